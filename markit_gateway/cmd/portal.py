@@ -12,7 +12,7 @@ from fastapi import FastAPI
 from fastapi.encoders import jsonable_encoder
 from fastapi.responses import JSONResponse, RedirectResponse
 
-from markit_gateway.common import IMUConnection, tcp_broadcast_command
+from markit_gateway.common import IMUConnection, StateTable, tcp_broadcast_command
 from markit_gateway.config import BrokerConfig
 from markit_gateway.functional import convert_measurement
 from markit_gateway.tasks import measure
@@ -31,7 +31,7 @@ IMU_ADDRESSES: Dict[str, Union[str, List[str]]] = {"unknown": []}  # index is de
 
 CONFIG: Optional[BrokerConfig] = None
 CLIENT_INFO_QUEUE: Optional[mp.Queue] = None
-IMU_STATE_QUEUE: Optional[mp.Queue] = None
+IMU_STATE_TABLE: Optional[StateTable] = None
 
 
 def make_response(status_code, **kwargs):
@@ -48,12 +48,16 @@ def measure_and_convert(
         signal_stop: mp.Event = None,
         signal_finish: mp.Event = None,
         client_info_queue: mp.Queue = None,
-        imu_state_queue: mp.Queue = None
+        imu_state_table: StateTable = None
 ):
-    measure(cfg, tag, signal_stop, client_info_queue, imu_state_queue)
+    measure(cfg, tag, signal_stop, client_info_queue, imu_state_table)
 
     try:
-        convert_measurement(osp.join(cfg.base_dir, tag))
+        convert_measurement(osp.join(cfg.base_dir, tag), cache_max_bytes=cfg.cache_max_bytes,
+                            index_stride=cfg.index_stride,
+                            align_n_workers=cfg.align_n_workers or None,
+                            align_pool=cfg.align_pool,
+                            align_rate_hz=cfg.align_rate_hz or None)
     except Exception as e:
         logging.error(e)
 
@@ -105,9 +109,23 @@ def imu_state_device_id(device_id: str = None):
             return make_response(status_code=500, message=f"device_id  is not connected")
 
 
+@app.get("/v1/imu/link")
+def imu_link():
+    global IMU_STATES
+    # Packet loss and decoder counters of every device, as last reported by its connection
+    keys = ('n_received', 'n_lost', 'n_duplicates', 'n_resets', 'n_checksum_failures', 'n_resync', 'n_skipped_bytes')
+    devices = {
+        device_id: {key: state[key] for key in (*keys, 'loss_rate') if key in state.keys()} for device_id, state in IMU_STATES.items()
+    }
+    total = {key: sum(device.get(key, 0) for device in devices.values()) for key in keys}
+    n_expected = total['n_received'] - total['n_duplicates'] + total['n_lost']
+    total['loss_rate'] = total['n_lost'] / n_expected if n_expected > 0 else 0.
+    return make_response(status_code=200, devices=devices, total=total, count=len(devices))
+
+
 @app.post("/v1/start")
 def start_process(tag: str = None, experiment_log: str = None):
-    global TCP_PROCS, STOP_EV, FINISH_EV, CONFIG, LOGGER, CLIENT_INFO_QUEUE, IMU_STATE_QUEUE, IMU_STATES, IMU_ADDRESSES
+    global TCP_PROCS, STOP_EV, FINISH_EV, CONFIG, LOGGER, CLIENT_INFO_QUEUE, IMU_STATE_TABLE, IMU_STATES, IMU_ADDRESSES
 
     # Wait until last capture ends
     if len(TCP_PROCS) > 0:
@@ -121,6 +139,7 @@ def start_process(tag: str = None, experiment_log: str = None):
                 # Clean up memory, prepare for next run
                 TCP_PROCS = []
                 IMU_STATES = {}
+                IMU_STATE_TABLE.clear()
                 IMU_ADDRESSES = {"unknown": []}
             else:
                 return make_response(status_code=500, msg="NOT FINISHED")
@@ -152,7 +171,7 @@ def start_process(tag: str = None, experiment_log: str = None):
                         STOP_EV,
                         FINISH_EV,
                         CLIENT_INFO_QUEUE,
-                        IMU_STATE_QUEUE
+                        IMU_STATE_TABLE
                     )
                 )
             ]
@@ -192,19 +211,14 @@ def kill_record():
 
 
 def update_imu_state_thread():
-    global IMU_STATE_QUEUE, IMU_STATES, LOGGER
+    global IMU_STATE_TABLE, IMU_STATES, LOGGER
     while True:
-        if IMU_STATE_QUEUE is not None:
-            if not IMU_STATE_QUEUE.empty():
-                try:
-                    msg = IMU_STATE_QUEUE.get(timeout=0.1)
-                    if msg is not None:
-                        if msg['id'] in IMU_STATES.keys():
-                            IMU_STATES[msg['id']] = msg
-                except Exception:
-                    pass
-        else:
-            time.sleep(0.1)
+        if IMU_STATE_TABLE is not None:
+            # Consistent copy of the latest states, however fast the workers write them
+            for device_id, state in IMU_STATE_TABLE.snapshot().items():
+                if device_id in IMU_STATES.keys():
+                    IMU_STATES[device_id] = state
+        time.sleep(0.1)
 
 
 def update_client_info_thread():
@@ -237,9 +251,9 @@ def update_client_info_thread():
 
 def portal(cfg: BrokerConfig):
     # Recording parameters
-    global CONFIG, LOGGER, IMU_STATE_QUEUE, CLIENT_INFO_QUEUE
+    global CONFIG, LOGGER, IMU_STATE_TABLE, CLIENT_INFO_QUEUE
 
-    IMU_STATE_QUEUE = mp.Queue()
+    IMU_STATE_TABLE = StateTable(cfg.state_table_size)
     CLIENT_INFO_QUEUE = mp.Queue()
 
     CONFIG = cfg
@@ -260,6 +274,8 @@ def portal(cfg: BrokerConfig):
     except KeyboardInterrupt:
         LOGGER.info(f"portal() got KeyboardInterrupt")
         return
+    finally:
+        IMU_STATE_TABLE.unlink()
 
 
 if __name__ == '__main__':
@@ -1,9 +1,21 @@
+import dataclasses
 import logging
-import struct
-from typing import List, Dict, BinaryIO
+import mmap
+import os
+from typing import List, Dict, BinaryIO, Union, Any, Optional, Iterator
 
 import numpy as np
 
+from .index import SeekIndex
+
+
+@dataclasses.dataclass()
+class ScanResult:
+    offsets: np.ndarray  # start offset of every accepted frame
+    skipped_bytes: int = 0  # bytes not covered by an accepted frame
+    n_resync: int = 0  # number of times the scanner had to re-acquire sync
+    end: int = 0  # offset right after the last accepted frame
+
 
 class IMUParser:
     ADDR = 0xe5
@@ -11,117 +23,301 @@ class IMUParser:
     ch_imu_data_t_fmt = "I3f3f3f3f4ffI"
     hi229_dgram_meta_t_fmt = "=qqIi12s"
 
+    # One datagram as it appears on the wire / on disk:
+    # 0xe5 + ch_imu_data_t + hi229_dgram_meta_t + xor checksum, packed, little endian
+    FRAME_DTYPE: np.dtype = np.dtype({
+        'names': [
+            'addr', 'imu_id',
+            'accel_x', 'accel_y', 'accel_z',
+            'gyro_x', 'gyro_y', 'gyro_z',
+            'mag_x', 'mag_y', 'mag_z',
+            'roll', 'pitch', 'yaw',
+            'quat_w', 'quat_x', 'quat_y', 'quat_z',
+            'pressure', 'sys_ticks',
+            'timestamp', 'tsf_timestamp', 'seq', 'uart_buffer_len', 'id',
+            'chksum'
+        ],
+        'formats': [
+            'u1', '<u4',
+            '<f4', '<f4', '<f4',
+            '<f4', '<f4', '<f4',
+            '<f4', '<f4', '<f4',
+            '<f4', '<f4', '<f4',
+            '<f4', '<f4', '<f4', '<f4',
+            '<f4', '<u4',
+            '<i8', '<i8', '<u4', '<i4', 'S12',
+            'u1'
+        ],
+        'offsets': [
+            0, 1,
+            5, 9, 13,
+            17, 21, 25,
+            29, 33, 37,
+            41, 45, 49,
+            53, 57, 61, 65,
+            69, 73,
+            77, 85, 93, 97, 101,
+            113
+        ],
+        'itemsize': 114
+    })
+    FRAME_SZ: int = FRAME_DTYPE.itemsize
+    SCAN_DEPTH: int = 4  # neighbouring frames consulted when candidates overlap
+    FRAME_COLUMNS: List[str] = [
+        "accel_x", "accel_y", "accel_z",
+        "gyro_x", "gyro_y", "gyro_z",
+        "roll", "pitch", "yaw",
+        "quat_w", "quat_x", "quat_y", "quat_z",
+        "temp",
+        "mag_x", "mag_y", "mag_z",
+        "sys_ticks",
+        'timestamp', 'tsf_timestamp', 'seq', 'uart_buffer_len', 'id',
+    ]
+
     def __init__(self) -> None:
-        self.buf: np.ndarray = np.zeros(shape=(100), dtype=np.uint8)
-        self.cursor: int = 0
-        self.start_reg: int = 0
-        self.length: int = 0
-        self.data_valid: bool = False
-        self.meta_valid: bool = False
-
-    def _reset(self):
-        self.cursor = 0
-        self.start_reg = 0
-        self.length = 0
-        self.data_valid = False
-        self.meta_valid = False
-        self.buf.fill(0)
+        self.last_scan: Optional[ScanResult] = None
 
-    @staticmethod
-    def verify_packet(buf, chksum: int) -> bool:
-        arr = np.frombuffer(buf, dtype=np.uint8)
-        arr_chksum = np.bitwise_xor.reduce(arr)
-        return arr_chksum == chksum
+    @classmethod
+    def verify_frames(cls, raw: np.ndarray) -> np.ndarray:
+        """Check sync byte and xor checksum of many frames at once
+
+        Args:
+            raw (np.ndarray): uint8 array of shape (N, FRAME_SZ)
 
-    def _sync(self, read_buf: bytes):
+        Returns:
+            np.ndarray: boolean mask of shape (N,)
         """
-        Magic Sync Algorithm.
-        See imu-esp-node (C code)
+        # xor over the payload and the checksum byte is zero for a valid frame
+        return (raw[:, 0] == cls.ADDR) & (np.bitwise_xor.reduce(raw, axis=1) == 0)
+
+    def decode(self, read_buf: Union[bytes, bytearray, memoryview, np.ndarray], start_idx: int = 0) -> np.ndarray:
+        """Decode back-to-back frames starting at start_idx
+
+        Frames are viewed in place with np.frombuffer, frames with a broken checksum are dropped.
+
         Args:
-            read_buf:
+            read_buf: raw recording
+            start_idx: offset of the first frame
 
         Returns:
+            np.ndarray: structured array of FRAME_DTYPE
+        """
+        n_frames = max(0, (len(read_buf) - start_idx) // self.FRAME_SZ)
+        if n_frames == 0:
+            return np.empty((0,), dtype=self.FRAME_DTYPE)
+
+        raw = np.frombuffer(read_buf, dtype=np.uint8, count=n_frames * self.FRAME_SZ, offset=start_idx)
+        raw = raw.reshape(n_frames, self.FRAME_SZ)
+        valid = self.verify_frames(raw)
+        n_invalid = n_frames - int(np.count_nonzero(valid))
+        if n_invalid > 0:
+            logging.warning(f"dropped {n_invalid} frames with bad checksum")
+            raw = raw[valid]
+
+        return np.ascontiguousarray(raw).view(self.FRAME_DTYPE).reshape(-1)
+
+    @classmethod
+    def scan(cls, read_buf: Union[bytes, bytearray, memoryview, np.ndarray]) -> ScanResult:
+        """Locate every valid frame in a buffer, tolerating corrupt spans
 
+        All 0xe5 candidates are found at once and their checksums are checked against a prefix xor of
+        the buffer, so a dropped or extra byte only costs the frames it touches.
+
+        Args:
+            read_buf: raw recording
+
+        Returns:
+            ScanResult: offsets of the accepted frames and resync statistics
         """
-        res: List[Dict[str, float]] = []
-        if len(read_buf) <= 0:
-            logging.warning('Empty record!!!')
-            return res
-
-        for idx in range(len(read_buf)):
-            if read_buf[idx] == self.ADDR:
-                _start_idx = idx
-                _end_idx = _start_idx + 1 + struct.calcsize(self.ch_imu_data_t_fmt) + struct.calcsize(
-                    self.hi229_dgram_meta_t_fmt)
-                data_valid = self.verify_packet(read_buf[_start_idx: _end_idx], read_buf[_end_idx])
-                if data_valid:
-                    return {
-                        "sync_start_idx": _start_idx,
-                        "dgram_length": _end_idx - _start_idx + 1,
-                        "imu_offset": 1,
-                        "imu_length": struct.calcsize(self.ch_imu_data_t_fmt),
-                        "imu_fmt": self.ch_imu_data_t_fmt,
-                        "meta_offset": _start_idx + 1 + struct.calcsize(self.ch_imu_data_t_fmt),
-                        "meta_length": struct.calcsize(self.hi229_dgram_meta_t_fmt),
-                        "meta_fmt": self.hi229_dgram_meta_t_fmt
-                    }
+        arr = np.frombuffer(read_buf, dtype=np.uint8)
+        n = len(arr)
+        if n < cls.FRAME_SZ:
+            return ScanResult(offsets=np.empty((0,), dtype=np.int64), skipped_bytes=n, n_resync=0, end=0)
+
+        candidates = np.flatnonzero(arr[:n - cls.FRAME_SZ + 1] == cls.ADDR)
+        prefix = np.empty(n + 1, dtype=np.uint8)
+        prefix[0] = 0
+        np.bitwise_xor.accumulate(arr, out=prefix[1:])
+        # xor over [start, start + FRAME_SZ) is zero for a valid frame
+        valid = candidates[prefix[candidates + cls.FRAME_SZ] == prefix[candidates]]
+
+        if len(valid) > 1:
+            # A random 0xe5 inside a payload passes the checksum once in 256 tries, and slowly changing
+            # readings can repeat such a false positive in the next frames. Real frames form the longest
+            # chains of candidates spaced FRAME_SZ apart, so overlapping candidates are ranked by chain support.
+            linked = np.flatnonzero(np.diff(valid) < cls.FRAME_SZ)
+            if len(linked) > 0:
+                contested = np.union1d(linked, linked + 1)
+                support = np.zeros(len(valid), dtype=np.int64)
+                for k in range(1, cls.SCAN_DEPTH + 1):
+                    for probe in (valid[contested] + k * cls.FRAME_SZ, valid[contested] - k * cls.FRAME_SZ):
+                        pos = np.minimum(np.searchsorted(valid, probe), len(valid) - 1)
+                        support[contested] += valid[pos] == probe
+
+                keep = np.ones(len(valid), dtype=bool)
+                # Only clusters of overlapping candidates are visited in python
+                for run in np.split(linked, np.flatnonzero(np.diff(linked) != 1) + 1):
+                    members = np.arange(run[0], run[-1] + 2)
+                    chosen: List[int] = []
+                    for m in members[np.lexsort((valid[members], -support[members]))]:
+                        if all(abs(int(valid[m]) - int(valid[c])) >= cls.FRAME_SZ for c in chosen):
+                            chosen.append(m)
+                    keep[members] = False
+                    keep[chosen] = True
+                valid = valid[keep]
+
+        if len(valid) == 0:
+            return ScanResult(offsets=valid.astype(np.int64), skipped_bytes=n, n_resync=0, end=0)
+
+        n_resync = int(np.count_nonzero(np.diff(valid) != cls.FRAME_SZ)) + int(valid[0] != 0)
+        return ScanResult(offsets=valid.astype(np.int64),
+                          skipped_bytes=n - len(valid) * cls.FRAME_SZ,
+                          n_resync=n_resync,
+                          end=int(valid[-1]) + cls.FRAME_SZ)
+
+    @classmethod
+    def decode_at(cls, read_buf: Union[bytes, bytearray, memoryview, np.ndarray], offsets: np.ndarray) -> np.ndarray:
+        """Gather frames at the given offsets into a structured array of FRAME_DTYPE"""
+        if len(offsets) == 0:
+            return np.empty((0,), dtype=cls.FRAME_DTYPE)
+        arr = np.frombuffer(read_buf, dtype=np.uint8)
+        if offsets[-1] - offsets[0] == (len(offsets) - 1) * cls.FRAME_SZ:
+            # Contiguous run, no gather needed
+            raw = arr[offsets[0]:offsets[-1] + cls.FRAME_SZ]
+        else:
+            raw = np.lib.stride_tricks.sliding_window_view(arr, cls.FRAME_SZ)[offsets]
+        return np.ascontiguousarray(raw).view(cls.FRAME_DTYPE).reshape(-1)
+
+    @classmethod
+    def to_columns(cls, frames: np.ndarray) -> Dict[str, np.ndarray]:
+        """Split structured frames into one array per field
+
+        Args:
+            frames (np.ndarray): structured array of FRAME_DTYPE
+
+        Returns:
+            Dict[str, np.ndarray]: field name -> array of shape (N,), same keys as the legacy dict records
+        """
+        res: Dict[str, np.ndarray] = {}
+        for key in cls.FRAME_COLUMNS:
+            if key == 'temp':
+                res[key] = np.zeros(len(frames), dtype=np.float32)
+            elif key == 'id':
+                res[key] = np.char.decode(frames['id'], 'latin-1')
+            else:
+                res[key] = frames[key]
+        return res
+
+    @staticmethod
+    def to_records(columns: Dict[str, np.ndarray]) -> List[Dict[str, Any]]:
+        """Convert columnar arrays back to the legacy list of dict records"""
+        keys = list(columns.keys())
+        values = [columns[key].tolist() for key in keys]
+        return [dict(zip(keys, row)) for row in zip(*values)]
+
+    def iter_batches(self,
+                     filename: str,
+                     batch_size: int = 0x10000,
+                     index: Optional[SeekIndex] = None,
+                     start: int = 0,
+                     stop: Optional[int] = None) -> Iterator[np.ndarray]:
+        """Memory-map a recording and yield its frames in batches
+
+        The file is scanned in windows of batch_size frames, a frame crossing a window boundary is carried over
+        to the next window. Statistics of the whole file are kept in self.last_scan.
+
+        Args:
+            filename (str): path to the recording
+            batch_size (int): maximum number of frames per batch
+            index (SeekIndex): if given, checkpoints of the decoded frames are added to it
+            start (int): byte offset to start scanning from
+            stop (int): byte offset to stop scanning at, defaults to end of file
+
+        Yields:
+            np.ndarray: structured array of FRAME_DTYPE, at most batch_size frames
+        """
+        self.last_scan = ScanResult(offsets=np.empty((0,), dtype=np.int64))
+        size = os.path.getsize(filename)
+        if size <= 0:
+            logging.warning("empty recording")
+            return
+        size = size if stop is None else min(stop, size)
+
+        window_sz = max(batch_size, 1) * self.FRAME_SZ
+        with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            while start < size:
+                stop = min(start + window_sz, size)
+                window = memoryview(mm)[start:stop]
+                scan = self.scan(window)
+                frames = self.decode_at(window, scan.offsets).copy()
+                window.release()
+                if index is not None:
+                    index.add(scan.offsets + start, frames)
+
+                if stop == size:
+                    next_start = stop
+                elif len(scan.offsets) > 0:
+                    next_start = start + scan.end
                 else:
-                    continue
-
-            self.cursor += 1
-
-        return None
-
-    def _parse(self, read_buf, fmt) -> List[Dict]:
-        result: List[Dict] = []
-        start_idx = fmt['sync_start_idx']
-        try:
-            while start_idx + fmt['dgram_length'] < len(read_buf):
-                imu_data = struct.unpack(
-                    self.ch_imu_data_t_fmt,
-                    read_buf[start_idx + fmt['imu_offset']:start_idx + fmt['imu_offset'] + fmt['imu_length']]
-                )
-                meta_data = struct.unpack(
-                    self.hi229_dgram_meta_t_fmt,
-                    read_buf[start_idx + fmt['meta_offset']:start_idx + fmt['meta_offset'] + fmt['meta_length']]
-                )
-
-                imu_dict: dict = {
-                    "accel_x": imu_data[1], "accel_y": imu_data[2], "accel_z": imu_data[3],
-                    "gyro_x": imu_data[4], "gyro_y": imu_data[5], "gyro_z": imu_data[6],
-                    "roll": imu_data[10], "pitch": imu_data[11], "yaw": imu_data[12],
-                    "quat_w": imu_data[13], "quat_x": imu_data[14], "quat_y": imu_data[15], "quat_z": imu_data[16],
-                    "temp": 0.0,
-                    "mag_x": imu_data[7], "mag_y": imu_data[8], "mag_z": imu_data[9],
-                    "sys_ticks": imu_data[18]
-                }
-
-                meta_dict = {
-                    'timestamp': meta_data[0],
-                    'tsf_timestamp': meta_data[1],
-                    'seq': meta_data[2],
-                    'uart_buffer_len': meta_data[3],
-                    'id': ''.join([chr(meta_data[4][idx]) for idx in range(len(meta_data[4]))]),
-                }
-
-                result.append({**imu_dict, **meta_dict})
-
-                start_idx += fmt['dgram_length']
-        except Exception as e:
-            print(e)
-            pass
-
-        return result
-
-    def __call__(self, f: BinaryIO) -> List[Dict[str, float]]:
+                    next_start = stop - (self.FRAME_SZ - 1)
+
+                self.last_scan.skipped_bytes += (next_start - start) - len(frames) * self.FRAME_SZ
+                self.last_scan.n_resync += scan.n_resync
+                self.last_scan.end = start + scan.end if len(scan.offsets) > 0 else self.last_scan.end
+                start = next_start
+
+                if len(frames) > 0:
+                    yield frames
+
+        if self.last_scan.skipped_bytes > 0:
+            logging.warning(f"skipped {self.last_scan.skipped_bytes} bytes in {filename}, resynced {self.last_scan.n_resync} times")
+
+    def read_range(self,
+                   filename: str,
+                   t_start: int,
+                   t_end: int,
+                   method: str = 'tsf_timestamp',
+                   device_id: Optional[str] = None) -> np.ndarray:
+        """Decode only the frames with t_start <= t < t_end
+
+        The byte ranges are looked up in the {filename}.idx.npy sidecar if there is one, otherwise the whole
+        recording is scanned.
+
+        Returns:
+            np.ndarray: structured array of FRAME_DTYPE
+        """
+        index = SeekIndex.load(filename)
+        ranges = index.byte_ranges(t_start, t_end, method, device_id) if index is not None else [(0, None)]
+        res: List[np.ndarray] = []
+        for start, stop in ranges:
+            for frames in self.iter_batches(filename, start=start, stop=stop):
+                mask = (frames[method] >= t_start) & (frames[method] < t_end)
+                if device_id is not None:
+                    mask &= frames['id'] == device_id.encode('latin-1')
+                res.append(frames[mask])
+        return np.concatenate(res) if len(res) > 0 else np.empty((0,), dtype=self.FRAME_DTYPE)
+
+    def __call__(self, f: BinaryIO, columnar: bool = False) -> Union[List[Dict[str, float]], Dict[str, np.ndarray]]:
+        """Parse a recording
+
+        Args:
+            f (BinaryIO): opened recording
+            columnar (bool): return Dict[str, np.ndarray] instead of List[Dict]
+
+        Returns:
+            decoded frames, as records (default) or as columns
+        """
         read_buf = f.read()
         if len(read_buf) <= 0:
             logging.warning("empty recording")
-            return []
-        fmt = self._sync(read_buf)
-        result = self._parse(read_buf, fmt)
+            return self.to_columns(np.empty((0,), dtype=self.FRAME_DTYPE)) if columnar else []
+        self.last_scan = self.scan(read_buf)
+        if self.last_scan.skipped_bytes > 0:
+            logging.warning(f"skipped {self.last_scan.skipped_bytes} bytes, resynced {self.last_scan.n_resync} times")
 
-        return result
+        frames = self.decode_at(read_buf, self.last_scan.offsets)
+        columns = self.to_columns(frames)
+        return columns if columnar else self.to_records(columns)
 
 
 if __name__ == '__main__':
@@ -1,4 +1,15 @@
 from .IMUParser import IMUParser
+from .balance import LoadBalancer, WorkerLoad, MigrateCommand, MigratedConnection
+from .clock import ClockModel
+from .framelog import FrameLog
+from .index import SeekIndex
+from .ingest import IngestSelector, RecvBuffer, AdaptiveBufferSize
+from .live import LiveSubscriber
 from .render import IMURender
+from .segment import SegmentedFile, SegmentManifest
+from .sequence import SequenceTracker
+from .state import StateTable
+from .stream import FrameStreamDecoder
 from .repo import ClientRepo, IMUConnection
-from .tcp import tcp_send_bytes, tcp_broadcast_command
+from .tcp import tcp_send_bytes, tcp_broadcast_command, tcp_listen_socket, tcp_accept_all
+from .writer import CoalescingWriter
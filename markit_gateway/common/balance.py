@@ -0,0 +1,102 @@
+import dataclasses
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .repo import IMUConnection
+
+
+@dataclasses.dataclass()
+class WorkerLoad:
+    """Load of a tcp_process worker over the last report interval, sent to tcp_listen_task"""
+    proc_id: int
+    bytes_per_s: float = 0.
+    connections: Dict[int, Tuple[int, float]] = dataclasses.field(default_factory=dict)  # fd -> (client port, bytes/s)
+
+    @property
+    def n_connections(self) -> int:
+        return len(self.connections)
+
+
+@dataclasses.dataclass()
+class MigrateCommand:
+    """Ask a worker to hand the connection on fd over to worker dst"""
+    fd: int
+    port: int  # client port, guards against the fd having been reused meanwhile
+    dst: int
+
+
+@dataclasses.dataclass()
+class MigratedConnection:
+    """A connection on its way to worker dst, with the bytes the new owner must replay first"""
+    dst: int
+    connection: IMUConnection
+    pending: bytes = b''
+
+
+class LoadBalancer:
+    """Placement of new clients and migration planning, from the loads the workers report
+
+    A new client goes to the worker with the least bytes/s, counting the clients placed there since its last
+    report at the average rate of a connection, then with the fewest connections. When the busiest worker
+    exceeds the mean load by more than threshold, plan() picks on it the connection whose move to the least
+    loaded worker best evens the two out. After a move, nothing else is planned for cooldown_s, so that the
+    next decision is based on fresh reports.
+
+    Args:
+        n_procs (int): number of workers
+        threshold (float): tolerated excess of the busiest worker over the mean, relative, 0 disables migrations
+        cooldown_s (float): minimal time between two migrations
+        min_bytes_per_s (float): imbalances smaller than this are ignored
+    """
+
+    def __init__(self, n_procs: int, threshold: float = 0.5, cooldown_s: float = 5., min_bytes_per_s: float = 0x1000):
+        self.n_procs = n_procs
+        self.threshold = threshold
+        self.cooldown_s = cooldown_s
+        self.min_bytes_per_s = min_bytes_per_s
+        self.loads: List[WorkerLoad] = [WorkerLoad(i) for i in range(n_procs)]
+        self.n_placed: List[int] = [0] * n_procs  # clients placed since the last report of each worker
+        self.last_move_time: float = 0.
+
+    def report(self, load: WorkerLoad):
+        self.loads[load.proc_id] = load
+        self.n_placed[load.proc_id] = 0
+
+    def _average_connection_rate(self) -> float:
+        n_connections = sum(load.n_connections for load in self.loads)
+        return sum(load.bytes_per_s for load in self.loads) / n_connections if n_connections > 0 else 0.
+
+    def place(self) -> int:
+        """Worker of a new client"""
+        rate = self._average_connection_rate()
+        proc_id = min(range(self.n_procs), key=lambda i: (
+            self.loads[i].bytes_per_s + self.n_placed[i] * rate,
+            self.loads[i].n_connections + self.n_placed[i]
+        ))
+        self.n_placed[proc_id] += 1
+        return proc_id
+
+    def plan(self, now: Optional[float] = None) -> Optional[Tuple[int, MigrateCommand]]:
+        """Next migration, as (source worker, command), or None if the load is balanced enough"""
+        now = time.time() if now is None else now
+        if self.threshold <= 0 or self.n_procs < 2 or now - self.last_move_time < self.cooldown_s:
+            return None
+        mean = sum(load.bytes_per_s for load in self.loads) / self.n_procs
+        src = max(self.loads, key=lambda x: x.bytes_per_s)
+        dst = min(self.loads, key=lambda x: x.bytes_per_s)
+        gap = src.bytes_per_s - dst.bytes_per_s
+        if src.bytes_per_s <= (1 + self.threshold) * mean or gap < self.min_bytes_per_s:
+            return None
+
+        # Moving rate r leaves a gap of |gap - 2r|, only moves that shrink it are worth it
+        candidates = [(fd, port, rate) for fd, (port, rate) in src.connections.items() if 0 < rate < gap]
+        if len(candidates) == 0:
+            return None
+        fd, port, rate = min(candidates, key=lambda x: abs(gap - 2 * x[2]))
+
+        # Account for the move until both workers report again
+        src.connections.pop(fd)
+        src.bytes_per_s -= rate
+        dst.bytes_per_s += rate
+        self.last_move_time = now
+        return src.proc_id, MigrateCommand(fd, port, dst.proc_id)
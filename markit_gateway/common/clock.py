@@ -0,0 +1,177 @@
+import glob
+import json
+import os
+from typing import Dict, Any, Optional, Union, Iterable, List
+
+import numpy as np
+
+
+class ClockModel:
+    """Running least-squares fit of a device's global timestamp against its tsf_timestamp
+
+        timestamp ~ timestamp(tsf_ref) + slope * (tsf - tsf_ref)
+
+    Means and co-moments are merged batch by batch (Chan et al.), so an update costs O(1) per frame and nothing
+    is kept but a handful of scalars. Values are taken relative to the first frame seen, which keeps float64
+    exact enough for microsecond clocks.
+    """
+    SUFFIX: str = '.clock.json'
+
+    def __init__(self, device_id: Optional[str] = None):
+        self.device_id = device_id
+        self.n: int = 0
+        self.tsf_ref: int = 0
+        self.timestamp_ref: int = 0
+        self.mean_tsf: float = 0.
+        self.mean_timestamp: float = 0.
+        self.c_xx: float = 0.
+        self.c_xy: float = 0.
+        self.c_yy: float = 0.
+
+    def __len__(self):
+        return self.n
+
+    def _merge(self, n: int, mean_x: float, mean_y: float, c_xx: float, c_xy: float, c_yy: float):
+        total = self.n + n
+        dx = mean_x - self.mean_tsf
+        dy = mean_y - self.mean_timestamp
+        w = self.n * n / total
+        self.mean_tsf += dx * n / total
+        self.mean_timestamp += dy * n / total
+        self.c_xx += c_xx + dx * dx * w
+        self.c_xy += c_xy + dx * dy * w
+        self.c_yy += c_yy + dy * dy * w
+        self.n = total
+
+    def update(self, tsf_timestamp: Union[int, np.ndarray], timestamp: Union[int, np.ndarray]):
+        """Add one or more (tsf_timestamp, timestamp) pairs"""
+        tsf_timestamp = np.asarray(tsf_timestamp, dtype=np.int64).reshape(-1)
+        timestamp = np.asarray(timestamp, dtype=np.int64).reshape(-1)
+        if len(tsf_timestamp) == 0:
+            return
+        if self.n == 0:
+            self.tsf_ref, self.timestamp_ref = int(tsf_timestamp[0]), int(timestamp[0])
+        x = (tsf_timestamp - self.tsf_ref).astype(np.float64)
+        y = (timestamp - self.timestamp_ref).astype(np.float64)
+        mean_x, mean_y = x.mean(), y.mean()
+        x -= mean_x
+        y -= mean_y
+        self._merge(len(x), mean_x, mean_y, float(x @ x), float(x @ y), float(y @ y))
+
+    def merge(self, other: 'ClockModel'):
+        """Fold in the fit of another part of the same device, e.g. an earlier connection"""
+        if other.n == 0:
+            return
+        if self.n == 0:
+            self.tsf_ref, self.timestamp_ref = other.tsf_ref, other.timestamp_ref
+        self._merge(other.n,
+                    other.mean_tsf + (other.tsf_ref - self.tsf_ref),
+                    other.mean_timestamp + (other.timestamp_ref - self.timestamp_ref),
+                    other.c_xx, other.c_xy, other.c_yy)
+
+    @property
+    def slope(self) -> float:
+        return self.c_xy / self.c_xx if self.c_xx > 0 else 1.
+
+    @property
+    def drift_ppm(self) -> float:
+        return (self.slope - 1.) * 1e6
+
+    @property
+    def offset_us(self) -> float:
+        """timestamp - tsf_timestamp at the center of the observed frames"""
+        return (self.timestamp_ref + self.mean_timestamp) - (self.tsf_ref + self.mean_tsf)
+
+    @property
+    def residual_std_us(self) -> float:
+        if self.n == 0:
+            return 0.
+        c_yy = self.c_yy - (self.c_xy ** 2 / self.c_xx if self.c_xx > 0 else 0.)
+        return float(np.sqrt(max(c_yy, 0.) / self.n))
+
+    def to_global(self, tsf_timestamp: Union[int, np.ndarray]) -> np.ndarray:
+        """Global timestamp of the given tsf_timestamp, int64 microseconds"""
+        x = (np.asarray(tsf_timestamp, dtype=np.int64) - self.tsf_ref).astype(np.float64) - self.mean_tsf
+        return self.timestamp_ref + np.round(self.mean_timestamp + self.slope * x).astype(np.int64)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'device_id': self.device_id,
+            'n': self.n,
+            'tsf_ref': self.tsf_ref,
+            'timestamp_ref': self.timestamp_ref,
+            'mean_tsf': self.mean_tsf,
+            'mean_timestamp': self.mean_timestamp,
+            'c_xx': self.c_xx,
+            'c_xy': self.c_xy,
+            'c_yy': self.c_yy,
+            'offset_us': self.offset_us,
+            'drift_ppm': self.drift_ppm,
+            'residual_std_us': self.residual_std_us,
+        }
+
+    @classmethod
+    def from_dict(cls, src: Dict[str, Any]) -> 'ClockModel':
+        res = cls(src.get('device_id'))
+        for key in ('n', 'tsf_ref', 'timestamp_ref'):
+            setattr(res, key, int(src[key]))
+        for key in ('mean_tsf', 'mean_timestamp', 'c_xx', 'c_xy', 'c_yy'):
+            setattr(res, key, float(src[key]))
+        return res
+
+    @classmethod
+    def path_of(cls, filename: str) -> str:
+        return filename + cls.SUFFIX
+
+    @classmethod
+    def save_all(cls, models: Iterable['ClockModel'], filename: str):
+        """Write the models next to the recording they were fitted on
+
+        A recording appended to by several connections (a reconnection reusing the fd) keeps one model per device,
+        the fits of the earlier connections are merged in.
+        """
+        path = cls.path_of(filename)
+        res: List[ClockModel] = []
+        if os.path.exists(path):
+            with open(path) as f:
+                res = [cls.from_dict(item) for item in json.load(f)]
+        by_id = {model.device_id: model for model in res if model.device_id is not None}
+        for model in models:
+            if model.device_id is not None and model.device_id in by_id.keys():
+                by_id[model.device_id].merge(model)
+            else:
+                res.append(model)
+        with open(path, 'w') as f:
+            json.dump([model.to_dict() for model in res], f, indent=4)
+
+    @classmethod
+    def load_all(cls, base_dir: str) -> Dict[str, 'ClockModel']:
+        """Models saved in a measurement directory, parts of the same device are merged"""
+        res: Dict[str, ClockModel] = {}
+        for path in sorted(glob.glob(os.path.join(base_dir, f'*{cls.SUFFIX}'))):
+            with open(path) as f:
+                models = [cls.from_dict(item) for item in json.load(f)]
+            for model in models:
+                if model.device_id is None:
+                    continue
+                if model.device_id not in res.keys():
+                    res[model.device_id] = cls(model.device_id)
+                res[model.device_id].merge(model)
+        return res
+
+    @classmethod
+    def fit(cls, tsf_timestamp: np.ndarray, timestamp: np.ndarray, device_id: Optional[str] = None, chunk_size: int = 0x10000) -> 'ClockModel':
+        """Fit a recorded device, reading the (possibly memory-mapped) columns chunk by chunk"""
+        res = cls(device_id)
+        tsf_timestamp = tsf_timestamp.reshape(-1)
+        timestamp = timestamp.reshape(-1)
+        for start in range(0, len(tsf_timestamp), chunk_size):
+            res.update(tsf_timestamp[start:start + chunk_size], timestamp[start:start + chunk_size])
+        return res
+
+    @staticmethod
+    def average(models: Iterable['ClockModel'], tsf_timestamp: np.ndarray) -> np.ndarray:
+        """Global time of tsf_timestamp averaged over several devices"""
+        predictions = [model.to_global(tsf_timestamp) for model in models]
+        base = predictions[0]
+        return base + np.round(np.mean([prediction - base for prediction in predictions], axis=0)).astype(np.int64)
@@ -0,0 +1,71 @@
+import glob
+import os
+from typing import Dict, BinaryIO, Union
+
+import numpy as np
+
+from .IMUParser import IMUParser
+from .writer import CoalescingWriter, CoalescedFile
+
+
+class FrameLog:
+    """Append-only log of decoded frames, one file per device
+
+    Every record is one IMUParser.FRAME_DTYPE frame, so a log can be memory-mapped as a structured array
+    and every field read as a column. Files are opened in append mode: frames of a device that reconnects
+    to another worker end up in the same log.
+    """
+    SUFFIX: str = '.frames'
+
+    def __init__(self, base_dir: str, writer: CoalescingWriter = None):
+        self.base_dir = base_dir
+        self.writer = writer
+        self.handles: Dict[bytes, Union[BinaryIO, CoalescedFile]] = {}
+
+    @classmethod
+    def path_of(cls, base_dir: str, imu_id: str) -> str:
+        return os.path.join(base_dir, f'imu_{imu_id}{cls.SUFFIX}')
+
+    @classmethod
+    def list(cls, base_dir: str) -> Dict[str, str]:
+        """Logs in a directory
+
+        Returns:
+            Dict[str, str]: device id -> path
+        """
+        return {
+            os.path.basename(path)[len('imu_'):-len(cls.SUFFIX)]: path for path in sorted(glob.glob(os.path.join(base_dir, f'imu_*{cls.SUFFIX}')))
+        }
+
+    @staticmethod
+    def load(path: str) -> np.ndarray:
+        """Memory-map a log, a record cut short by an interrupted write is ignored"""
+        n_frames = os.path.getsize(path) // IMUParser.FRAME_SZ
+        if n_frames == 0:
+            return np.empty((0,), dtype=IMUParser.FRAME_DTYPE)
+        return np.memmap(path, dtype=IMUParser.FRAME_DTYPE, mode='r', shape=(n_frames,))
+
+    def append(self, frames: np.ndarray):
+        if len(frames) == 0:
+            return
+        ids = frames['id']
+        if np.all(ids == ids[0]):
+            self._write(ids[0], frames)
+        else:
+            for device_id in np.unique(ids):
+                self._write(device_id, frames[ids == device_id])
+
+    def _write(self, device_id: bytes, frames: np.ndarray):
+        if device_id not in self.handles.keys():
+            path = self.path_of(self.base_dir, device_id.decode('latin-1'))
+            self.handles[device_id] = self.writer.open(path) if self.writer is not None else open(path, 'ab')
+        self.handles[device_id].write(np.ascontiguousarray(frames).view(np.uint8))
+
+    def flush(self):
+        for handle in self.handles.values():
+            handle.flush()
+
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
+        self.handles = {}
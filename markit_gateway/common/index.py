@@ -0,0 +1,136 @@
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+class SeekIndex:
+    """Sparse timestamp -> byte offset checkpoints of a raw recording
+
+    Every stride-th frame is recorded with its offset, timestamps and device id. The index is stored next to
+    the recording as {recording}.idx.npy and lets IMUParser decode a time window without reading the whole
+    file.
+    """
+    DTYPE: np.dtype = np.dtype([
+        ('offset', '<i8'),
+        ('timestamp', '<i8'),
+        ('tsf_timestamp', '<i8'),
+        ('id', 'S12'),
+    ])
+    SUFFIX: str = '.idx.npy'
+
+    def __init__(self, stride: int = 256, entries: Optional[np.ndarray] = None):
+        self.stride = max(stride, 1)
+        self._entries: List[np.ndarray] = [] if entries is None else [entries]
+        self._countdown: int = 0
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._entries)
+
+    @classmethod
+    def path_of(cls, filename: str) -> str:
+        return filename + cls.SUFFIX
+
+    @classmethod
+    def load(cls, filename: str) -> Optional['SeekIndex']:
+        """Index of a recording, None if there is no sidecar"""
+        path = cls.path_of(filename)
+        if not os.path.exists(path):
+            return None
+        return cls(entries=np.load(path))
+
+    def save(self, filename: str):
+        """Write the sidecar of a recording, merged with the checkpoints of earlier sessions appended to it"""
+        entries = self.entries
+        previous = self.load(filename)
+        if previous is not None:
+            entries = np.concatenate([previous.entries, entries])
+            # In file order, a checkpoint recorded twice is kept once
+            entries = entries[np.unique(entries['offset'], return_index=True)[1]]
+        np.save(self.path_of(filename), entries)
+
+    @property
+    def entries(self) -> np.ndarray:
+        if len(self._entries) != 1:
+            self._entries = [np.concatenate(self._entries) if len(self._entries) > 0 else np.empty((0,), dtype=self.DTYPE)]
+        return self._entries[0]
+
+    def add(self, offsets: np.ndarray, frames: np.ndarray):
+        """Record a checkpoint every stride frames
+
+        Args:
+            offsets (np.ndarray): offset of every frame in the recording
+            frames (np.ndarray): structured array of IMUParser.FRAME_DTYPE
+        """
+        picked = np.arange(self._countdown, len(frames), self.stride)
+        self._countdown = (self._countdown - len(frames)) % self.stride
+        if len(picked) == 0:
+            return
+        entries = np.empty((len(picked),), dtype=self.DTYPE)
+        entries['offset'] = offsets[picked]
+        for field in ('timestamp', 'tsf_timestamp', 'id'):
+            entries[field] = frames[field][picked]
+        self._entries.append(entries)
+
+    def add_checkpoint(self, offset: int, frame: np.ndarray, n_frames: int):
+        """Live variant of add(): n_frames were decoded since the last call and frame is the last of them"""
+        self._countdown -= n_frames
+        if self._countdown > 0:
+            return
+        self._countdown = self.stride
+        entry = np.empty((1,), dtype=self.DTYPE)
+        entry['offset'] = offset
+        for field in ('timestamp', 'tsf_timestamp', 'id'):
+            entry[field] = frame[field]
+        self._entries.append(entry)
+
+    def byte_ranges(self,
+                    t_start: int,
+                    t_end: int,
+                    method: str = 'tsf_timestamp',
+                    device_id: Optional[str] = None) -> List[Tuple[int, Optional[int]]]:
+        """Byte ranges of the recording that hold every frame with t_start <= t < t_end
+
+        A recording appended to by several connections holds several sessions, the time restarts or jumps back at
+        each of them. Checkpoints are split into runs of non-decreasing time, each run is searched on its own.
+
+        Returns:
+            List[Tuple[int, Optional[int]]]: disjoint (start, stop) offsets in file order, stop is None for end of file
+        """
+        entries = self.entries
+        if device_id is not None:
+            entries = entries[entries['id'] == device_id.encode('latin-1')]
+        if len(entries) == 0:
+            return [(0, None)]
+        entries = entries[np.argsort(entries['offset'], kind='stable')]
+        timestamps = entries[method]
+        bounds = [0, *(np.flatnonzero(np.diff(timestamps) < 0) + 1).tolist(), len(entries)]
+
+        res: List[Tuple[int, Optional[int]]] = []
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            session = timestamps[lo:hi]
+            # Back off one checkpoint to tolerate offsets that are slightly late. Frames before the first and after
+            # the last checkpoint of a session lie between it and its neighbours
+            first = max(lo + int(np.searchsorted(session, t_start, side='right')) - 2, lo - 1)
+            last = min(lo + int(np.searchsorted(session, t_end, side='left')) + 1, hi)
+            start = int(entries['offset'][first]) if first >= 0 else 0
+            stop = int(entries['offset'][last]) if last < len(entries) else None
+            if len(res) > 0 and (res[-1][1] is None or res[-1][1] >= start):
+                # Overlapping or adjacent
+                res[-1] = (res[-1][0], None if res[-1][1] is None or stop is None else max(res[-1][1], stop))
+            else:
+                res.append((start, stop))
+        return res
+
+    def byte_range(self,
+                   t_start: int,
+                   t_end: int,
+                   method: str = 'tsf_timestamp',
+                   device_id: Optional[str] = None) -> Tuple[int, Optional[int]]:
+        """Single byte range covering byte_ranges()
+
+        Returns:
+            Tuple[int, Optional[int]]: start and stop offsets, stop is None for end of file
+        """
+        ranges = self.byte_ranges(t_start, t_end, method, device_id)
+        return ranges[0][0], ranges[-1][1]
@@ -0,0 +1,193 @@
+import selectors
+import socket
+from multiprocessing.connection import Connection
+from typing import Any, Dict, List, Optional, Tuple
+
+from .tcp import tcp_accept_all
+
+
+class RecvBuffer:
+    """Preallocated buffer for socket.recv_into, for connections whose bytes are stored without decoding
+
+    Same receive protocol as FrameStreamDecoder: receive into writable(), then commit() what was received.
+    """
+
+    def __init__(self, capacity: int = 0x4000):
+        self.capacity: int = capacity
+        self._buf: bytearray = bytearray(capacity)
+        self._view: memoryview = memoryview(self._buf)
+        self.tail: int = 0
+
+    def __len__(self):
+        return self.tail
+
+    def writable(self) -> memoryview:
+        return self._view[self.tail:]
+
+    def commit(self, n: int):
+        self.tail += n
+
+    def take(self) -> memoryview:
+        """Bytes received so far, the buffer is emptied. The view is valid until the next writable() call"""
+        res = self._view[:self.tail]
+        self.tail = 0
+        return res
+
+    def resize(self, capacity: int):
+        """Reallocate the buffer with another capacity, received bytes are kept"""
+        capacity = max(capacity, self.tail)
+        if capacity == self.capacity:
+            return
+        buf = bytearray(capacity)
+        buf[:self.tail] = self._view[:self.tail]
+        self.capacity = capacity
+        self._buf = buf
+        self._view = memoryview(self._buf)
+
+
+class AdaptiveBufferSize:
+    """Receive buffer size of one connection, following its throughput
+
+    The size doubles when one poll brings in half of the buffer or more, and halves when both that poll and the
+    moving average of the bytes per poll stay under a quarter and an eighth of it. A quiet connection keeps a small buffer, a busy one gets
+    fewer and larger recv_into calls per wakeup.
+
+    Args:
+        min_size (int): initial and minimal size in bytes
+        max_size (int): maximal size in bytes
+        alpha (float): weight of the last poll in the moving average
+    """
+
+    def __init__(self, min_size: int = 0x400, max_size: int = 0x40000, alpha: float = 1 / 16):
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size)
+        self.alpha = alpha
+        self.size: int = min_size
+        self.average: float = 0.
+
+    def observe(self, n: int) -> int:
+        """Account for n bytes received in one poll, returns the size to use from now on"""
+        self.average += self.alpha * (n - self.average)
+        if 2 * n >= self.size:
+            self.size = min(2 * self.size, self.max_size)
+        elif 8 * self.average < self.size and 4 * n < self.size:
+            self.size = max(self.size // 2, self.min_size)
+        return self.size
+
+
+class IngestSelector:
+    """Readiness loop of a tcp_process worker, driven by the OS instead of select() + sleep()
+
+    Client sockets are watched by selectors.DefaultSelector (epoll on Linux, so no 1024 fd limit). poll() only
+    returns when a socket is readable, a new client is handed over on the wakeup connection, or the timeout
+    expires; then every readable socket is drained with non-blocking recv_into() into the buffer of its
+    receiver until it would block or the buffer is full. Whatever is left is read on the next poll, once the
+    receiver has consumed its buffer.
+
+    A receiver is anything with writable() -> memoryview and commit(n), e.g. RecvBuffer, FrameStreamDecoder or
+    IMUConnection.
+
+    Listening sockets added with add_listener() are accepted from in the same loop, until accept() would block;
+    the new connections are returned with the handoffs as (socket, (address, port)) pairs.
+
+    Args:
+        wakeup (Connection): read end of the pipe new clients are sent on, optional
+
+    Example:
+        >>> ingest = IngestSelector(pipe_r)
+        >>> ingest.register(sock, sock.fileno(), RecvBuffer())
+        >>> handoffs, received, closed = ingest.poll(timeout=0.5)
+        >>> for key, n_bytes in received: ...
+    """
+
+    def __init__(self, wakeup: Optional[Connection] = None):
+        self.wakeup = wakeup
+        self.selector = selectors.DefaultSelector()
+        self.sockets: Dict[Any, socket.socket] = {}
+        self.listeners: List[socket.socket] = []
+        if wakeup is not None:
+            self.selector.register(wakeup.fileno(), selectors.EVENT_READ, None)
+
+    def __len__(self):
+        return len(self.sockets)
+
+    def add_listener(self, server_socket: socket.socket):
+        """Accept connections of a listening socket in poll(), the socket is closed with the selector"""
+        server_socket.setblocking(False)
+        self.selector.register(server_socket, selectors.EVENT_READ, None)
+        self.listeners.append(server_socket)
+
+    def register(self, sock: socket.socket, key: Any, receiver: Any):
+        """Watch sock, its data is received into receiver and reported under key"""
+        # Sockets received from another process come back in blocking mode
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ, (key, receiver))
+        self.sockets[key] = sock
+
+    def unregister(self, key: Any):
+        """Stop watching the socket of key, must be called before the socket is closed"""
+        sock = self.sockets.pop(key, None)
+        if sock is not None:
+            self.selector.unregister(sock)
+
+    @staticmethod
+    def _drain(sock: socket.socket, receiver: Any) -> Tuple[int, Optional[Exception], bool]:
+        n_bytes = 0
+        while True:
+            buf = receiver.writable()
+            if len(buf) == 0:
+                return n_bytes, None, False
+            try:
+                n = sock.recv_into(buf)
+            except (BlockingIOError, InterruptedError):
+                return n_bytes, None, False
+            except OSError as e:
+                return n_bytes, e, True
+            if n == 0:
+                return n_bytes, None, True
+            receiver.commit(n)
+            n_bytes += n
+            if n == len(buf):
+                # Full, the level-triggered selector reports the socket again on the next poll
+                return n_bytes, None, False
+
+    def poll(self, timeout: Optional[float] = None) -> Tuple[List[Any], List[Tuple[Any, int]], List[Tuple[Any, Optional[Exception]]]]:
+        """Wait for readiness and drain what is ready
+
+        Returns:
+            Tuple[List[Any], List[Tuple[Any, int]], List[Tuple[Any, Optional[Exception]]]]:
+                objects received on the wakeup connection and accepted connections, (key, number of bytes) of
+                the sockets that delivered data into their receiver and (key, error) of the sockets that were
+                closed by the peer (error is None) or failed. Closed sockets are unregistered already, the data
+                they sent before closing is still reported.
+        """
+        handoffs, received, closed = [], [], []
+        for selector_key, _ in self.selector.select(timeout):
+            if selector_key.fileobj in self.listeners:
+                handoffs.extend(tcp_accept_all(selector_key.fileobj))
+                continue
+            if selector_key.data is None:
+                try:
+                    while self.wakeup.poll():
+                        handoffs.append(self.wakeup.recv())
+                except EOFError:
+                    # The listener is gone, no more handoffs
+                    self.selector.unregister(selector_key.fileobj)
+                continue
+
+            key, receiver = selector_key.data
+            n_bytes, error, eof = self._drain(selector_key.fileobj, receiver)
+            if n_bytes > 0:
+                received.append((key, n_bytes))
+            if eof:
+                self.unregister(key)
+                closed.append((key, error))
+        return handoffs, received, closed
+
+    def close(self):
+        """Close the selector and the listening sockets, client sockets are left to their owner"""
+        self.selector.close()
+        for server_socket in self.listeners:
+            server_socket.close()
+        self.sockets = {}
+        self.listeners = []
@@ -0,0 +1,45 @@
+import time
+from multiprocessing.connection import Client, Connection
+from typing import Dict, Any, Optional, Tuple, Iterator
+
+
+class LiveSubscriber:
+    """Client of the live aligned stream published by live_align_task
+
+    Each message holds a batch of aligned samples laid out like align_measurement's result, see
+    LiveAligner.poll. On receipt the end-to-end latency of every sample, from the gateway receiving the
+    completing frame to this process receiving the batch, is added as 'latency_us'.
+
+    Example:
+        >>> with LiveSubscriber(('127.0.0.1', 18890)) as sub:
+        ...     for msg in sub:
+        ...         print(msg['tsf_timestamp'][-1], msg['devices'].keys(), msg['latency_us'].max())
+    """
+
+    def __init__(self, address: Tuple[str, int] = ('127.0.0.1', 18890), authkey: Optional[bytes] = None):
+        self.address = address
+        self.conn: Connection = Client(address, authkey=authkey)
+
+    def recv(self, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """Next batch, None on timeout"""
+        if timeout is not None and not self.conn.poll(timeout):
+            return None
+        msg = self.conn.recv()
+        msg['latency_us'] = time.time_ns() // 1000 - msg['arrival_us']
+        return msg
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        while True:
+            try:
+                yield self.recv()
+            except EOFError:
+                return
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,126 +1,148 @@
 import logging
-import multiprocessing as mp
-import struct
+import os
 import time
-from io import BytesIO
-from typing import Dict, List, Tuple, Optional, BinaryIO, Union
+from typing import Dict, List, Optional, BinaryIO, Union
 import numpy as np
 
+from .IMUParser import IMUParser
+from .clock import ClockModel
+from .index import SeekIndex
+from .segment import SegmentedFile
+from .sequence import SequenceTracker
+from .state import StateTable
+from .stream import FrameStreamDecoder
+from .writer import CoalescingWriter, CoalescedFile
 
-class IMURender:
-    ch_imu_data_t_fmt = "I3f3f3f3f4ffI"
-    imu_packet_length = struct.calcsize(ch_imu_data_t_fmt)
-    dgram_meta_t_fmt = "=qqIi12s"
-    meta_packet_length = struct.calcsize(dgram_meta_t_fmt)
-    imu_addr: bytes = b'\xe5'
-    addr_length = 1
-    packet_length = addr_length + \
-                    struct.calcsize(ch_imu_data_t_fmt) + struct.calcsize(dgram_meta_t_fmt)
 
-    buffer: BytesIO = BytesIO()
+class IMURender:
+    decoder: Optional[FrameStreamDecoder] = None
+    index: Optional[SeekIndex] = None
+    file_offset: int = 0
 
     filename: Optional[str] = None
-    file_handle: Optional[BinaryIO] = None
-    out_queue: Optional[mp.Queue] = None
+    file_handle: Optional[Union[BinaryIO, CoalescedFile, SegmentedFile]] = None
+    state_table: Optional[StateTable] = None
     update_interval_s: Optional[float] = None
     last_update_time: Optional[float] = None
+    state_pending: bool = False
 
-    state: Optional[Dict[str, Union[float, str, int]]] = None
+    last_frame: Optional[np.ndarray] = None
     state_is_valid: bool = False
+    clocks: Optional[Dict[str, ClockModel]] = None
+    sequences: Optional[Dict[str, SequenceTracker]] = None
 
     def __init__(self,
                  filename: str = None,
                  update_interval_s: float = 1e-1,
-                 out_queue: mp.Queue = None):
+                 state_table: StateTable = None,
+                 writer: CoalescingWriter = None,
+                 index_stride: int = 0,
+                 segment_max_bytes: int = 0,
+                 segment_max_duration_s: float = 0.,
+                 buffer_size: int = 0x4000):
         self.filename = filename
+        self.index_stride = index_stride
         if self.filename is not None:
-            self.file_handle = open(self.filename, "ab")
-
-        self.out_queue = out_queue
+            if segment_max_bytes > 0 or segment_max_duration_s > 0:
+                self.file_handle = SegmentedFile(os.path.dirname(self.filename),
+                                                 os.path.splitext(os.path.basename(self.filename))[0],
+                                                 writer=writer,
+                                                 max_bytes=segment_max_bytes,
+                                                 max_duration_s=segment_max_duration_s,
+                                                 on_rotate=self._on_rotate)
+            else:
+                # Offsets of the seek index are relative to the start of the file. A previous connection on the same
+                # file may still have bytes pending in the writer, they count as well
+                if writer is not None:
+                    self.file_handle = writer.open(self.filename)
+                    self.file_offset = writer.size(self.filename)
+                else:
+                    self.file_offset = os.path.getsize(self.filename) if os.path.exists(self.filename) else 0
+                    self.file_handle = open(self.filename, "ab")
+            if index_stride > 0:
+                self.index = SeekIndex(stride=index_stride)
+
+        self.decoder = FrameStreamDecoder(buffer_size)
+        self.n_committed = 0
+        self.clocks = {}
+        self.sequences = {}
+        self.state_table = state_table
         self.update_interval_s = update_interval_s
-        self.last_update_time = time.time()
+        self.last_update_time = 0.  # the first state is published at once
 
     @staticmethod
-    def verify_packet(buf, chksum: int) -> bool:
-        arr = np.frombuffer(buf, dtype=np.uint8)
-        arr_chksum = np.bitwise_xor.reduce(arr)
-        return arr_chksum == chksum
-
-    def _parse_packet(self, pkt: bytes) -> Dict[str, Union[float, str, int]]:
-        imu_struct = struct.unpack(self.ch_imu_data_t_fmt,
-                                   pkt[self.addr_length:self.addr_length + self.imu_packet_length])
-        meta_struct = struct.unpack(
-            self.dgram_meta_t_fmt, pkt[self.addr_length + self.imu_packet_length:])
-
-        imu_dict: dict = {
-            "accel_x": imu_struct[1], "accel_y": imu_struct[2], "accel_z": imu_struct[3],
-            "gyro_x": imu_struct[4], "gyro_y": imu_struct[5], "gyro_z": imu_struct[6],
-            "roll": imu_struct[10], "pitch": imu_struct[11], "yaw": imu_struct[12],
-            "quat_w": imu_struct[13], "quat_x": imu_struct[14], "quat_y": imu_struct[15],
-            "quat_z": imu_struct[16],
-            "temp": 0.0,
-            "mag_x": imu_struct[7], "mag_y": imu_struct[8], "mag_z": imu_struct[9],
-            "sys_ticks": imu_struct[18]
-        }
-
-        meta_dict = {
-            'timestamp': meta_struct[0],
-            'tsf_timestamp': meta_struct[1],
-            'seq': meta_struct[2],
-            'uart_buffer_len': meta_struct[3],
-            'id': ''.join([chr(meta_struct[4][idx]) for idx in range(len(meta_struct[4]))]),
-        }
-        return {**imu_dict, **meta_dict}
-
-    def _try_sync(self, data: bytes) -> Tuple[bool, List[Dict[str, Union[float, str, int]]]]:
-
-        self.buffer.write(data)
-        self.buffer.seek(0)
-
-        while (addr := self.buffer.read(1)) != self.imu_addr:
-            if addr == b'':
-                return False, []
-        self.buffer.seek(self.buffer.tell() - 1)
-
-        _content = self.buffer.read(self.packet_length)
-        _chksum = self.buffer.read(1)
-        if len(_content) < self.packet_length or len(_chksum) < 1:
-            self.buffer.write(_content)
-            self.buffer.write(_chksum)
-            return False, []
-
-        data_valid = self.verify_packet(_content, int(_chksum[0]))
-
-        if data_valid:
-            self.buffer.seek(self.buffer.tell() - self.packet_length - 1)
-            res = []
-            while True:
-                pkt = self.buffer.read(self.packet_length)
-                checksum = self.buffer.read(1)
-                if len(pkt) < self.packet_length or checksum == b'':
-                    self.buffer = BytesIO(pkt)
-                    self.buffer.read()  # move pointer to end using read
-                    break
-                res.append(self._parse_packet(pkt))
-            return True, res
-        else:
-            return False, []
+    def _parse_frames(frames: np.ndarray) -> List[Dict[str, Union[float, str, int]]]:
+        return IMUParser.to_records(IMUParser.to_columns(frames))
+
+    @property
+    def state(self) -> Optional[Dict[str, Union[float, str, int]]]:
+        """Latest decoded frame as a dict with the clock fit and link counters of its device, built on access only"""
+        if self.last_frame is None:
+            return None
+        res = self._parse_frames(self.last_frame)[0]
+        clock = self.clocks.get(res['id'])
+        if clock is not None:
+            res['clock_offset_us'] = clock.offset_us
+            res['clock_drift_ppm'] = clock.drift_ppm
+            res['clock_residual_std_us'] = clock.residual_std_us
+        res.update(self.link_stats(res['id']))
+        return res
+
+    def link_stats(self, device_id: str) -> Dict[str, Union[float, int]]:
+        """Sequence counters of a device, with the decoder counters of this connection"""
+        res = self.sequences[device_id].to_dict() if device_id in self.sequences.keys() else {}
+        res['n_checksum_failures'] = self.decoder.n_checksum_failures
+        res['n_resync'] = self.decoder.n_resync
+        res['n_skipped_bytes'] = self.decoder.n_skipped_bytes
+        return res
 
-    def update(self, data: bytes):
-        # If not synced, try to sync
-        success, res = self._try_sync(data)
-        if success:
+    def _update_devices(self, frames: np.ndarray):
+        # A connection normally carries a single device
+        ids = frames['id']
+        groups = [(ids[-1], frames)] if np.all(ids == ids[-1]) else [(device_id, frames[ids == device_id]) for device_id in np.unique(ids)]
+        for device_id, device_frames in groups:
+            device_id = device_id.decode('latin-1')
+            if device_id not in self.clocks.keys():
+                self.clocks[device_id] = ClockModel(device_id)
+                self.sequences[device_id] = SequenceTracker()
+            self.clocks[device_id].update(device_frames['tsf_timestamp'], device_frames['timestamp'])
+            self.sequences[device_id].update(device_frames['seq'])
+
+    def writable(self) -> memoryview:
+        """Free space of the decoder buffer, receive into it then commit()"""
+        return self.decoder.writable()
+
+    def commit(self, n: int):
+        """Mark n bytes written into writable() as received, they are processed by the next update()"""
+        self.decoder.commit(n)
+        self.n_committed += n
+
+    def update(self, data: bytes = None) -> np.ndarray:
+        """Decode a received chunk and flush it to disk
+
+        Args:
+            data (bytes): received chunk, if None the bytes committed since the last call are used
+
+        Returns:
+            np.ndarray: frames completed by this chunk, structured array of IMUParser.FRAME_DTYPE
+        """
+        if data is None:
+            # Received in place, nothing is copied before decoding
+            data = self.decoder.committed(self.n_committed)
+            self.n_committed = 0
+            frames = self.decoder.decode()
+        else:
+            frames = self.decoder.feed(data)
+        if len(frames) > 0:
             self.state_is_valid = True
-            self.state = res[-1]
-            # Communicate
-            if self.out_queue is not None and not self.out_queue.full():
-                try:
-                    time_elapsed = time.time() - self.last_update_time
-                    if time_elapsed > self.update_interval_s:
-                        self.out_queue.put(self.state, timeout=1)
-                        self.last_update_time = time.time()
-                except TimeoutError as _:  # ignore timeout error
-                    pass
+            self.last_frame = frames[-1:]
+            self._update_devices(frames)
+            if self.index is not None:
+                offset = self.file_offset + self.decoder.last_frame_end - self.decoder.FRAME_SZ
+                if offset >= 0:  # a frame straddling two segments has no offset in the current one
+                    self.index.add_checkpoint(offset, frames[-1], len(frames))
+            self.state_pending = True
+            self.publish_state()
         else:
             self.state_is_valid = False
 
@@ -128,14 +150,46 @@ class IMURender:
         if self.file_handle is not None:
             self.file_handle.write(data)
 
-        return res
-
-    def submit_buffer(self, data: bytes):
-        _, res = self._try_sync(data)
-        return res
+        return frames
+
+    def publish_state(self, force: bool = False):
+        """Write the latest state to the state table, at most every update_interval_s unless forced
+
+        A state held back by the throttle stays pending until a later call, close() publishes it at the latest.
+        """
+        if self.state_table is None or not self.state_pending:
+            return
+        now = time.time()
+        if force or now - self.last_update_time > self.update_interval_s:
+            self.state_table.write(self.state)
+            self.last_update_time = now
+            self.state_pending = False
+
+    def submit_buffer(self, data: bytes) -> List[Dict[str, Union[float, str, int]]]:
+        return self._parse_frames(self.decoder.feed(data))
+
+    @property
+    def segment_filename(self) -> Optional[str]:
+        """File that currently receives the data"""
+        return self.file_handle.path if isinstance(self.file_handle, SegmentedFile) else self.filename
+
+    def _on_rotate(self, closed_path: str, closed_bytes: int):
+        # Each segment gets its own seek index with offsets relative to the segment
+        if self.index is not None:
+            if len(self.index) > 0:
+                self.index.save(closed_path)
+            self.index = SeekIndex(stride=self.index_stride)
+        self.file_offset -= closed_bytes
 
     def close(self):
-        self.file_handle.close()
+        self.publish_state(force=True)
+        filename = self.segment_filename
+        if self.file_handle is not None:
+            self.file_handle.close()
+        if self.index is not None and len(self.index) > 0:
+            self.index.save(filename)
+        if self.filename is not None and len(self.clocks) > 0:
+            ClockModel.save_all(self.clocks.values(), self.filename)
 
 
 # States:
@@ -1,44 +1,84 @@
 import dataclasses
 import logging
-import multiprocessing as mp
 import os
 import socket
-from typing import Dict, BinaryIO, Tuple, Optional
+from typing import Dict, BinaryIO, Tuple, Optional, Union
 
+import numpy as np
+
+from .IMUParser import IMUParser
+from .framelog import FrameLog
+from .ingest import RecvBuffer, AdaptiveBufferSize
 from .render import IMURender
+from .state import StateTable
+from .segment import SegmentedFile
 from .tcp import tcp_send_bytes, IMUControlMessage
+from .writer import CoalescingWriter, CoalescedFile
 
 
 @dataclasses.dataclass()
 class IMUConnection:
-    socket: socket.socket
+    socket: Optional[socket.socket]
     addr: str
     port: int
     render_packet: bool = False
     proc_id: int = None
     update_interval_s: float = 1e-1
+    recv_size: int = 0x400
+    recv_max_size: int = 0x40000
 
     tcp_fd: int = None
     active: bool = False
 
     render: IMURender = None
-    buffer: BinaryIO = None
-    out_queue: mp.Queue = None
+    buffer: Union[BinaryIO, CoalescedFile, SegmentedFile] = None
+    state_table: StateTable = None
+    frame_log: FrameLog = None
+    recv_buffer: RecvBuffer = None
+    recv_sizer: AdaptiveBufferSize = None
+    n_bytes: int = 0  # received so far
+    n_bytes_reported: int = 0  # n_bytes at the last load report of the worker
+    replay_tail: bytes = b''  # last bytes stored without decoding, see detach()
 
     imu_port: Optional[int] = None
     device_id: Optional[str] = None
 
     def __post_init__(self):
-        self.tcp_fd = self.socket.fileno()
+        # Copies sent to the portal only describe the client and carry no socket
+        self.tcp_fd = self.socket.fileno() if self.socket is not None else None
         self.active = False
 
     def set_backend(self,
                     filename: str,
-                    out_queue: mp.Queue = None):
-        if self.render_packet:
-            self.render = IMURender(filename, out_queue=out_queue, update_interval_s=self.update_interval_s)
+                    state_table: StateTable = None,
+                    frame_log: FrameLog = None,
+                    writer: CoalescingWriter = None,
+                    index_stride: int = 0,
+                    segment_max_bytes: int = 0,
+                    segment_max_duration_s: float = 0.):
+        # Decoded frames can only be logged if packets are rendered
+        self.frame_log = frame_log
+        self.recv_sizer = AdaptiveBufferSize(self.recv_size, self.recv_max_size)
+        if self.render_packet or self.frame_log is not None:
+            self.render = IMURender(filename,
+                                    state_table=state_table,
+                                    update_interval_s=self.update_interval_s,
+                                    writer=writer,
+                                    index_stride=index_stride,
+                                    segment_max_bytes=segment_max_bytes,
+                                    segment_max_duration_s=segment_max_duration_s,
+                                    buffer_size=self.recv_size)
+        elif segment_max_bytes > 0 or segment_max_duration_s > 0:
+            # Roll over to {stem}.{k:04d}.dat segments listed in {stem}.segments.json
+            self.buffer = SegmentedFile(os.path.dirname(filename),
+                                        os.path.splitext(os.path.basename(filename))[0],
+                                        writer=writer,
+                                        max_bytes=segment_max_bytes,
+                                        max_duration_s=segment_max_duration_s)
         else:
-            self.buffer = open(filename, 'ab')
+            self.buffer = writer.open(filename) if writer is not None else open(filename, 'ab')
+        if self.render is None:
+            self.recv_buffer = RecvBuffer(self.recv_size)
 
     def close(self):
         if not getattr(self.socket, '_closed'):
@@ -49,15 +89,80 @@ class IMUConnection:
 
         if self.buffer is not None:
             self.buffer.close()
+        if self.render is not None:
+            self.render.close()
 
-    def update(self, data: bytes = None):
-        if data is not None:
-            if self.render is not None:
-                self.render.update(data)
-            elif self.buffer is not None:
-                self.buffer.write(data)
-            else:
-                raise ValueError("No buffer or render object")
+    def detach(self) -> Tuple['IMUConnection', bytes]:
+        """Close the backend of this worker but keep the connection, so that another worker takes it over
+
+        The socket is left open, the caller closes its own copy once it has been sent. The bytes to replay are
+        the received ones that do not complete a frame yet; the next owner feeds them first, so the frame cut by
+        the migration is stored and decoded once, in its file.
+
+        Returns:
+            Tuple[IMUConnection, bytes]: copy of the connection without backend, bytes to replay
+        """
+        if self.render is not None:
+            replay = self.render.decoder.pending()
+            self.render.close()
+        else:
+            # Frame boundaries are unknown, the tail of an already stored frame is skipped by the parser
+            replay = self.replay_tail
+            self.buffer.close()
+        connection = IMUConnection(self.socket,
+                                   self.addr,
+                                   self.port,
+                                   render_packet=self.render_packet,
+                                   proc_id=self.proc_id,
+                                   update_interval_s=self.update_interval_s,
+                                   recv_size=self.recv_size,
+                                   recv_max_size=self.recv_max_size,
+                                   imu_port=self.imu_port,
+                                   device_id=self.device_id)
+        return connection, replay
+
+    def writable(self) -> memoryview:
+        """Buffer to receive into with socket.recv_into, the decoder's own buffer if packets are rendered"""
+        return self.render.writable() if self.render is not None else self.recv_buffer.writable()
+
+    def commit(self, n: int):
+        """Mark n bytes written into writable() as received"""
+        if self.render is not None:
+            self.render.commit(n)
+        else:
+            self.recv_buffer.commit(n)
+
+    def update(self, data: bytes = None) -> Optional[np.ndarray]:
+        """Store a received chunk
+
+        Args:
+            data (bytes): received chunk, if None the bytes committed since the last call are stored and the
+                receive buffer is resized to the throughput of the connection
+
+        Returns:
+            Optional[np.ndarray]: frames decoded from the chunk if packets are rendered, else None
+        """
+        if self.render is not None:
+            n = self.render.n_committed
+            self.n_bytes += n if data is None else len(data)
+            frames = self.render.update(data)
+            if self.frame_log is not None:
+                self.frame_log.append(frames)
+            if data is None:
+                self.render.decoder.resize(self.recv_sizer.observe(n))
+            return frames
+        elif self.buffer is not None:
+            if data is None:
+                data = self.recv_buffer.take()
+                self.recv_buffer.resize(self.recv_sizer.observe(len(data)))
+            self.buffer.write(data)
+            self.n_bytes += len(data)
+            # Enough to complete a frame cut by a migration, see detach()
+            tail_sz = IMUParser.FRAME_SZ - 1
+            self.replay_tail = (self.replay_tail + bytes(memoryview(data)[-tail_sz:]))[-tail_sz:]
+        else:
+            raise ValueError("No buffer or render object")
+        return None
 
     def query_device_id(self) -> Optional[str]:
         if self.device_id is None:
@@ -94,10 +199,24 @@ class IMUConnection:
 
 
 class ClientRepo:
-    def __init__(self, base_dir, proc_id, imu_state_queue: mp.Queue = None):
+    def __init__(self,
+                 base_dir,
+                 proc_id,
+                 imu_state_table: StateTable = None,
+                 decode_at_ingest: bool = False,
+                 writer: CoalescingWriter = None,
+                 index_stride: int = 0,
+                 segment_max_bytes: int = 0,
+                 segment_max_duration_s: float = 0.):
         self.base_dir = base_dir
         self.proc_id = proc_id
-        self.imu_state_queue = imu_state_queue
+        self.imu_state_table = imu_state_table
+        self.decode_at_ingest = decode_at_ingest
+        self.writer = writer
+        self.index_stride = index_stride
+        self.segment_max_bytes = segment_max_bytes
+        self.segment_max_duration_s = segment_max_duration_s
+        self.frame_log: Optional[FrameLog] = FrameLog(base_dir, writer=writer) if decode_at_ingest else None
 
         self.index_by_fd: Dict[int, IMUConnection] = {}
 
@@ -108,7 +227,13 @@ class ClientRepo:
         # Registration of New client
         fd = client.tcp_fd
         if client.tcp_fd not in self.index_by_fd.keys():
-            client.set_backend(os.path.join(self.base_dir, f'process_{str(self.proc_id)}_{fd}.dat'), out_queue=self.imu_state_queue)
+            client.set_backend(os.path.join(self.base_dir, f'process_{str(self.proc_id)}_{fd}.dat'),
+                               state_table=self.imu_state_table,
+                               frame_log=self.frame_log,
+                               writer=self.writer,
+                               index_stride=self.index_stride,
+                               segment_max_bytes=self.segment_max_bytes,
+                               segment_max_duration_s=self.segment_max_duration_s)
             self.index_by_fd[fd] = client
         else:
             logging.warning(f"the fd: {fd} is already registered with client {self.index_by_fd[fd]}")
@@ -123,10 +248,18 @@ class ClientRepo:
         self.index_by_fd[fd].close()
         del self.index_by_fd[fd]
 
+    def detach(self, fd) -> Tuple[IMUConnection, bytes]:
+        """Remove a client without closing its socket, see IMUConnection.detach"""
+        client = self.index_by_fd.pop(fd)
+        return client.detach()
+
     def close(self):
         for _, client in self.index_by_fd.items():
             client.close()
-        self.__init__(self.base_dir, self.proc_id)
+        if self.frame_log is not None:
+            self.frame_log.close()
+        self.__init__(self.base_dir, self.proc_id, self.imu_state_table, self.decode_at_ingest, self.writer, self.index_stride,
+                      self.segment_max_bytes, self.segment_max_duration_s)
 
     def mark_as_online(self, fd):
         self.index_by_fd[fd].active = True
@@ -0,0 +1,138 @@
+import json
+import os
+import time
+from typing import Dict, List, Optional, Any, Union, BinaryIO, Callable
+
+from .writer import CoalescingWriter, CoalescedFile
+
+
+class SegmentManifest:
+    """Ordered list of the segment files of one capture stream
+
+    The manifest is rewritten atomically whenever a segment is opened or closed. A segment is complete once it
+    is marked closed and the file on disk has reached the recorded size, the latter matters when writes go
+    through a CoalescingWriter and are still pending.
+
+    Layout of {stem}.segments.json::
+
+        {"stem": "process_0_10", "segments": [{"name": "process_0_10.0000.dat", "bytes": 1024,
+                                               "t_open": 1690000000.0, "t_close": 1690000060.0, "closed": true}]}
+    """
+    SUFFIX: str = '.segments.json'
+
+    def __init__(self, base_dir: str, stem: str):
+        self.base_dir = base_dir
+        self.stem = stem
+        self.path = os.path.join(base_dir, stem + self.SUFFIX)
+        self.segments: List[Dict[str, Any]] = []
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.segments = json.load(f)['segments']
+
+    @classmethod
+    def list(cls, base_dir: str) -> List['SegmentManifest']:
+        """All manifests of a measurement directory"""
+        return [
+            cls(base_dir, name[:-len(cls.SUFFIX)]) for name in sorted(os.listdir(base_dir)) if name.endswith(cls.SUFFIX)
+        ]
+
+    def segment_path(self, k: int) -> str:
+        return os.path.join(self.base_dir, f'{self.stem}.{k:04d}.dat')
+
+    @property
+    def paths(self) -> List[str]:
+        """Segment files in capture order"""
+        return [os.path.join(self.base_dir, segment['name']) for segment in self.segments]
+
+    def complete_paths(self) -> List[str]:
+        """Segment files that are closed and fully written, safe to convert while the capture is running"""
+        res = []
+        for path, segment in zip(self.paths, self.segments):
+            if segment['closed'] and os.path.exists(path) and os.path.getsize(path) >= segment['bytes']:
+                res.append(path)
+        return res
+
+    def open_segment(self) -> str:
+        path = self.segment_path(len(self.segments))
+        self.segments.append({'name': os.path.basename(path), 'bytes': 0, 't_open': time.time(), 't_close': None, 'closed': False})
+        self.save()
+        return path
+
+    def close_segment(self, n_bytes: int):
+        self.segments[-1].update({'bytes': n_bytes, 't_close': time.time(), 'closed': True})
+        self.save()
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'stem': self.stem, 'segments': self.segments}, f)
+        os.replace(tmp_path, self.path)
+
+
+class SegmentedFile:
+    """Append-only capture file that rolls over to a new segment after max_bytes or max_duration_s
+
+    Segments are named {stem}.{k:04d}.dat and listed in a SegmentManifest. Rotation happens between writes, so a
+    frame may straddle two segments; convert_measurement stitches those back together. A limit of 0 disables
+    the corresponding rule.
+    """
+
+    def __init__(self,
+                 base_dir: str,
+                 stem: str,
+                 writer: CoalescingWriter = None,
+                 max_bytes: int = 0,
+                 max_duration_s: float = 0.,
+                 on_rotate: Callable[[str, int], None] = None):
+        self.writer = writer
+        self.max_bytes = max_bytes
+        self.max_duration_s = max_duration_s
+        self.on_rotate = on_rotate
+        self.manifest = SegmentManifest(base_dir, stem)
+        self.closed = False
+
+        self.path: Optional[str] = None
+        self.handle: Optional[Union[BinaryIO, CoalescedFile]] = None
+        self.n_bytes: int = 0
+        self.t_open: float = 0.
+        self._open()
+
+    def _open(self):
+        self.path = self.manifest.open_segment()
+        self.handle = self.writer.open(self.path) if self.writer is not None else open(self.path, 'ab')
+        self.n_bytes = 0
+        self.t_open = time.time()
+
+    def _close(self):
+        self.handle.close()
+        self.manifest.close_segment(self.n_bytes)
+
+    def due(self) -> bool:
+        if self.n_bytes <= 0:
+            return False
+        if 0 < self.max_bytes <= self.n_bytes:
+            return True
+        return 0 < self.max_duration_s <= time.time() - self.t_open
+
+    def rotate(self):
+        """Close the current segment and start the next one"""
+        closed_path, closed_bytes = self.path, self.n_bytes
+        self._close()
+        self._open()
+        if self.on_rotate is not None:
+            self.on_rotate(closed_path, closed_bytes)
+
+    def write(self, data: Union[bytes, bytearray, memoryview]) -> int:
+        n = self.handle.write(data)
+        self.n_bytes += n
+        if self.due():
+            self.rotate()
+        return n
+
+    def flush(self):
+        self.handle.flush()
+
+    def close(self):
+        if not self.closed:
+            self._close()
+            self.closed = True
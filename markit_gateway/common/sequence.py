@@ -0,0 +1,60 @@
+from typing import Dict, Any, Optional
+
+import numpy as np
+
+
+class SequenceTracker:
+    """Packet loss counters of one device, driven by the seq field of its frames
+
+    A frame is new when its seq is above every seq seen before, the numbers skipped in between are counted as
+    lost. Frames at or below that maximum are counted as duplicates (or late reordered frames). A seq that drops
+    by more than reset_window is taken as a device restart and tracking starts over.
+
+    Args:
+        reset_window (int): largest backwards step still treated as a duplicate
+    """
+
+    def __init__(self, reset_window: int = 0x1000):
+        self.reset_window = reset_window
+        self.last_seq: Optional[int] = None
+        self.n_received: int = 0
+        self.n_lost: int = 0
+        self.n_duplicates: int = 0
+        self.n_resets: int = 0
+
+    def update(self, seq: np.ndarray):
+        """Count a batch of sequence numbers, in arrival order"""
+        seq = np.asarray(seq, dtype=np.int64).reshape(-1)
+        while len(seq) > 0:
+            if self.last_seq is None:
+                self.last_seq = int(seq[0]) - 1
+            prev_max = np.maximum.accumulate(np.concatenate([[self.last_seq], seq[:-1]]))
+            restart = np.flatnonzero(seq < prev_max - self.reset_window)
+            n = int(restart[0]) if len(restart) > 0 else len(seq)
+
+            new = seq[:n] > prev_max[:n]
+            self.n_received += n
+            self.n_lost += int((seq[:n][new] - prev_max[:n][new] - 1).sum())
+            self.n_duplicates += n - int(np.count_nonzero(new))
+            if n > 0:
+                self.last_seq = max(self.last_seq, int(seq[:n].max()))
+
+            if n < len(seq):
+                self.n_resets += 1
+                self.last_seq = None
+            seq = seq[n:]
+
+    @property
+    def loss_rate(self) -> float:
+        """Lost over expected frames"""
+        n_expected = self.n_received - self.n_duplicates + self.n_lost
+        return self.n_lost / n_expected if n_expected > 0 else 0.
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'n_received': self.n_received,
+            'n_lost': self.n_lost,
+            'n_duplicates': self.n_duplicates,
+            'n_resets': self.n_resets,
+            'loss_rate': self.loss_rate,
+        }
@@ -0,0 +1,161 @@
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from typing import Any, Dict, List, Optional, Union
+
+import numpy as np
+
+
+class StateTable:
+    """Latest state of every device in shared memory, written by the tcp workers and read by the portal and the UI
+
+    Each device owns a fixed slot, allocated under a lock the first time it is written and looked up locally
+    afterwards. A slot is guarded by a seqlock: the writer makes its version odd, overwrites the slot and makes the
+    version even again; a reader copies the slot and keeps the copy only if the version was even and unchanged
+    across the copy. Writers take the lock against each other but never wait for readers, and nothing is queued
+    or pickled.
+
+    The table is created by the process that owns it and inherited by the workers. The owner calls unlink() once
+    everyone is done with it.
+
+    Args:
+        n_slots (int): maximal number of devices
+        name (str): name of an existing table to attach to, a new table is created if None
+        lock (mp.Lock): lock guarding slot allocation, shared by all the processes using the table
+
+    Example:
+        >>> table = StateTable(256)
+        >>> table.write(render.state)  # in a tcp worker
+        >>> table.snapshot()  # in the portal
+        {'84f7033b3e78': {'accel_x': 1.0, ..., 'n_skipped_bytes': 0}}
+    """
+    FLOAT_FIELDS: List[str] = [
+        "accel_x", "accel_y", "accel_z",
+        "gyro_x", "gyro_y", "gyro_z",
+        "roll", "pitch", "yaw",
+        "quat_w", "quat_x", "quat_y", "quat_z",
+        "temp",
+        "mag_x", "mag_y", "mag_z",
+        "clock_offset_us", "clock_drift_ppm", "clock_residual_std_us",
+        "loss_rate",
+    ]
+    INT_FIELDS: List[str] = [
+        "sys_ticks", "timestamp", "tsf_timestamp", "seq", "uart_buffer_len",
+        "n_received", "n_lost", "n_duplicates", "n_resets",
+        "n_checksum_failures", "n_resync", "n_skipped_bytes",
+    ]
+    STATE_DTYPE: np.dtype = np.dtype(
+        [('id', 'S12')] + [(key, '<f8') for key in FLOAT_FIELDS] + [(key, '<i8') for key in INT_FIELDS],
+        align=True
+    )
+    MAX_READ_RETRIES: int = 100
+
+    def __init__(self, n_slots: int = 256, name: Optional[str] = None, lock: Optional[mp.Lock] = None):
+        self.n_slots = n_slots
+        self.lock = lock if lock is not None else mp.Lock()
+        size = n_slots * (8 + self.STATE_DTYPE.itemsize)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.shm.buf[:size] = bytes(size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.versions: np.ndarray = np.ndarray((n_slots,), dtype='<u8', buffer=self.shm.buf)
+        self.slots: np.ndarray = np.ndarray((n_slots,), dtype=self.STATE_DTYPE, buffer=self.shm.buf, offset=n_slots * 8)
+        self._slot_by_id: Dict[str, int] = {}
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def __getstate__(self):
+        # Attach to the same block when sent to a spawned process
+        return {'n_slots': self.n_slots, 'name': self.name, 'lock': self.lock}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.slots['id']))
+
+    def _slot(self, device_id: str) -> Optional[int]:
+        idx = self._slot_by_id.get(device_id)
+        if idx is not None:
+            return idx
+        key = device_id.encode('latin-1')
+        with self.lock:
+            # The device may have been written by another worker already, e.g. before a reconnection
+            ids = self.slots['id']
+            matches = np.flatnonzero(ids == key)
+            if len(matches) == 0:
+                matches = np.flatnonzero(ids == b'')
+                if len(matches) == 0:
+                    return None
+                self.slots['id'][matches[0]] = key
+            idx = int(matches[0])
+        self._slot_by_id[device_id] = idx
+        return idx
+
+    def write(self, state: Optional[Dict[str, Union[float, str, int]]]) -> bool:
+        """Overwrite the slot of state['id'] with state, missing fields are zeroed
+
+        Returns:
+            bool: False if the table is full and the device has no slot
+        """
+        if state is None:
+            return False
+        idx = self._slot(state['id'])
+        if idx is None:
+            return False
+        row = (state['id'].encode('latin-1'), *(state.get(key, 0) for key in self.FLOAT_FIELDS),
+               *(state.get(key, 0) for key in self.INT_FIELDS))
+        # Two workers may write the same slot while a device reconnects to another one, the seqlock only protects
+        # readers against a single writer. Writers are throttled by IMURender, so the lock is hardly contended
+        with self.lock:
+            version = int(self.versions[idx]) + 1  # odd while the slot is being written
+            self.versions[idx] = version
+            self.slots[idx] = row
+            self.versions[idx] = version + 1
+        return True
+
+    def _read_slot(self, idx: int) -> Optional[Dict[str, Any]]:
+        for _ in range(self.MAX_READ_RETRIES):
+            version = int(self.versions[idx])
+            if version & 1:
+                continue
+            row = self.slots[idx].copy()
+            if int(self.versions[idx]) == version:
+                if row['id'] == b'':
+                    return None
+                res = dict(zip(self.STATE_DTYPE.names, row.tolist()))
+                res['id'] = res['id'].decode('latin-1')
+                return res
+        return None
+
+    def read(self, device_id: str) -> Optional[Dict[str, Any]]:
+        """Consistent copy of the latest state of a device, None if it has not been written yet"""
+        matches = np.flatnonzero(self.slots['id'] == device_id.encode('latin-1'))
+        return self._read_slot(int(matches[0])) if len(matches) > 0 else None
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Consistent copy of the latest state of every device, slots being rewritten for too long are skipped"""
+        res = {}
+        for idx in np.flatnonzero(self.slots['id'] != b''):
+            state = self._read_slot(int(idx))
+            if state is not None:
+                res[state['id']] = state
+        return res
+
+    def clear(self):
+        """Forget every device, only while no worker writes the table"""
+        with self.lock:
+            self.slots[:] = np.zeros((self.n_slots,), dtype=self.STATE_DTYPE)
+        self._slot_by_id = {}
+
+    def close(self):
+        """Detach this process from the table"""
+        del self.versions, self.slots
+        self.shm.close()
+
+    def unlink(self):
+        """Detach and free the table, by its owner"""
+        self.close()
+        self.shm.unlink()
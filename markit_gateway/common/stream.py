@@ -0,0 +1,134 @@
+from typing import List
+
+import numpy as np
+
+from .IMUParser import IMUParser
+
+
+class FrameStreamDecoder:
+    """Incremental frame decoder for one live connection
+
+    Bytes are written into a preallocated bytearray and frames are decoded in place through a numpy view of
+    it. Only the tail of an incomplete frame survives a decode() call, so the buffer never grows. Sync state
+    is kept between chunks; when a frame fails its checksum the decoder falls back to IMUParser.scan.
+    """
+    FRAME_SZ: int = IMUParser.FRAME_SZ
+    FRAME_DTYPE: np.dtype = IMUParser.FRAME_DTYPE
+
+    def __init__(self, capacity: int = 0x4000):
+        self.capacity: int = max(capacity, 4 * self.FRAME_SZ)
+        self._buf: bytearray = bytearray(self.capacity)
+        self._view: memoryview = memoryview(self._buf)
+        self._arr: np.ndarray = np.frombuffer(self._buf, dtype=np.uint8)
+        self.head: int = 0
+        self.tail: int = 0
+
+        self.synced: bool = False
+        self.position: int = 0  # stream offset of head, i.e. bytes consumed so far
+        self.last_frame_end: int = 0  # stream offset right after the last decoded frame
+        self.n_frames: int = 0
+        self.n_skipped_bytes: int = 0
+        self.n_checksum_failures: int = 0
+        self.n_resync: int = 0
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def writable(self) -> memoryview:
+        """Free space after the pending bytes, suitable for socket.recv_into"""
+        if self.head == self.tail:
+            self.head = self.tail = 0
+        elif self.capacity - self.tail < self.FRAME_SZ:
+            # Compact: at most FRAME_SZ - 1 pending bytes are moved
+            pending = self.tail - self.head
+            self._view[:pending] = self._view[self.head:self.tail]
+            self.head, self.tail = 0, pending
+        return self._view[self.tail:]
+
+    def commit(self, n: int):
+        """Mark n bytes written into writable() as received"""
+        self.tail += n
+
+    def pending(self) -> bytes:
+        """Received bytes that are not part of a decoded frame yet, e.g. the beginning of an incomplete frame"""
+        return bytes(self._view[self.head:self.tail])
+
+    def committed(self, n: int) -> memoryview:
+        """The last n bytes received, valid until the next writable() call"""
+        return self._view[self.tail - n:self.tail]
+
+    def resize(self, capacity: int):
+        """Reallocate the buffer with another capacity, pending bytes are kept"""
+        capacity = max(capacity, 4 * self.FRAME_SZ, self.tail - self.head)
+        if capacity == self.capacity:
+            return
+        buf = bytearray(capacity)
+        pending = self.tail - self.head
+        buf[:pending] = self._view[self.head:self.tail]
+        self.capacity = capacity
+        self._buf = buf
+        self._view = memoryview(self._buf)
+        self._arr = np.frombuffer(self._buf, dtype=np.uint8)
+        self.head, self.tail = 0, pending
+
+    def feed(self, data: bytes) -> np.ndarray:
+        """Copy a received chunk into the buffer and decode every complete frame
+
+        Returns:
+            np.ndarray: structured array of FRAME_DTYPE
+        """
+        res: List[np.ndarray] = []
+        data = memoryview(data)
+        while len(data) > 0:
+            dst = self.writable()
+            n = min(len(dst), len(data))
+            dst[:n] = data[:n]
+            self.commit(n)
+            data = data[n:]
+            res.append(self.decode())
+        if len(res) == 1:
+            return res[0]
+        return np.concatenate(res) if len(res) > 0 else np.empty((0,), dtype=self.FRAME_DTYPE)
+
+    def decode(self) -> np.ndarray:
+        """Decode every complete frame between head and tail
+
+        Returns:
+            np.ndarray: structured array of FRAME_DTYPE, copied out of the buffer
+        """
+        res: List[np.ndarray] = []
+        while self.tail - self.head >= self.FRAME_SZ:
+            if self.synced:
+                n = (self.tail - self.head) // self.FRAME_SZ
+                raw = self._arr[self.head:self.head + n * self.FRAME_SZ].reshape(n, self.FRAME_SZ)
+                valid = IMUParser.verify_frames(raw)
+                n_valid = n if valid.all() else int(np.argmin(valid))
+                if n_valid > 0:
+                    res.append(raw[:n_valid].copy().view(self.FRAME_DTYPE).reshape(-1))
+                    self.head += n_valid * self.FRAME_SZ
+                    self.position += n_valid * self.FRAME_SZ
+                    self.last_frame_end = self.position
+                if n_valid < n:
+                    self.synced = False
+                    self.n_checksum_failures += 1
+            else:
+                scan = IMUParser.scan(self._view[self.head:self.tail])
+                if len(scan.offsets) > 0:
+                    skip = int(scan.offsets[0])
+                    self.synced = True
+                    if self.last_frame_end > 0:  # sync was lost, not acquired for the first time
+                        self.n_resync += 1
+                else:
+                    # Keep the bytes that may hold the beginning of a frame
+                    skip = self.tail - self.head - (self.FRAME_SZ - 1)
+                self.head += skip
+                self.position += skip
+                self.n_skipped_bytes += skip
+                if not self.synced:
+                    break
+
+        if len(res) == 0:
+            return np.empty((0,), dtype=self.FRAME_DTYPE)
+        frames = res[0] if len(res) == 1 else np.concatenate(res)
+        self.n_frames += len(frames)
+        return frames
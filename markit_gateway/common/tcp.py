@@ -2,7 +2,7 @@ import dataclasses
 import logging
 import socket
 from concurrent.futures import ThreadPoolExecutor
-from typing import Union, List, Dict, Any
+from typing import Union, List, Dict, Any, Tuple
 
 
 @dataclasses.dataclass()
@@ -71,3 +71,51 @@ def tcp_broadcast_command(addresses: List[str], port: int, command_string: str,
                     logging.debug(f"{ret.addr} return: {res_no_crlf}")
                 results.append({'addr': ret.addr, 'res': res_no_crlf})
     return results
+
+
+def tcp_listen_socket(addr: str, port: int, backlog: int = 1024, rcvbuf: int = 0, reuse_port: bool = False) -> socket.socket:
+    """Non-blocking listening socket
+
+    Args:
+        addr (str): address to bind
+        port (int): port to bind
+        backlog (int): length of the accept queue, capped by net.core.somaxconn
+        rcvbuf (int): SO_RCVBUF inherited by accepted sockets, 0 keeps the OS default
+        reuse_port (bool): set SO_REUSEPORT, so that several processes bind the same port and the kernel spreads
+            new connections among them
+
+    Returns:
+        socket.socket: listening socket
+    """
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if rcvbuf > 0:
+        # Set before listen() so that accepted sockets inherit it and the TCP window scale is negotiated for it
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    server_socket.bind((addr, port))
+    server_socket.listen(backlog)
+    server_socket.setblocking(False)
+    return server_socket
+
+
+def tcp_accept_all(server_socket: socket.socket) -> List[Tuple[socket.socket, Tuple[str, int]]]:
+    """Accept every pending connection of a non-blocking listening socket, until it would block
+
+    Returns:
+        List[Tuple[socket.socket, Tuple[str, int]]]: (client socket, (address, port)) as returned by accept()
+    """
+    res = []
+    while True:
+        try:
+            res.append(server_socket.accept())
+        except (BlockingIOError, InterruptedError):
+            return res
+        except ConnectionAbortedError:
+            # Reset by the peer while it was queued
+            continue
+        except OSError as e:
+            # e.g. out of file descriptors, what is left stays queued for the next round
+            logging.warning(f"accept failed: {e}")
+            return res
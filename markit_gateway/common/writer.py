@@ -0,0 +1,186 @@
+import logging
+import os
+import threading
+import time
+from typing import Dict, BinaryIO, Optional, Any, Union
+
+
+class CoalescedFile:
+    """File-like handle whose writes are batched by a CoalescingWriter"""
+
+    def __init__(self, writer: 'CoalescingWriter', path: str):
+        self.writer = writer
+        self.path = path
+        self.closed = False
+
+    def write(self, data: Union[bytes, bytearray, memoryview]) -> int:
+        return self.writer.write(self.path, data)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        if not self.closed:
+            self.writer.close(self.path)
+            self.closed = True
+
+
+class CoalescingWriter:
+    """Background writer that turns many small appends into large sequential writes
+
+    write() only appends to an in-memory buffer of the target file under a lock, the disk is touched by a
+    separate thread once flush_size bytes are pending or flush_interval_s has elapsed. The recv loop therefore
+    never waits on the disk, a stalled disk shows up as growing pending_bytes instead.
+
+    fsync policy:
+        - never: leave it to the OS
+        - flush: fsync every file after each batch
+        - close: fsync a file when it is closed
+    """
+    FSYNC_POLICIES = ('never', 'flush', 'close')
+
+    def __init__(self, flush_interval_s: float = 0.5, flush_size: int = 0x100000, fsync: str = 'never'):
+        if fsync not in self.FSYNC_POLICIES:
+            raise ValueError(f"fsync policy must be one of {self.FSYNC_POLICIES}, got {fsync}")
+        self.flush_interval_s = flush_interval_s
+        self.flush_size = flush_size
+        self.fsync = fsync
+
+        self._cond = threading.Condition()
+        self._pending: Dict[str, bytearray] = {}
+        self._closing: Dict[str, bool] = {}
+        self._handles: Dict[str, BinaryIO] = {}
+        self._sizes: Dict[str, int] = {}  # logical size of every file, written or not
+        self._flush_requested = False
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+
+        self.pending_bytes: int = 0
+        self.max_pending_bytes: int = 0
+        self.bytes_written: int = 0
+        self.n_flushes: int = 0
+        self.last_flush_s: float = 0.
+
+        self.logger = logging.getLogger("coalescing_writer")
+
+    def open(self, path: str) -> CoalescedFile:
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="coalescing_writer", daemon=True)
+                self._thread.start()
+            if path not in self._pending.keys():
+                self._pending[path] = bytearray()
+            self._track_size(path)
+        return CoalescedFile(self, path)
+
+    def _track_size(self, path: str):
+        if path not in self._sizes.keys():
+            self._sizes[path] = os.path.getsize(path) if os.path.exists(path) else 0
+
+    def size(self, path: str) -> int:
+        """Size of the file once everything written so far is on disk, including the bytes still pending"""
+        with self._cond:
+            self._track_size(path)
+            return self._sizes[path]
+
+    def write(self, path: str, data: Union[bytes, bytearray, memoryview]) -> int:
+        view = memoryview(data)
+        n = view.nbytes
+        with self._cond:
+            if path not in self._pending.keys():
+                self._pending[path] = bytearray()
+            self._track_size(path)
+            self._pending[path] += view
+            self._sizes[path] += n
+            self.pending_bytes += n
+            self.max_pending_bytes = max(self.max_pending_bytes, self.pending_bytes)
+            if self.pending_bytes >= self.flush_size:
+                self._cond.notify()
+        return n
+
+    def close(self, path: str):
+        with self._cond:
+            self._closing[path] = True
+            self._cond.notify()
+
+    def flush(self):
+        """Ask the background thread to write everything pending now"""
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify()
+
+    def stop(self):
+        """Write everything pending, close all files and join the background thread"""
+        with self._cond:
+            self._stopped = True
+            for path in self._pending.keys():
+                self._closing[path] = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                'pending_bytes': self.pending_bytes,
+                'max_pending_bytes': self.max_pending_bytes,
+                'bytes_written': self.bytes_written,
+                'n_flushes': self.n_flushes,
+                'n_files': len(self._pending),
+                'last_flush_s': self.last_flush_s,
+            }
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._stopped or self._flush_requested or len(self._closing) > 0 or self.pending_bytes >= self.flush_size,
+                    timeout=self.flush_interval_s
+                )
+                # Swap the buffers out, disk I/O happens without the lock
+                batch = {path: buf for path, buf in self._pending.items() if len(buf) > 0}
+                for path in batch.keys():
+                    self._pending[path] = bytearray()
+                closing = list(self._closing.keys())
+                for path in closing:
+                    self._pending.pop(path, None)
+                self._closing = {}
+                self._flush_requested = False
+                stopped = self._stopped
+
+            start = time.time()
+            n_written = 0
+            for path, buf in batch.items():
+                try:
+                    if path not in self._handles.keys():
+                        self._handles[path] = open(path, 'ab')
+                    self._handles[path].write(buf)
+                    self._handles[path].flush()
+                    if self.fsync == 'flush':
+                        os.fsync(self._handles[path].fileno())
+                    n_written += len(buf)
+                except OSError as e:
+                    self.logger.error(f"failed to write {len(buf)} bytes to {path}: {e}")
+            for path in closing:
+                handle = self._handles.pop(path, None)
+                if handle is not None:
+                    try:
+                        if self.fsync in ('flush', 'close'):
+                            os.fsync(handle.fileno())
+                    except OSError as e:
+                        self.logger.error(f"failed to fsync {path}: {e}")
+                    finally:
+                        handle.close()
+            with self._cond:
+                self.pending_bytes -= sum(len(buf) for buf in batch.values())
+                self.bytes_written += n_written
+                if len(batch) > 0:
+                    self.n_flushes += 1
+                    self.last_flush_s = time.time() - start
+
+            if stopped:
+                for handle in self._handles.values():
+                    handle.close()
+                self._handles = {}
+                return
@@ -17,6 +17,30 @@ class BrokerConfig:
     __DEFAULT_RENDER_PACKET__: bool = True
     __DEFAULT_UPDATE_INTERVAL_S__: float = 1e-1
     __DEFAULT_DEBUG__: bool = False
+    __DEFAULT_DECODE_AT_INGEST__: bool = False
+    __DEFAULT_WRITE_FLUSH_INTERVAL_S__: float = 0.5
+    __DEFAULT_WRITE_FLUSH_SIZE__: int = 0x100000
+    __DEFAULT_WRITE_FSYNC__: str = 'never'
+    __DEFAULT_INDEX_STRIDE__: int = 256
+    __DEFAULT_CACHE_MAX_BYTES__: int = 0x100000000
+    __DEFAULT_SEGMENT_MAX_BYTES__: int = 0
+    __DEFAULT_SEGMENT_MAX_DURATION_S__: float = 0.
+    __DEFAULT_LIVE_ENABLE__: bool = False
+    __DEFAULT_LIVE_PORT__: int = 18890
+    __DEFAULT_LIVE_RATE_HZ__: float = 100.
+    __DEFAULT_LIVE_MAX_DELAY_MS__: float = 50.
+    __DEFAULT_ALIGN_N_WORKERS__: int = 0
+    __DEFAULT_ALIGN_POOL__: str = 'process'
+    __DEFAULT_ALIGN_RATE_HZ__: float = 0.
+    __DEFAULT_TCP_BUFF_MAX_SZ__: int = 0x40000
+    __DEFAULT_TCP_RCVBUF__: int = 0
+    __DEFAULT_TCP_NODELAY__: bool = False
+    __DEFAULT_TCP_BACKLOG__: int = 1024
+    __DEFAULT_TCP_REUSEPORT__: bool = False
+    __DEFAULT_LOAD_REPORT_INTERVAL_S__: float = 1.
+    __DEFAULT_REBALANCE_THRESHOLD__: float = 0.5
+    __DEFAULT_REBALANCE_COOLDOWN_S__: float = 5.
+    __DEFAULT_STATE_TABLE_SIZE__: int = 256
 
     n_procs: int = __DEFAULT_N_PROCS__
     base_dir: str = __DEFAULT_DATA_DIR__
@@ -29,6 +53,30 @@ class BrokerConfig:
     render_packet: bool = __DEFAULT_RENDER_PACKET__
     update_interval_s: float = __DEFAULT_UPDATE_INTERVAL_S__
     debug: bool = __DEFAULT_DEBUG__
+    decode_at_ingest: bool = __DEFAULT_DECODE_AT_INGEST__
+    write_flush_interval_s: float = __DEFAULT_WRITE_FLUSH_INTERVAL_S__
+    write_flush_size: int = __DEFAULT_WRITE_FLUSH_SIZE__
+    write_fsync: str = __DEFAULT_WRITE_FSYNC__
+    index_stride: int = __DEFAULT_INDEX_STRIDE__
+    cache_max_bytes: int = __DEFAULT_CACHE_MAX_BYTES__
+    segment_max_bytes: int = __DEFAULT_SEGMENT_MAX_BYTES__
+    segment_max_duration_s: float = __DEFAULT_SEGMENT_MAX_DURATION_S__
+    live_enable: bool = __DEFAULT_LIVE_ENABLE__
+    live_port: int = __DEFAULT_LIVE_PORT__
+    live_rate_hz: float = __DEFAULT_LIVE_RATE_HZ__
+    live_max_delay_ms: float = __DEFAULT_LIVE_MAX_DELAY_MS__
+    align_n_workers: int = __DEFAULT_ALIGN_N_WORKERS__
+    align_pool: str = __DEFAULT_ALIGN_POOL__
+    align_rate_hz: float = __DEFAULT_ALIGN_RATE_HZ__
+    tcp_buff_max_sz: int = __DEFAULT_TCP_BUFF_MAX_SZ__
+    tcp_rcvbuf: int = __DEFAULT_TCP_RCVBUF__
+    tcp_nodelay: bool = __DEFAULT_TCP_NODELAY__
+    tcp_backlog: int = __DEFAULT_TCP_BACKLOG__
+    tcp_reuseport: bool = __DEFAULT_TCP_REUSEPORT__
+    load_report_interval_s: float = __DEFAULT_LOAD_REPORT_INTERVAL_S__
+    rebalance_threshold: float = __DEFAULT_REBALANCE_THRESHOLD__
+    rebalance_cooldown_s: float = __DEFAULT_REBALANCE_COOLDOWN_S__
+    state_table_size: int = __DEFAULT_STATE_TABLE_SIZE__
 
     imu_addresses: List[str] = []
 
@@ -60,6 +108,30 @@ class BrokerConfig:
         self.update_interval_s: float = src['update_interval_s']
         self.imu_addresses = src['imu_addresses']
         self.debug = src['debug']
+        self.decode_at_ingest = src.get('decode_at_ingest', self.__DEFAULT_DECODE_AT_INGEST__)
+        self.write_flush_interval_s = src.get('write_flush_interval_s', self.__DEFAULT_WRITE_FLUSH_INTERVAL_S__)
+        self.write_flush_size = src.get('write_flush_size', self.__DEFAULT_WRITE_FLUSH_SIZE__)
+        self.write_fsync = src.get('write_fsync', self.__DEFAULT_WRITE_FSYNC__)
+        self.index_stride = src.get('index_stride', self.__DEFAULT_INDEX_STRIDE__)
+        self.cache_max_bytes = src.get('cache_max_bytes', self.__DEFAULT_CACHE_MAX_BYTES__)
+        self.segment_max_bytes = src.get('segment_max_bytes', self.__DEFAULT_SEGMENT_MAX_BYTES__)
+        self.segment_max_duration_s = src.get('segment_max_duration_s', self.__DEFAULT_SEGMENT_MAX_DURATION_S__)
+        self.live_enable = src.get('live_enable', self.__DEFAULT_LIVE_ENABLE__)
+        self.live_port = src.get('live_port', self.__DEFAULT_LIVE_PORT__)
+        self.live_rate_hz = src.get('live_rate_hz', self.__DEFAULT_LIVE_RATE_HZ__)
+        self.live_max_delay_ms = src.get('live_max_delay_ms', self.__DEFAULT_LIVE_MAX_DELAY_MS__)
+        self.align_n_workers = src.get('align_n_workers', self.__DEFAULT_ALIGN_N_WORKERS__)
+        self.align_pool = src.get('align_pool', self.__DEFAULT_ALIGN_POOL__)
+        self.align_rate_hz = src.get('align_rate_hz', self.__DEFAULT_ALIGN_RATE_HZ__)
+        self.tcp_buff_max_sz = src.get('tcp_buff_max_sz', self.__DEFAULT_TCP_BUFF_MAX_SZ__)
+        self.tcp_rcvbuf = src.get('tcp_rcvbuf', self.__DEFAULT_TCP_RCVBUF__)
+        self.tcp_nodelay = src.get('tcp_nodelay', self.__DEFAULT_TCP_NODELAY__)
+        self.tcp_backlog = src.get('tcp_backlog', self.__DEFAULT_TCP_BACKLOG__)
+        self.tcp_reuseport = src.get('tcp_reuseport', self.__DEFAULT_TCP_REUSEPORT__)
+        self.load_report_interval_s = src.get('load_report_interval_s', self.__DEFAULT_LOAD_REPORT_INTERVAL_S__)
+        self.rebalance_threshold = src.get('rebalance_threshold', self.__DEFAULT_REBALANCE_THRESHOLD__)
+        self.rebalance_cooldown_s = src.get('rebalance_cooldown_s', self.__DEFAULT_REBALANCE_COOLDOWN_S__)
+        self.state_table_size = src.get('state_table_size', self.__DEFAULT_STATE_TABLE_SIZE__)
         self.__post_init__()
 
     def get_dict(self) -> Dict[str, Any]:
@@ -75,7 +147,31 @@ class BrokerConfig:
             'render_packet': self.render_packet,
             'update_interval_s': self.update_interval_s,
             'imu_addresses': self.imu_addresses,
-            'debug': self.debug
+            'debug': self.debug,
+            'decode_at_ingest': self.decode_at_ingest,
+            'write_flush_interval_s': self.write_flush_interval_s,
+            'write_flush_size': self.write_flush_size,
+            'write_fsync': self.write_fsync,
+            'index_stride': self.index_stride,
+            'cache_max_bytes': self.cache_max_bytes,
+            'segment_max_bytes': self.segment_max_bytes,
+            'segment_max_duration_s': self.segment_max_duration_s,
+            'live_enable': self.live_enable,
+            'live_port': self.live_port,
+            'live_rate_hz': self.live_rate_hz,
+            'live_max_delay_ms': self.live_max_delay_ms,
+            'align_n_workers': self.align_n_workers,
+            'align_pool': self.align_pool,
+            'align_rate_hz': self.align_rate_hz,
+            'tcp_buff_max_sz': self.tcp_buff_max_sz,
+            'tcp_rcvbuf': self.tcp_rcvbuf,
+            'tcp_nodelay': self.tcp_nodelay,
+            'tcp_backlog': self.tcp_backlog,
+            'tcp_reuseport': self.tcp_reuseport,
+            'load_report_interval_s': self.load_report_interval_s,
+            'rebalance_threshold': self.rebalance_threshold,
+            'rebalance_cooldown_s': self.rebalance_cooldown_s,
+            'state_table_size': self.state_table_size,
         }
 
     def configure_from_keyboard(self):
@@ -90,3 +186,4 @@ class BrokerConfig:
         self.render_packet = must_parse_cli_bool("Render packet?", default_value=True)
         self.update_interval_s = must_parse_cli_float("Update interval (s)?", min=1e-3, max=1e3, default_value=self.__DEFAULT_UPDATE_INTERVAL_S__)
         self.debug = must_parse_cli_bool("Debug?", default_value=False)
+        self.decode_at_ingest = must_parse_cli_bool("Decode frames at ingest?", default_value=self.__DEFAULT_DECODE_AT_INGEST__)
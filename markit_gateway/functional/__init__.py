@@ -1,3 +1,7 @@
-from .convert import convert_measurement
-from .ellipse import EllipseFitter
-from .vector import vectorize_to_np
+from .convert import convert_measurement, convert_closed_segments
+from .ellipse import EllipseFitter, OnlineEllipseFitter
+from .vector import vectorize_to_np, FrameBatch, group_by_device
+from .store import AlignedStore, AlignedStoreWriter
+from .cache import ConversionCache
+from .interp import SharedIndexInterpolator
+from .live import LiveAligner
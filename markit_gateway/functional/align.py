@@ -1,120 +1,355 @@
 import glob
 import json
 import os
-from typing import Dict, List
+import shutil
+import struct
+import zipfile
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, Any
 
 import numpy as np
 
 import os.path as osp
 import quaternionic
+from scipy.signal import firwin
 from scipy.spatial.transform import Rotation as R
-from scipy.spatial.transform import Slerp
 import pickle
 
-from markit_gateway.functional.ellipse import EllipseFitter
+from markit_gateway.common import ClockModel
+from markit_gateway.functional.ellipse import OnlineEllipseFitter
+from markit_gateway.functional.interp import SharedIndexInterpolator
+from markit_gateway.functional.store import AlignedStore, AlignedStoreWriter, ALIGNED_STORE_NAME
 
 
 def quaternionic_slerp(*args):
     return quaternionic.slerp(*args)
 
 
-def get_averaged_global_timestamp_us(imu_device_id_mapping, min_timestamp_us, method):
-    _raw = np.array([
-        imu_device_id_mapping[imu_id]['timestamp'][np.where(imu_device_id_mapping[imu_id][method] >= min_timestamp_us)[0].min()] for imu_id in imu_device_id_mapping.keys()
-    ])
+LINEAR_INTERP_FIELDS: Dict[str, List[str]] = {
+    'accel': ['accel_x', 'accel_y', 'accel_z'],
+    'gyro': ['gyro_x', 'gyro_y', 'gyro_z'],
+    'mag': ['mag_x', 'mag_y', 'mag_z'],
+}
+QUAT_INTERP_FIELDS: Dict[str, List[str]] = {
+    'quat': ['quat_x', 'quat_y', 'quat_z', 'quat_w'],
+}
+EULER_FIELDS: Dict[str, str] = {
+    'euler': 'quat',  # derived from the interpolated quaternion
+}
+ALIGNED_FIELDS: Dict[str, Tuple[Tuple[int, ...], Any]] = {
+    **{field: ((len(src_field),), np.float64) for field, src_field in LINEAR_INTERP_FIELDS.items()},
+    **{field: ((len(src_field),), np.float64) for field, src_field in QUAT_INTERP_FIELDS.items()},
+    **{field: ((3,), np.float64) for field in EULER_FIELDS.keys()},
+}
+_LINEAR_CHANNELS: List[str] = [name for src_field in LINEAR_INTERP_FIELDS.values() for name in src_field]
+_QUAT_CHANNELS: List[str] = [name for src_field in QUAT_INTERP_FIELDS.values() for name in src_field]
 
-    _mean = _raw.mean(axis=0)
+
+def get_averaged_global_timestamp_us(clock_models: Dict[str, ClockModel], tsf_timestamp_us: int):
+    """Global time of a tsf_timestamp averaged over devices, with the spread between the devices"""
+    _raw = np.array([model.to_global(tsf_timestamp_us) for model in clock_models.values()])
+
+    _mean = ClockModel.average(clock_models.values(), np.array([tsf_timestamp_us]))[0]
     _std = np.std(_raw)
     _var = np.var(_raw)
 
     return int(_mean), _std, _var
 
 
-def align_measurement(measurement_basedir: str, method: str = 'tsf_timestamp') -> Dict[str, Dict[str, np.ndarray]]:
-    _linear_interp_fields = {
-        'accel': ['accel_x', 'accel_y', 'accel_z'],
-        'gyro': ['gyro_x', 'gyro_y', 'gyro_z'],
-        'mag': ['mag_x', 'mag_y', 'mag_z'],
-    }
-    _quat_interp_fields = {
-        'quat': ['quat_x', 'quat_y', 'quat_z', 'quat_w'],
-    }
-    _euler_interp_fields = {
-        'euler': ['roll', 'pitch', 'yaw'],
-    }
+def load_npz_mmap(filename: str) -> Dict[str, np.ndarray]:
+    """Open the members of an .npz file as read-only memory maps
 
-    filenames_list: List[str] = glob.glob(os.path.join(measurement_basedir, '*.npz'))
-    imu_device_id_mapping = {
-        osp.basename(filename).split('_')[1].split('.')[0]: np.load(filename) for filename in filenames_list
-    }
+    np.savez stores members uncompressed, so each .npy inside the zip can be mapped in place. Compressed
+    members (np.savez_compressed) fall back to being read into memory.
+    """
+    res = {}
+    with zipfile.ZipFile(filename) as zf, open(filename, 'rb') as f:
+        for info in zf.infolist():
+            name = info.filename[:-len('.npy')] if info.filename.endswith('.npy') else info.filename
+            if info.compress_type != zipfile.ZIP_STORED:
+                with zf.open(info) as member:
+                    res[name] = np.lib.format.read_array(member)
+                continue
+            # Local file header: 30 fixed bytes, then the file name and the extra field
+            f.seek(info.header_offset)
+            header = f.read(30)
+            name_len, extra_len = struct.unpack('<HH', header[26:30])
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            elif version == (2, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            else:
+                shape, fortran_order, dtype = (), False, np.dtype(object)
+            if dtype.hasobject or np.prod(shape) == 0:
+                with zf.open(info) as member:
+                    res[name] = np.lib.format.read_array(member)
+                continue
+            res[name] = np.memmap(filename, dtype=dtype, mode='r', offset=f.tell(), shape=shape, order='F' if fortran_order else 'C')
+    return res
+
+
+def _load_device(imu_data: Dict[str, np.ndarray], fields) -> Dict[str, np.ndarray]:
+    """Flat views of the given fields of one device, columns are stored with shape (N, 1)
+
+    Views of memory-mapped columns stay memory-mapped, only the windows that are sliced later are read.
+    """
+    return {name: imu_data[name].reshape(-1) for name in fields}
+
+
+def anti_alias_taps(src_period_us: float, rate_hz: float) -> Optional[np.ndarray]:
+    """FIR low-pass taps for decimating a device sampled every src_period_us to rate_hz
+
+    The cutoff is at 80% of the output Nyquist frequency and the filter spans about four output periods.
+
+    Returns:
+        Optional[np.ndarray]: odd number of taps, None if the output is not slower than the source
+    """
+    factor = 1e6 / src_period_us / rate_hz if src_period_us > 0 else 0.
+    if factor <= 1.:
+        return None
+    return firwin(2 * int(np.ceil(4 * factor)) + 1, 0.4 * rate_hz, fs=1e6 / src_period_us)
+
+
+def interpolate_device(imu_data: Dict[str, np.ndarray],
+                       src_t: np.ndarray,
+                       dst_t: np.ndarray,
+                       taps: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+    """Resample the channels of one device onto dst_t
+
+    Args:
+        imu_data (Dict[str, np.ndarray]): flat source columns (accel_x, ..., quat_w) sampled at src_t
+        src_t (np.ndarray): source timestamps, non-decreasing
+        dst_t (np.ndarray): target timestamps
+        taps (np.ndarray): anti-aliasing filter of the linear channels, see anti_alias_taps. Quaternions are
+            not filtered
+
+    Returns:
+        Dict[str, np.ndarray]: aligned fields, see ALIGNED_FIELDS
+    """
+    res = {}
+    interpolator = SharedIndexInterpolator(src_t, dst_t)
+
+    # All linear channels in one pass, then split into (M, 3) fields
+    if taps is None:
+        _linear = interpolator.linear(np.stack([imu_data[name] for name in _LINEAR_CHANNELS], axis=1))
+    else:
+        # Channel-major layout, the filter reads contiguous runs of each channel
+        _linear = interpolator.linear(np.stack([imu_data[name] for name in _LINEAR_CHANNELS], axis=0).T, taps)
+    col = 0
+    for dst_field, src_field in LINEAR_INTERP_FIELDS.items():
+        res[dst_field] = np.ascontiguousarray(_linear[:, col:col + len(src_field)])
+        col += len(src_field)
+
+    for dst_field, src_field in QUAT_INTERP_FIELDS.items():
+        res[dst_field] = interpolator.slerp(np.stack([imu_data[name] for name in src_field], axis=1))
+
+    for dst_field, src_field in EULER_FIELDS.items():
+        res[dst_field] = R.from_quat(res[src_field]).as_euler(seq='xyz', degrees=True)
+    return res
+
+
+def _share_array(array: np.ndarray, spill_path: str) -> Tuple[str, int, Tuple[int, ...], Tuple[int, ...], str]:
+    """Picklable reference to the memory of an array, see _attach_array
+
+    Arrays backed by a file mapping are referenced in place, others are spilled to spill_path first. Workers map
+    the same pages instead of receiving a pickled copy.
+    """
+    root = array
+    while isinstance(root.base, np.ndarray):
+        root = root.base
+    if not (isinstance(root, np.memmap) and root.filename is not None):
+        np.save(spill_path, np.ascontiguousarray(array))
+        array = root = np.load(spill_path, mmap_mode='r')
+    offset = array.__array_interface__['data'][0] - root.__array_interface__['data'][0] + root.offset
+    return root.filename, offset, array.shape, array.strides, array.dtype.str
+
+
+def _attach_array(ref: Tuple[str, int, Tuple[int, ...], Tuple[int, ...], str]) -> np.ndarray:
+    filename, offset, shape, strides, dtype = ref
+    return np.ndarray(shape, np.dtype(dtype), buffer=np.memmap(filename, dtype=np.uint8, mode='r'), offset=offset, strides=strides)
+
+
+def _align_device(imu_id: str,
+                  imu_data: Dict[str, np.ndarray],
+                  method: str,
+                  store_path: str,
+                  chunk_size: int,
+                  taps: Optional[np.ndarray] = None) -> OnlineEllipseFitter:
+    """Interpolate one device onto the master timeline already written to the store
+
+    Returns:
+        OnlineEllipseFitter: moments of the aligned magnetometer, accumulated chunk by chunk
+    """
+    master_t = np.load(os.path.join(store_path, 'tsf_timestamp.npy'), mmap_mode='r')
+    outputs = AlignedStoreWriter.attach(store_path, imu_id, ALIGNED_FIELDS.keys())
+    src_t = imu_data[method]
+    margin = len(taps) // 2 if taps is not None else 0
+    fitter = OnlineEllipseFitter()
+    for start in range(0, len(master_t), chunk_size):
+        dst_t = np.asarray(master_t[start:start + chunk_size])
+        # The window plus the source samples right before and after it, and those under the filter
+        lo = max(int(np.searchsorted(src_t, dst_t[0], side='right')) - 1 - margin, 0)
+        hi = min(int(np.searchsorted(src_t, dst_t[-1], side='left')) + 1 + margin, len(src_t))
+        window = {name: np.asarray(value[lo:hi]) for name, value in imu_data.items()}
+        aligned = interpolate_device(window, window[method], dst_t, taps)
+        for field, value in aligned.items():
+            outputs[field][start:start + len(dst_t)] = value
+        fitter.update(aligned['mag'])
+    for array in outputs.values():
+        array.flush()
+    return fitter
+
+
+def _align_device_shared(imu_id: str, refs: Dict[str, Tuple], method: str, store_path: str, chunk_size: int, taps: Optional[np.ndarray] = None):
+    return _align_device(imu_id, {name: _attach_array(ref) for name, ref in refs.items()}, method, store_path, chunk_size, taps)
+
+
+def align_measurement(measurement_basedir: str,
+                      method: str = 'tsf_timestamp',
+                      imu_device_id_mapping: Optional[Dict[str, Dict[str, np.ndarray]]] = None,
+                      chunk_size: int = 0x10000,
+                      dump_pickle: bool = False,
+                      clock_models: Optional[Dict[str, ClockModel]] = None,
+                      n_workers: Optional[int] = None,
+                      pool: str = 'process',
+                      rate_hz: Optional[float] = None) -> Dict[str, Dict[str, np.ndarray]]:
+    """Resample every device onto the timestamps of a master device, or onto a uniform grid of rate_hz
+
+    The master timeline is walked in windows of chunk_size samples. For each window only the source samples
+    bracketing it are read, interpolated and written to the aligned store, so peak memory depends on
+    chunk_size and not on the length of the session.
+
+    Global timestamps of the master timeline come from the clock fits (timestamp against tsf_timestamp) of the
+    devices, averaged. Fits made at ingest are saved as *.clock.json next to the recordings, devices without
+    one are fitted here in a single pass over their two timestamp columns.
+
+    Devices are interpolated in parallel once the master timeline is in the store. Workers map the timeline file
+    and the source columns rather than receiving copies, write their own device files and return the moments of
+    their magnetometer; the ellipsoids of all devices are then solved in one batch, in device order, so the
+    output does not depend on n_workers.
+
+    With rate_hz, the grid covers the common range of the devices at multiples of the output period (like the
+    live stream). Only grid points are interpolated; accel, gyro and mag of devices sampled faster than rate_hz
+    are low-pass filtered first, evaluated at the bracketing samples only, see anti_alias_taps.
+
+    Args:
+        measurement_basedir (str): measurement directory, imu_{id}.npz files are loaded from here unless
+            imu_device_id_mapping is given
+        method (str): timestamp field used for alignment
+        imu_device_id_mapping (Dict[str, Dict[str, np.ndarray]]): device id -> columns laid out like imu_{id}.npz,
+            sorted by method
+        chunk_size (int): samples aligned and written at a time
+        dump_pickle (bool): also write the legacy imu.pkl, which needs the whole result in memory
+        clock_models (Dict[str, ClockModel]): device id -> clock fit, loaded from measurement_basedir by default
+        n_workers (int): size of the worker pool, defaults to the number of cores, 1 aligns in this process
+        pool (str): 'process' or 'thread'
+        rate_hz (float): output rate, defaults to the native timestamps of the master device
+
+    Returns:
+        Dict[str, Dict[str, np.ndarray]]: aligned fields of every device, memory-mapped from the aligned store
+    """
+    if imu_device_id_mapping is None:
+        filenames_list: List[str] = glob.glob(os.path.join(measurement_basedir, '*.npz'))
+        imu_device_id_mapping = {
+            osp.basename(filename).split('_')[1].split('.')[0]: load_npz_mmap(filename) for filename in filenames_list
+        }
     # imu_device_id_mapping = {
     #     k:v for k, v in imu_device_id_mapping.items() if k != 'all'
     # }
-    master_id = list(imu_device_id_mapping.keys())[0]
-    min_timestamp_us = max([item['tsf_timestamp'].min() for item in imu_device_id_mapping.values()])
-    max_timestamp_us = min([item['tsf_timestamp'].max() for item in imu_device_id_mapping.values()])
-    _ts = imu_device_id_mapping[master_id][method]
-    master_tsf_timestamp_us = _ts[(_ts >= min_timestamp_us) & (_ts <= max_timestamp_us)]
-    master_global_to_tsf, std, var = get_averaged_global_timestamp_us(imu_device_id_mapping, min_timestamp_us, method)
-    master_global_timestamp_us = (master_tsf_timestamp_us - master_tsf_timestamp_us[0]) + master_global_to_tsf
-
-    interp_res = dict()
-    meta_data = dict()
-    for imu_id, imu_data in imu_device_id_mapping.items():
-        interp_res[imu_id] = dict()
-        for dst_field, src_field in _linear_interp_fields.items():
-            interp_res[imu_id][dst_field] = np.concatenate(
-                [
-                    np.expand_dims(
-                        np.interp(
-                            master_tsf_timestamp_us,
-                            imu_data[method].squeeze(),
-                            imu_data[name].squeeze()
-                        ),
-                        axis=1
-                    ) for name in src_field
-                ],
-                axis=1
-            )
-
-        for dst_field, src_field in _quat_interp_fields.items():
-            _quat = np.concatenate(
-                [imu_data[name] for name in src_field],
-                axis=1
-            )
-            slerp = Slerp(
-                imu_data[method].squeeze(),
-                R.from_quat(_quat)
-            )
-            interp_res[imu_id][dst_field] = slerp(master_tsf_timestamp_us).as_quat()
-
-        for dst_field, src_field in _euler_interp_fields.items():
-            _euler = np.concatenate(
-                [imu_data[name] for name in src_field],
-                axis=1
-            )
-            slerp = Slerp(
-                imu_data[method].squeeze(),
-                R.from_euler('xyz', _euler, degrees=True)
-            )
-            interp_res[imu_id][dst_field] = slerp(master_tsf_timestamp_us).as_euler(seq='xyz', degrees=True)
-
-        interp_res[imu_id]['timestamp'] = master_global_timestamp_us
-        interp_res[imu_id]['tsf_timestamp'] = master_tsf_timestamp_us
+    devices = {
+        imu_id: _load_device(imu_data, {method, 'timestamp', 'tsf_timestamp', *_LINEAR_CHANNELS, *_QUAT_CHANNELS})
+        for imu_id, imu_data in imu_device_id_mapping.items()
+    }
+    master_id = list(devices.keys())[0]
+    min_timestamp_us = max([item['tsf_timestamp'].min() for item in devices.values()])
+    max_timestamp_us = min([item['tsf_timestamp'].max() for item in devices.values()])
+    _ts = devices[master_id][method]
+    _tsf = devices[master_id]['tsf_timestamp']
+    master_start = int(np.searchsorted(_ts, min_timestamp_us, side='left'))
+    master_stop = int(np.searchsorted(_ts, max_timestamp_us, side='right'))
+    n_samples = max(master_stop - master_start, 0)  # devices that do not overlap give an empty store
+    taps: Dict[str, Optional[np.ndarray]] = {imu_id: None for imu_id in devices.keys()}
+    if rate_hz:
+        period_us = 1e6 / rate_hz
+        grid_start = int(np.ceil(min_timestamp_us / period_us))
+        n_samples = max(int(np.floor(max_timestamp_us / period_us)) - grid_start + 1, 0)
+        taps = {
+            imu_id: anti_alias_taps((imu_data[method][-1] - imu_data[method][0]) / max(len(imu_data[method]) - 1, 1), rate_hz)
+            for imu_id, imu_data in devices.items()
+        }
+    if clock_models is None:
+        clock_models = ClockModel.load_all(measurement_basedir)
+    clock_models = {
+        imu_id: clock_models[imu_id] if len(clock_models.get(imu_id, ())) > 0 else ClockModel.fit(imu_data['tsf_timestamp'], imu_data['timestamp'], imu_id)
+        for imu_id, imu_data in devices.items()
+    }
+    master_global_to_tsf, std, var = get_averaged_global_timestamp_us(clock_models, int(round(grid_start * period_us)) if rate_hz else int(_tsf[min(master_start, len(_tsf) - 1)]))
 
+    meta_data = dict()
     meta_data['general'] = {
-        '.master_id': master_id
+        '.master_id': master_id,
+        'rate_hz': rate_hz,
     }
     meta_data['timestamp'] = {
         'master_global_to_tsf': master_global_to_tsf,
         'std': std,
         'var': var,
     }
-    meta_data['ellipse'] = {
-        imu_id: EllipseFitter.fit(imu_data['mag']) for imu_id, imu_data in interp_res.items()
+    meta_data['clock'] = {
+        imu_id: model.to_dict() for imu_id, model in clock_models.items()
     }
 
-    pickle.dump(interp_res, open(os.path.join(measurement_basedir, f'imu.pkl'), 'wb'))
+    store_path = os.path.join(measurement_basedir, ALIGNED_STORE_NAME)
+    store = AlignedStoreWriter(store_path, n_samples, list(devices.keys()), ALIGNED_FIELDS, meta=meta_data)
+    for start in range(0, n_samples, chunk_size):
+        stop = min(start + chunk_size, n_samples)
+        if rate_hz:
+            master_tsf_timestamp_us = np.round((grid_start + np.arange(start, stop)) * period_us).astype(np.int64)
+            master_global_timestamp_us = ClockModel.average(clock_models.values(), master_tsf_timestamp_us) if method == 'tsf_timestamp' else master_tsf_timestamp_us
+        else:
+            master_tsf_timestamp_us = np.asarray(_ts[master_start + start:master_start + stop], dtype=np.int64)
+            master_global_timestamp_us = ClockModel.average(clock_models.values(), np.asarray(_tsf[master_start + start:master_start + stop], dtype=np.int64))
+        store.write_timeline(start, timestamp=master_global_timestamp_us, tsf_timestamp=master_tsf_timestamp_us)
+    store.flush()
+
+    n_workers = min(os.cpu_count() if n_workers is None else n_workers, len(devices))
+    executor: Optional[Executor] = None
+    if n_workers > 1:
+        executor = ProcessPoolExecutor(n_workers) if pool == 'process' else ThreadPoolExecutor(n_workers)
+    spill_dir = os.path.join(store_path, '.share')
+    try:
+        if executor is None:
+            fitters = {imu_id: _align_device(imu_id, imu_data, method, store_path, chunk_size, taps[imu_id]) for imu_id, imu_data in devices.items()}
+        elif pool == 'process':
+            os.makedirs(spill_dir, exist_ok=True)
+            futures = {
+                imu_id: executor.submit(_align_device_shared,
+                                        imu_id,
+                                        {name: _share_array(value, os.path.join(spill_dir, f'{imu_id}.{name}.npy')) for name, value in imu_data.items()},
+                                        method, store_path, chunk_size, taps[imu_id])
+                for imu_id, imu_data in devices.items()
+            }
+            fitters = {imu_id: future.result() for imu_id, future in futures.items()}
+        else:
+            futures = {imu_id: executor.submit(_align_device, imu_id, imu_data, method, store_path, chunk_size, taps[imu_id]) for imu_id, imu_data in devices.items()}
+            fitters = {imu_id: future.result() for imu_id, future in futures.items()}
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        shutil.rmtree(spill_dir, ignore_errors=True)
+    for start in range(0, n_samples, chunk_size):
+        store.commit_chunk(start, min(start + chunk_size, n_samples))
+
+    meta_data['ellipse'] = dict(zip(fitters.keys(), OnlineEllipseFitter.solve_batch(fitters.values())))
+    store.meta = meta_data
+    store.close()
+
+    interp_res = {imu_id: AlignedStore(store_path).device(imu_id) for imu_id in devices.keys()}
+    if dump_pickle:
+        pickle.dump({imu_id: {field: np.array(value) for field, value in fields.items()} for imu_id, fields in interp_res.items()},
+                    open(os.path.join(measurement_basedir, f'imu.pkl'), 'wb'))
     json.dump(meta_data, open(os.path.join(measurement_basedir, f'imu.json'), 'w'), indent=4)
     # np.savez(os.path.join(measurement_basedir, f'imu_all.npz'), **interp_res)
     return interp_res
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from typing import Dict, Tuple, Optional, Any
+
+
+class ConversionCache:
+    """Parsed output of raw recordings, keyed by path, size, mtime and content hash
+
+    Every entry holds the per-device frame records of one .dat file. A stat key (path, size, mtime) maps to
+    the content hash so unchanged files are not even re-hashed; a touched or copied file with the same content
+    still hits by hash. Entries are evicted least recently used first once the cache exceeds max_bytes.
+
+    Layout::
+
+        {cache_dir}/index.json
+        {cache_dir}/{content_hash}/imu_{id}.frames
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 0x100000000):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index_path = os.path.join(cache_dir, 'index.json')
+        self.index: Dict[str, Dict[str, Any]] = {'stat': {}, 'entries': {}}
+        if os.path.exists(self._index_path):
+            try:
+                with open(self._index_path) as f:
+                    self.index = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f"conversion cache index is unreadable, starting over: {e}")
+        self.logger = logging.getLogger('conversion_cache')
+
+    @staticmethod
+    def _stat_key(filename: str) -> str:
+        stat = os.stat(filename)
+        return f"{os.path.abspath(filename)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    @staticmethod
+    def content_hash(filename: str) -> str:
+        h = hashlib.blake2b(digest_size=20)
+        with open(filename, 'rb') as f:
+            while True:
+                chunk = f.read(0x100000)
+                if not chunk:
+                    break
+                h.update(chunk)
+        return h.hexdigest()
+
+    def get(self, filename: str) -> Optional[Dict[str, Tuple[str, int, int]]]:
+        """Cached pieces of a recording
+
+        Returns:
+            Optional[Dict[str, Tuple[str, int, int]]]: device id -> (frames path, number of frames, first tsf_timestamp),
+                None on miss
+        """
+        stat_key = self._stat_key(filename)
+        digest = self.index['stat'].get(stat_key)
+        if digest is None:
+            digest = self.content_hash(filename)
+            self.index['stat'][stat_key] = digest
+        entry = self.index['entries'].get(digest)
+        if entry is None:
+            return None
+
+        pieces = {imu_id: (os.path.join(self.cache_dir, digest, name), n_frames, first_tsf_timestamp) for imu_id, (name, n_frames, first_tsf_timestamp) in entry['pieces'].items()}
+        if not all(os.path.exists(piece[0]) for piece in pieces.values()):
+            self._remove(digest)
+            return None
+        entry['last_access'] = time.time()
+        return pieces
+
+    def put(self, filename: str, pieces: Dict[str, Tuple[str, int, int]]):
+        """Keep the spooled pieces of a freshly parsed recording, hard-linked when possible"""
+        stat_key = self._stat_key(filename)
+        digest = self.index['stat'].get(stat_key)
+        if digest is None:
+            digest = self.content_hash(filename)
+            self.index['stat'][stat_key] = digest
+        entry_dir = os.path.join(self.cache_dir, digest)
+        os.makedirs(entry_dir, exist_ok=True)
+
+        entry = {'filename': os.path.abspath(filename), 'pieces': {}, 'bytes': 0, 'last_access': time.time()}
+        for imu_id, (path, n_frames, first_tsf_timestamp) in pieces.items():
+            name = f'imu_{imu_id}.frames'
+            dst = os.path.join(entry_dir, name)
+            if os.path.exists(dst):
+                os.remove(dst)
+            try:
+                os.link(path, dst)
+            except OSError:
+                shutil.copyfile(path, dst)
+            entry['pieces'][imu_id] = [name, n_frames, first_tsf_timestamp]
+            entry['bytes'] += os.path.getsize(dst)
+        self.index['entries'][digest] = entry
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits in max_bytes"""
+        entries = self.index['entries']
+        total = sum(entry['bytes'] for entry in entries.values())
+        for digest in sorted(entries.keys(), key=lambda x: entries[x]['last_access']):
+            if total <= self.max_bytes:
+                break
+            total -= entries[digest]['bytes']
+            self._remove(digest)
+
+    def _remove(self, digest: str):
+        self.index['entries'].pop(digest, None)
+        self.index['stat'] = {k: v for k, v in self.index['stat'].items() if v != digest}
+        shutil.rmtree(os.path.join(self.cache_dir, digest), ignore_errors=True)
+
+    def save(self):
+        self.evict()
+        # Stat keys of files that no longer exist are dropped
+        self.index['stat'] = {k: v for k, v in self.index['stat'].items() if os.path.exists(k.rsplit(':', 2)[0])}
+        tmp_path = self._index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self._index_path)
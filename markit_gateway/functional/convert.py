@@ -1,57 +1,318 @@
 import glob
 import logging
 import os
-from typing import Dict, List
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, BinaryIO, Tuple, Optional
 
 import numpy as np
 import tqdm
 
-from markit_gateway.common import IMUParser
-from markit_gateway.functional.vector import vectorize_to_np
+from markit_gateway.common import IMUParser, FrameLog, SeekIndex, SegmentManifest, ClockModel
 from markit_gateway.functional.align import align_measurement
+from markit_gateway.functional.cache import ConversionCache
+from markit_gateway.functional.vector import FrameBatch, group_by_device
 
-def convert_measurement(measurement_basedir: str, delete_dat: bool = False) -> Dict[str, Dict[str, np.ndarray]]:
-    _logger = logging.getLogger('convert_measurement')
+MEASUREMENT_KEYS: List[str] = [
+    'id', 'timestamp',
+    'accel_x', 'accel_y', 'accel_z',
+    'gyro_x', 'gyro_y', 'gyro_z',
+    'mag_x', 'mag_y', 'mag_z',
+    'quat_w', 'quat_x', 'quat_y', 'quat_z',
+    'pitch', 'roll', 'yaw',
+    'uart_buffer_len', 'tsf_timestamp', 'seq'
+]
+
+
+def frames_to_npz_dict(frames: np.ndarray, imu_id: str, keys: List[str] = None) -> Dict[str, np.ndarray]:
+    """Lay out frames of one device the way imu_{id}.npz stores them
+
+    Columns are views of frames (which may be a np.memmap), so nothing is materialized before np.savez.
+
+    Args:
+        frames (np.ndarray): structured array of IMUParser.FRAME_DTYPE
+        imu_id (str): device id
+        keys (List[str]): fields to export, defaults to MEASUREMENT_KEYS
+
+    Returns:
+        Dict[str, np.ndarray]: field name -> array of shape (N, 1)
+    """
+    keys = MEASUREMENT_KEYS if keys is None else keys
+    res = {}
+    for key in keys:
+        if key == 'id':
+            res[key] = np.broadcast_to(np.array(imu_id), (len(frames), 1))
+        else:
+            res[key] = np.expand_dims(frames[key], axis=-1)
+    return res
+
+
+def _convert_file(filename: str, spool_dir: str, batch_size: int, index_stride: int = 256) -> Dict[str, Tuple[str, int, int]]:
+    """Parse one recording and spool its frames per device
 
-    MEASUREMENT_KEYS: List[str] = [
-        'id', 'timestamp',
-        'accel_x', 'accel_y', 'accel_z',
-        'gyro_x', 'gyro_y', 'gyro_z',
-        'mag_x', 'mag_y', 'mag_z',
-        'quat_w', 'quat_x', 'quat_y', 'quat_z',
-        'pitch', 'roll', 'yaw',
-        'uart_buffer_len', 'tsf_timestamp','seq'
-    ]
-
-    filenames_list: List[str] = glob.glob(os.path.join(measurement_basedir, '*.dat'))
-    all_measurement: Dict[str, list] = {}
-    all_measurement_np: Dict[str, Dict[str, np.ndarray]] = {}
+    A seek index of the recording is written along the way unless index_stride is 0 or the recording already has
+    one, e.g. built at ingest.
+
+    Returns:
+        Dict[str, Tuple[str, int, int]]: device id -> (spool path, number of frames, first tsf_timestamp)
+    """
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    spool_handles: Dict[str, BinaryIO] = {}
+    pending: Dict[str, FrameBatch] = {}
+    res: Dict[str, Tuple[str, int, int]] = {}
     imu_parser = IMUParser()
+    index = SeekIndex(stride=index_stride) if index_stride > 0 and not os.path.exists(SeekIndex.path_of(filename)) else None
 
-    # Scatter measurement point
-    for filename in filenames_list:
-        with open(filename, 'rb') as f:
-            points = imu_parser(f)
-            for point in points:
-                point_id = str(point['id'])
-                if point_id not in all_measurement.keys():
-                    all_measurement[point_id] = []
-                all_measurement[point_id].append(point)
-    _logger.info(f"Got measurement from {len(all_measurement)} client")
-
-    # Convert to numpy
-    with tqdm.tqdm(len(all_measurement)) as pbar:
-        pbar.update()
-        for key in all_measurement.keys():
-            all_measurement_np[key] = vectorize_to_np(all_measurement[key], MEASUREMENT_KEYS)
-
-    # Clean dat files
-    if delete_dat:
-        map(lambda x: os.remove(x), filenames_list)
+    def _flush(imu_id: str):
+        if imu_id not in spool_handles.keys():
+            path = os.path.join(spool_dir, f'{stem}.imu_{imu_id}.frames')
+            spool_handles[imu_id] = open(path, 'wb')
+            res[imu_id] = (path, 0, int(pending[imu_id]['tsf_timestamp'][0]))
+        spool_handles[imu_id].write(pending[imu_id].data.tobytes())
+        path, n_frames, first_tsf_timestamp = res[imu_id]
+        res[imu_id] = (path, n_frames + len(pending[imu_id]), first_tsf_timestamp)
+        pending[imu_id].clear()
+
+    for frames in imu_parser.iter_batches(filename, batch_size, index=index):
+        for imu_id, device_frames in group_by_device(frames).items():
+            if imu_id not in pending.keys():
+                pending[imu_id] = FrameBatch(batch_size)
+            pending[imu_id].append(device_frames)
+            if len(pending[imu_id]) >= batch_size:
+                _flush(imu_id)
+    for imu_id in pending.keys():
+        if len(pending[imu_id]) > 0:
+            _flush(imu_id)
+        spool_handles[imu_id].close()
+    if index is not None and len(index) > 0:
+        index.save(filename)
+    return res
+
+
+def _stitch_segments(prev_path: str, next_path: str, spool_dir: str) -> Dict[str, Tuple[str, int, int]]:
+    """Recover the frames that straddle the boundary between two consecutive segments of a capture stream
+
+    Segments are rotated between two recv() chunks, so the last frame of a segment may continue in the next
+    one. Only a few frames around the boundary are scanned, frames lying entirely in one segment have already
+    been parsed with that segment.
+
+    Returns:
+        Dict[str, Tuple[str, int, int]]: device id -> (spool path, number of frames, first tsf_timestamp)
+    """
+    window_sz = 2 * IMUParser.SCAN_DEPTH * IMUParser.FRAME_SZ
+    with open(prev_path, 'rb') as f:
+        f.seek(max(os.path.getsize(prev_path) - window_sz, 0))
+        tail = f.read()
+    with open(next_path, 'rb') as f:
+        head = f.read(window_sz)
+    buf = tail + head
+    offsets = IMUParser.scan(buf).offsets
+    offsets = offsets[(offsets < len(tail)) & (offsets + IMUParser.FRAME_SZ > len(tail))]
+
+    res: Dict[str, Tuple[str, int, int]] = {}
+    if len(offsets) == 0:
+        return res
+    stem = os.path.splitext(os.path.basename(prev_path))[0]
+    for imu_id, device_frames in group_by_device(IMUParser.decode_at(buf, offsets)).items():
+        path = os.path.join(spool_dir, f'{stem}.boundary.imu_{imu_id}.frames')
+        device_frames.tofile(path)
+        res[imu_id] = (path, len(device_frames), int(device_frames['tsf_timestamp'][0]))
+    return res
+
+
+def _default_cache_dir(measurement_basedir: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(measurement_basedir)), '.cache')
+
+
+def convert_closed_segments(measurement_basedir: str,
+                            batch_size: int = 0x10000,
+                            cache_dir: Optional[str] = None,
+                            cache_max_bytes: int = 0x100000000,
+                            index_stride: int = 256) -> int:
+    """Parse the closed segments of a running capture ahead of convert_measurement
 
-    # Dump numpy array
-    for imu_id in all_measurement_np.keys():
-        np.savez(os.path.join(measurement_basedir, f'imu_{imu_id}.npz'), **all_measurement_np[imu_id])
+    Segments that are complete (see SegmentManifest.complete_paths) and not cached yet are parsed into the
+    conversion cache, so that convert_measurement only parses the last segment of every stream once the capture
+    stops. Frames straddling two segments are left to convert_measurement.
+
+    Args:
+        measurement_basedir (str): measurement directory being captured
+        batch_size (int): frames decoded per batch
+        cache_dir (str): conversion cache, defaults to the one of convert_measurement
+        cache_max_bytes (int): size limit of the conversion cache, 0 disables incremental conversion
+        index_stride (int): see convert_measurement
+
+    Returns:
+        int: number of segments parsed
+    """
+    if cache_max_bytes <= 0:
+        return 0
+    cache = ConversionCache(cache_dir if cache_dir is not None else _default_cache_dir(measurement_basedir), max_bytes=cache_max_bytes)
+    spool_dir = os.path.join(measurement_basedir, '.spool')
+    os.makedirs(spool_dir, exist_ok=True)
+
+    n_parsed = 0
+    for manifest in SegmentManifest.list(measurement_basedir):
+        for path in manifest.complete_paths():
+            if cache.get(path) is not None:
+                continue
+            pieces = _convert_file(path, spool_dir, batch_size, index_stride)
+            cache.put(path, pieces)
+            for piece in pieces.values():
+                os.remove(piece[0])
+            n_parsed += 1
+    if n_parsed > 0:
+        cache.save()
+    return n_parsed
+
+
+def _dump_device(imu_id: str, pieces: List[str], spool_dir: str, measurement_basedir: str) -> str:
+    """Merge the spooled pieces of one device, in tsf_timestamp order, and write imu_{id}.npz
+
+    Returns:
+        str: path to the merged spool file
+    """
+    if len(pieces) == 1:
+        merged = pieces[0]
+    else:
+        merged = os.path.join(spool_dir, f'imu_{imu_id}.frames')
+        with open(merged, 'wb') as dst:
+            for piece in pieces:
+                with open(piece, 'rb') as src:
+                    shutil.copyfileobj(src, dst, 0x100000)
+    frames = FrameLog.load(merged)
+    # Workers appending to the same frame log, or overlapping pieces, leave the frames out of order
+    if np.any(np.diff(frames['tsf_timestamp']) < 0):
+        frames = frames[np.argsort(frames['tsf_timestamp'], kind='stable')]
+        merged = os.path.join(spool_dir, f'imu_{imu_id}.sorted.frames')
+        frames.tofile(merged)
+        frames = FrameLog.load(merged)
+    np.savez(os.path.join(measurement_basedir, f'imu_{imu_id}.npz'), **frames_to_npz_dict(frames, imu_id))
+    return merged
+
+
+def convert_measurement(measurement_basedir: str,
+                        delete_dat: bool = False,
+                        batch_size: int = 0x10000,
+                        n_workers: Optional[int] = None,
+                        cache_dir: Optional[str] = None,
+                        cache_max_bytes: int = 0x100000000,
+                        index_stride: int = 256,
+                        align_n_workers: Optional[int] = None,
+                        align_pool: str = 'process',
+                        align_rate_hz: Optional[float] = None) -> Dict[str, Dict[str, np.ndarray]]:
+    """Convert raw recordings of a measurement to imu_{id}.npz, then align them
+
+    Args:
+        measurement_basedir (str): measurement directory holding process_{proc}_{fd}.dat files, or their
+            process_{proc}_{fd}.{k}.dat segments listed in process_{proc}_{fd}.segments.json
+        delete_dat (bool): remove .dat files once parsed, with their sidecars
+        batch_size (int): frames decoded per batch, bounds the memory of each worker
+        n_workers (int): size of the process pool, defaults to the number of cores, 1 disables the pool
+        cache_dir (str): conversion cache, defaults to .cache under the parent of measurement_basedir (base_dir)
+        cache_max_bytes (int): size limit of the conversion cache, 0 disables caching
+        index_stride (int): frames between two checkpoints of the seek indexes written for recordings that have
+            none, 0 disables indexing
+        align_n_workers (int): workers aligning devices in parallel, defaults to the number of cores
+        align_pool (str): 'process' or 'thread' pool for the alignment, see align_measurement
+        align_rate_hz (float): rate of the aligned output, defaults to the native rate of the master device
+
+    Returns:
+        Dict[str, Dict[str, np.ndarray]]: aligned fields of every device
+    """
+    _logger = logging.getLogger('convert_measurement')
+
+    filenames_list: List[str] = sorted(glob.glob(os.path.join(measurement_basedir, '*.dat')))
+    spool_dir = os.path.join(measurement_basedir, '.spool')
+    os.makedirs(spool_dir, exist_ok=True)
+
+    device_pieces: Dict[str, List[Tuple[str, int, int]]] = {}
+    parse_list: List[str] = filenames_list
+    frame_logs = FrameLog.list(measurement_basedir)
+    if len(frame_logs) > 0:
+        # Frames were decoded at ingest, only the finalize step is left
+        _logger.info(f"Found frame logs of {len(frame_logs)} client, skip parsing")
+        device_pieces = {imu_id: [(path, 0, 0)] for imu_id, path in frame_logs.items()}
+        parse_list = []
+
+    # Unchanged recordings are served from the conversion cache
+    cache: Optional[ConversionCache] = None
+    results: Dict[str, Dict[str, Tuple[str, int, int]]] = {}
+    if cache_max_bytes > 0 and len(parse_list) > 0:
+        if cache_dir is None:
+            cache_dir = _default_cache_dir(measurement_basedir)
+        cache = ConversionCache(cache_dir, max_bytes=cache_max_bytes)
+        for filename in parse_list:
+            cached = cache.get(filename)
+            if cached is not None:
+                results[filename] = cached
+        if len(results) > 0:
+            _logger.info(f"{len(results)} of {len(parse_list)} recordings are unchanged, skip parsing")
+        parse_list = [filename for filename in parse_list if filename not in results.keys()]
+
+    n_workers = min(os.cpu_count() if n_workers is None else n_workers, max(len(parse_list), len(device_pieces), 1))
+    executor = ProcessPoolExecutor(n_workers) if n_workers > 1 else None
+
+    # Scatter measurement point, each file is parsed by a worker and spooled to disk per device
+    try:
+        with tqdm.tqdm(total=len(parse_list)) as pbar:
+            if executor is not None:
+                futures = {filename: executor.submit(_convert_file, filename, spool_dir, batch_size, index_stride) for filename in parse_list}
+                for _ in as_completed(futures.values()):
+                    pbar.update()
+                parsed = {filename: future.result() for filename, future in futures.items()}
+            else:
+                parsed = {}
+                for filename in parse_list:
+                    parsed[filename] = _convert_file(filename, spool_dir, batch_size, index_stride)
+                    pbar.update()
+        if cache is not None:
+            for filename, result in parsed.items():
+                cache.put(filename, result)
+        results.update(parsed)
+        if len(results) > 0:
+            # Frames cut in half by segment rotation
+            for manifest in SegmentManifest.list(measurement_basedir):
+                paths = [path for path in manifest.paths if os.path.exists(path)]
+                for prev_path, next_path in zip(paths[:-1], paths[1:]):
+                    results[prev_path + '.boundary'] = _stitch_segments(prev_path, next_path, spool_dir)
+        for result in [results[filename] for filename in sorted(results.keys())]:
+            for imu_id, piece in result.items():
+                if imu_id not in device_pieces.keys():
+                    device_pieces[imu_id] = []
+                device_pieces[imu_id].append(piece)
+        _logger.info(f"Got measurement from {len(device_pieces)} client")
+
+        # Clean dat files
+        if delete_dat:
+            for filename in filenames_list:
+                os.remove(filename)
+                # Clock fits are still needed by the alignment, they go once it is done
+                if os.path.exists(SeekIndex.path_of(filename)):
+                    os.remove(SeekIndex.path_of(filename))
+            for manifest in SegmentManifest.list(measurement_basedir):
+                os.remove(manifest.path)
+
+        # Dump numpy array, pieces of a device (one per reconnect) are merged in time order
+        merged: Dict[str, str] = {}
+        dump_args = [
+            (imu_id, [piece[0] for piece in sorted(pieces, key=lambda x: x[2])], spool_dir, measurement_basedir)
+            for imu_id, pieces in device_pieces.items()
+        ]
+        if executor is not None:
+            futures = {args[0]: executor.submit(_dump_device, *args) for args in dump_args}
+            for imu_id, future in futures.items():
+                merged[imu_id] = future.result()
+        else:
+            for args in dump_args:
+                merged[args[0]] = _dump_device(*args)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    all_measurement_np: Dict[str, Dict[str, np.ndarray]] = {
+        imu_id: frames_to_npz_dict(FrameLog.load(path), imu_id) for imu_id, path in merged.items()
+    }
     """example
     >>> import numpy as np
     >>> npfile = np.load('./imu_mem_2021-10-21_211859/imu_84f7033b3e78.npz')
@@ -67,7 +328,14 @@ def convert_measurement(measurement_basedir: str, delete_dat: bool = False) -> D
           [1.63482235e+15]])
     """
 
-    interp_res = align_measurement(measurement_basedir)
+    interp_res = align_measurement(measurement_basedir, imu_device_id_mapping=all_measurement_np, n_workers=align_n_workers, pool=align_pool, rate_hz=align_rate_hz)
+    del all_measurement_np
+    shutil.rmtree(spool_dir)
+    if delete_dat:
+        for path in glob.glob(os.path.join(measurement_basedir, f'*{ClockModel.SUFFIX}')):
+            os.remove(path)
+    if cache is not None:
+        cache.save()
     return interp_res
 
 
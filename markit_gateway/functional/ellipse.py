@@ -2,70 +2,116 @@ import dataclasses
 from math import sqrt
 
 import numpy as np
-from scipy.optimize import root
-from typing import Tuple, Optional, List
+from typing import Tuple, Optional, List, Iterable
 
-@dataclasses.dataclass()
-class EllipseFitter:
+EllipseFitResult = Tuple[bool, Optional[List[float]], Optional[List[float]], Optional[float]]
 
-    @staticmethod
-    def fit(points: np.ndarray) -> Tuple[bool, Optional[List[float]],  Optional[List[float]], Optional[float]]:
-        """Fit an ellipse to points
-        Args:
-            points (np.ndarray): Points to fit
 
-        Returns:
-            EllipseFitter: Result of fitting
+class OnlineEllipseFitter:
+    """Axis-aligned ellipsoid fit kept as running sums, updated per sample or per batch
 
-        """
+    The ellipsoid x^2 + a y^2 + b z^2 + c x + d y + e z + f = 0 is fitted by least squares. With the feature vector
+    phi = [y^2, z^2, x, y, z, 1], the normal equations only need sum(phi phi^T) and sum(x^2 phi), so an update costs
+    O(1) per sample and solve() is a 6x6 linear solve whatever the number of samples.
+
+    Example:
+        >>> fitter = OnlineEllipseFitter()
+        >>> fitter.update(mag_batch)  # (N, 3)
+        >>> ret, pos, length, score = fitter.solve()
+    """
 
-        x: np.ndarray = points[:, 0]
-        y: np.ndarray = points[:, 1]
-        z: np.ndarray = points[:, 2]
+    def __init__(self):
+        self.n: int = 0
+        self.phi_phi: np.ndarray = np.zeros((6, 6), dtype=np.float64)
+        self.phi_xx: np.ndarray = np.zeros((6,), dtype=np.float64)
 
-        # Averages
-        x_avr, y_avr, z_avr = x.mean(), y.mean(), z.mean()
+    def __len__(self):
+        return self.n
 
-        xx_avr, yy_avr, zz_avr = (x ** 2).mean(), (y ** 2).mean(), (z ** 2).mean()
-        xy_avr, xz_avr, yz_avr = np.dot(x, y).mean(), np.dot(x, z).mean(), np.dot(y, z).mean()
+    @staticmethod
+    def _features(points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        x, y, z = points[:, 0], points[:, 1], points[:, 2]
+        return np.stack([y ** 2, z ** 2, x, y, z, np.ones_like(x)], axis=1), x ** 2
+
+    def update(self, points: np.ndarray):
+        """Add (3,) or (N, 3) points"""
+        phi, xx = self._features(points)
+        self.n += len(phi)
+        self.phi_phi += phi.T @ phi
+        self.phi_xx += phi.T @ xx
+
+    def merge(self, other: 'OnlineEllipseFitter'):
+        self.n += other.n
+        self.phi_phi += other.phi_phi
+        self.phi_xx += other.phi_xx
 
-        xxx_avr, xxy_avr, xxz_avr = (x ** 3).mean(), (x ** 2 * y).mean(), (x ** 2 * z).mean()
-        xyy_avr, xzz_avr, yyy_avr = (x * y ** 2).mean(), (x * z ** 2).mean(), (y ** 3).mean()
-        yyz_avr, yzz_avr, zzz_avr = (y ** 2 * z).mean(), (y * z ** 2).mean(), (z ** 3).mean()
+    @staticmethod
+    def _result(coefficients: Optional[np.ndarray]) -> EllipseFitResult:
+        if coefficients is None:
+            return False, None, None, None
+        a, b, c, d, e, f = coefficients
+        # NumPy scalars return inf/nan on a degenerate system instead of raising, make them raise
+        try:
+            with np.errstate(divide='raise', over='raise', invalid='raise'):
+                x0 = -c / 2  # X coordinate of the center
+                y0 = -d / (2 * a)  # Y coordinate of the center
+                z0 = -e / (2 * b)  # Z coordinate of the center
+                # X-axis length
+                A = sqrt(x0 * x0 + a * y0 * y0 + b * z0 * z0 - f)
+                # Y-axis length
+                B = A / sqrt(a)
+                # Z-axis length
+                C = A / sqrt(b)
+                score = float(np.sum(np.array([x0, y0, z0]) ** 2) + np.std([A, B, C]))
+        except (ValueError, ZeroDivisionError, OverflowError, FloatingPointError) as _:
+            return False, None, None, None
+        if not np.all(np.isfinite([x0, y0, z0, A, B, C, score])):
+            return False, None, None, None
+        pos = [float(x0), float(y0), float(z0)]
+        length = [A, B, C]
+        return True, pos, length, score
+
+    def solve(self) -> EllipseFitResult:
+        """Center, semi-axis lengths and score of the current fit, see EllipseFitter.fit"""
+        return self.solve_batch([self])[0]
+
+    @classmethod
+    def solve_batch(cls, fitters: Iterable['OnlineEllipseFitter']) -> List[EllipseFitResult]:
+        """Solve several fits, e.g. one per device, with a single batched np.linalg.solve"""
+        fitters = list(fitters)
+        if len(fitters) == 0:
+            return []
+        phi_phi = np.stack([fitter.phi_phi for fitter in fitters])
+        phi_xx = np.stack([fitter.phi_xx for fitter in fitters])
+        try:
+            coefficients = list(np.linalg.solve(phi_phi, -phi_xx[..., None])[..., 0])
+        except np.linalg.LinAlgError:
+            # Too few or degenerate samples in one of them, solve them one by one
+            coefficients = []
+            for lhs, rhs in zip(phi_phi, phi_xx):
+                try:
+                    coefficients.append(np.linalg.solve(lhs, -rhs))
+                except np.linalg.LinAlgError:
+                    coefficients.append(None)
+        return [cls._result(item) for item in coefficients]
 
-        yyyy_avr, zzzz_avr, xxyy_avr, xxzz_avr, yyzz_avr = (y ** 4).mean(), (z ** 4).mean(), (x ** 2 * y ** 2).mean(), (x ** 2 * z ** 2).mean(), (y ** 2 * z ** 2).mean()
 
-        # Coefficients of the characteristic polynomial
-        A_Matrix = np.array([[yyyy_avr, yyzz_avr, xyy_avr, yyy_avr, yyz_avr, yy_avr],
-                             [yyzz_avr, zzzz_avr, xzz_avr, yzz_avr, zzz_avr, zz_avr],
-                             [xyy_avr, xzz_avr, xx_avr, xy_avr, xz_avr, x_avr],
-                             [yyy_avr, yzz_avr, xy_avr, yy_avr, yz_avr, y_avr],
-                             [yyz_avr, zzz_avr, xz_avr, yz_avr, zz_avr, z_avr],
-                             [yy_avr, zz_avr, x_avr, y_avr, z_avr, 1]])
-        # Constant vector at right hand side
-        B_Matrix = np.array([[-xxyy_avr], [-xxzz_avr], [-xxx_avr], [-xxy_avr], [-xxz_avr], [-xx_avr]])
+@dataclasses.dataclass()
+class EllipseFitter:
 
-        # Solve A @ result = B
-        result: np.ndarray = root(lambda _x: np.squeeze(np.matmul(A_Matrix, np.expand_dims(_x, -1)) - B_Matrix), np.zeros(shape=(6,))).x
+    @staticmethod
+    def fit(points: np.ndarray, chunk_size: int = 0x10000) -> EllipseFitResult:
+        """Fit an ellipse to points
+        Args:
+            points (np.ndarray): Points to fit, shape (N, 3)
+            chunk_size (int): points read at a time, points may be memory-mapped
 
-        x0 = -result[2] / 2  # X coordinate of the center
-        y0 = -result[3] / (2 * result[0])  # Y coordinate of the center
-        z0 = -result[4] / (2 * result[1])  # Z coordinate of the center
+        Returns:
+            EllipseFitter: Result of fitting
 
-        # Get the length of the semi-major axis
-        try:
-            # X-axis length
-            A = sqrt(x0 * x0 + result[0] * y0 * y0 + result[1] * z0 * z0 - result[5])
-            # Y-axis length
-            B = A / sqrt(result[0])
-            # Z-axis length
-            C = A / sqrt(result[1])
-
-            ret = True
-            pos = [x0, y0, z0]
-            length = [A, B, C]
-            score = np.sum(np.array(pos) ** 2) + np.std(length)
-            return ret, pos, length, score
-
-        except ValueError as _:
-            return False, None, None, None
+        """
+        fitter = OnlineEllipseFitter()
+        for start in range(0, len(points), chunk_size):
+            fitter.update(points[start:start + chunk_size])
+        return fitter.solve()
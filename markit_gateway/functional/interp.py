@@ -0,0 +1,101 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+
+class SharedIndexInterpolator:
+    """Interpolation from one source timeline to one target timeline, with the search done once
+
+    The bracketing source samples and the weights of every target time are computed in __init__, every
+    channel of the device then reuses them: linear channels are interpolated as a single (N, C) array and
+    quaternions are slerped over the same brackets. Target times outside of the source range are clamped to
+    the first / last sample, like np.interp does.
+
+    Args:
+        src_t (np.ndarray): source timestamps, non-decreasing, shape (N,)
+        dst_t (np.ndarray): target timestamps, shape (M,)
+    """
+
+    def __init__(self, src_t: np.ndarray, dst_t: np.ndarray):
+        src_t = np.asarray(src_t).reshape(-1)
+        dst_t = np.asarray(dst_t).reshape(-1)
+        if len(src_t) == 0:
+            raise ValueError("source timeline is empty")
+        if len(src_t) == 1:
+            self.lo = np.zeros(len(dst_t), dtype=np.int64)
+            self.hi = self.lo
+            self.weight = np.zeros(len(dst_t), dtype=np.float64)
+            return
+
+        self.lo = np.clip(np.searchsorted(src_t, dst_t, side='right') - 1, 0, len(src_t) - 2)
+        self.hi = self.lo + 1
+        t_lo = src_t[self.lo]
+        span = (src_t[self.hi] - t_lo).astype(np.float64)
+        # Repeated source timestamps give an empty bracket, its upper sample is taken like np.interp does
+        self.weight = np.clip(np.divide(dst_t - t_lo, span, out=np.ones_like(span), where=span > 0), 0., 1.)
+
+    def __len__(self):
+        return len(self.weight)
+
+    def linear(self, values: np.ndarray, taps: Optional[np.ndarray] = None) -> np.ndarray:
+        """Linear interpolation of (N,) or (N, C) values, returns float64 of shape (M,) or (M, C)
+
+        With taps, values are low-pass filtered first by a zero-phase FIR of odd length. The filter is only
+        evaluated at the bracketing samples, never over the whole source, and the edges are padded with the
+        first / last value.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        w = self.weight if values.ndim == 1 else self.weight[:, None]
+        if taps is None:
+            v_lo, v_hi = values[self.lo], values[self.hi]
+        else:
+            v_lo, v_hi = self._filter_brackets(values, taps)
+        return v_lo + w * (v_hi - v_lo)
+
+    def _filter_brackets(self, values: np.ndarray, taps: np.ndarray, block_size: int = 0x1000) -> Tuple[np.ndarray, np.ndarray]:
+        n, width = len(values), len(taps) + 1
+        # Channels first, so that the source samples around every bracket are contiguous
+        channels = np.ascontiguousarray(np.atleast_2d(values.T))
+        # lo and hi = lo + 1 share all but one sample of their neighbourhood, one gather and one product serve both
+        pair = np.zeros((width, 2), dtype=np.float64)
+        pair[:-1, 0] = taps
+        pair[1:, 1] = taps
+        first = self.lo - len(taps) // 2
+        inner = (first >= 0) & (first + width <= n)
+        windows = np.lib.stride_tricks.sliding_window_view(channels, min(width, n), axis=1)
+
+        res = np.empty((len(channels), len(self.lo), 2), dtype=np.float64)
+        for start in range(0, len(self.lo), block_size):
+            stop = min(start + block_size, len(self.lo))
+            if inner[start:stop].all():
+                block = windows[:, first[start:stop]]
+            else:
+                # Near the ends of the source, missing samples repeat the first / last one
+                block = channels[:, np.clip(first[start:stop, None] + np.arange(width), 0, n - 1)]
+            res[:, start:stop] = block @ pair
+        if values.ndim == 1:
+            return res[0, :, 0], res[0, :, 1]
+        return res[..., 0].T, res[..., 1].T
+
+    def slerp(self, quat: np.ndarray) -> np.ndarray:
+        """Spherical linear interpolation of unit quaternions of shape (N, 4), along the shortest arc
+
+        The component order is kept, e.g. scalar-last (x, y, z, w) in and out.
+        """
+        quat = np.asarray(quat, dtype=np.float64)
+        quat = quat / np.linalg.norm(quat, axis=1, keepdims=True)
+        q_lo = quat[self.lo]
+        q_hi = quat[self.hi]
+        dot = np.einsum('ij,ij->i', q_lo, q_hi)
+        # q and -q are the same rotation, take the short way
+        q_hi = np.where((dot < 0)[:, None], -q_hi, q_hi)
+        dot = np.abs(dot)
+
+        theta = np.arccos(np.clip(dot, -1., 1.))
+        sin_theta = np.sin(theta)
+        near = sin_theta < 1e-6
+        safe_sin = np.where(near, 1., sin_theta)
+        w_lo = np.where(near, 1. - self.weight, np.sin((1. - self.weight) * theta) / safe_sin)
+        w_hi = np.where(near, self.weight, np.sin(self.weight * theta) / safe_sin)
+        res = w_lo[:, None] * q_lo + w_hi[:, None] * q_hi
+        return res / np.linalg.norm(res, axis=1, keepdims=True)
@@ -0,0 +1,183 @@
+import logging
+from typing import Dict, Optional, Any
+
+import numpy as np
+
+from markit_gateway.common import IMUParser, ClockModel
+from markit_gateway.functional.align import interpolate_device
+from markit_gateway.functional.vector import FrameBatch, group_by_device
+
+
+class LiveAligner:
+    """Align frames of several devices while they arrive, on a fixed output grid of the tsf_timestamp clock
+
+    Every device keeps a short jitter buffer of recent frames. A grid time t is emitted as soon as every device
+    has a frame at or after t, or at the latest once its deadline (the host time at which t is expected to be
+    received, plus max_delay_us) has passed. In the latter case devices without data are held at their last
+    sample and flagged as stale, so the output latency stays bounded even if one device stalls. Interpolation is
+    the same as align_measurement, see interpolate_device.
+
+    Grid times are also converted to global timestamps with the running clock fits of the devices in the stream,
+    averaged like align_measurement does.
+
+    Latency of a sample is the host time of emission minus the host arrival time of the frame that completed it.
+
+    Args:
+        rate_hz (float): output rate
+        max_delay_us (int): longest time a grid point waits for late devices
+        device_timeout_us (int): devices silent for this long are dropped from the output
+        n_latency_samples (int): size of the rolling window used for latency percentiles
+    """
+    ARRIVAL_DTYPE = np.dtype([('frame', IMUParser.FRAME_DTYPE), ('arrival_us', np.int64)])
+    OFFSET_WINDOW_US: int = 5_000_000
+
+    def __init__(self,
+                 rate_hz: float = 100.,
+                 max_delay_us: int = 50_000,
+                 device_timeout_us: int = 1_000_000,
+                 n_latency_samples: int = 0x1000):
+        self.period_us = max(int(round(1e6 / rate_hz)), 1)
+        self.max_delay_us = max_delay_us
+        self.device_timeout_us = device_timeout_us
+
+        self.buffers: Dict[str, FrameBatch] = {}
+        self.clocks: Dict[str, ClockModel] = {}
+        self.next_t: Optional[int] = None
+
+        # Host clock - tsf clock, minimum over a sliding window filters out network delay
+        self.clock_offset_us: Optional[int] = None
+        self._offset_min: Optional[int] = None
+        self._offset_window_start: int = 0
+
+        self._latency = np.zeros((max(n_latency_samples, 1),), dtype=np.int64)
+        self._n_latency: int = 0
+        self.n_emitted: int = 0
+        self.n_stale: int = 0
+        self.n_late_frames: int = 0
+
+        self.logger = logging.getLogger('live_aligner')
+
+    def push(self, frames: np.ndarray, arrival_us: int):
+        """Add decoded frames of any devices
+
+        Args:
+            frames (np.ndarray): structured array of IMUParser.FRAME_DTYPE
+            arrival_us (int): host time at which the frames were received
+        """
+        for imu_id, device_frames in group_by_device(frames).items():
+            if imu_id not in self.buffers.keys():
+                self.buffers[imu_id] = FrameBatch(0x400, dtype=self.ARRIVAL_DTYPE)
+                self.clocks.setdefault(imu_id, ClockModel(imu_id))
+                self.logger.info(f"device {imu_id} joined the live stream")
+            buffer = self.buffers[imu_id]
+
+            # Keep the source timeline strictly increasing, duplicates and reordered frames are dropped
+            tsf = device_frames['tsf_timestamp']
+            last_tsf = buffer['frame']['tsf_timestamp'][-1] if len(buffer) > 0 else np.iinfo(np.int64).min
+            keep = tsf > np.maximum.accumulate(np.concatenate([[last_tsf], tsf[:-1]]))
+            if self.next_t is not None:
+                late = tsf < self.next_t - self.period_us
+                self.n_late_frames += int(np.count_nonzero(late & keep))
+            device_frames = device_frames[keep]
+            if len(device_frames) == 0:
+                continue
+
+            self.clocks[imu_id].update(device_frames['tsf_timestamp'], device_frames['timestamp'])
+            records = np.empty((len(device_frames),), dtype=self.ARRIVAL_DTYPE)
+            records['frame'] = device_frames
+            records['arrival_us'] = arrival_us
+            buffer.append(records)
+            self._update_clock_offset(arrival_us - int(device_frames['tsf_timestamp'][-1]), arrival_us)
+
+    def _update_clock_offset(self, offset_us: int, now_us: int):
+        self._offset_min = offset_us if self._offset_min is None else min(self._offset_min, offset_us)
+        self.clock_offset_us = self._offset_min if self.clock_offset_us is None else min(self.clock_offset_us, self._offset_min)
+        if now_us - self._offset_window_start > self.OFFSET_WINDOW_US:
+            # Start a new window so that drift between the clocks is followed
+            self.clock_offset_us = self._offset_min
+            self._offset_min = None
+            self._offset_window_start = now_us
+
+    def _drop_silent_devices(self, now_us: int):
+        for imu_id in list(self.buffers.keys()):
+            buffer = self.buffers[imu_id]
+            if len(buffer) == 0 or now_us - buffer['arrival_us'][-1] > self.device_timeout_us:
+                self.logger.info(f"device {imu_id} left the live stream")
+                del self.buffers[imu_id]
+        if len(self.buffers) == 0:
+            self.next_t = None
+
+    def poll(self, now_us: int) -> Optional[Dict[str, Any]]:
+        """Emit every grid point that is ready at host time now_us
+
+        Returns:
+            Optional[Dict[str, Any]]: None if nothing is ready, otherwise::
+
+                {
+                    'tsf_timestamp': (M,) int64 grid times,
+                    'timestamp': (M,) int64 global timestamps of the grid times,
+                    'arrival_us': (M,) int64 host arrival time of the frame that completed each sample,
+                    'emit_us': host time of emission,
+                    'devices': {device_id: {'accel': (M, 3), 'gyro', 'mag', 'quat', 'euler', 'stale': (M,) bool}},
+                }
+        """
+        self._drop_silent_devices(now_us)
+        if len(self.buffers) == 0 or self.clock_offset_us is None:
+            return None
+
+        latest = {imu_id: int(buffer['frame']['tsf_timestamp'][-1]) for imu_id, buffer in self.buffers.items()}
+        if self.next_t is None:
+            first = max(int(buffer['frame']['tsf_timestamp'][0]) for buffer in self.buffers.values())
+            self.next_t = -(-first // self.period_us) * self.period_us
+
+        # Complete for every device, or past the deadline
+        horizon = max(min(latest.values()), now_us - self.clock_offset_us - self.max_delay_us)
+        if horizon < self.next_t:
+            return None
+        t = np.arange(self.next_t, horizon + 1, self.period_us, dtype=np.int64)
+
+        res = {'tsf_timestamp': t, 'timestamp': ClockModel.average([self.clocks[imu_id] for imu_id in self.buffers.keys()], t), 'devices': {}}
+        arrival_us = np.zeros_like(t)
+        stale_any = np.zeros(len(t), dtype=bool)
+        for imu_id, buffer in self.buffers.items():
+            frames = buffer['frame']
+            src_t = frames['tsf_timestamp']
+            res['devices'][imu_id] = interpolate_device(frames, src_t, t)
+
+            stale = (t > latest[imu_id]) | (t < src_t[0])
+            res['devices'][imu_id]['stale'] = stale
+            stale_any |= stale
+            hi = np.minimum(np.searchsorted(src_t, t, side='left'), len(src_t) - 1)
+            arrival_us = np.maximum(arrival_us, np.where(stale, 0, buffer['arrival_us'][hi]))
+
+        # A stale sample was completed by its deadline rather than by a frame
+        arrival_us = np.where(stale_any, t + self.clock_offset_us, arrival_us)
+        res['arrival_us'] = arrival_us
+        res['emit_us'] = now_us
+        self._record_latency(now_us - arrival_us)
+        self.n_emitted += len(t)
+        self.n_stale += int(np.count_nonzero(stale_any))
+
+        # Only the frame right before the next grid point is still needed
+        self.next_t = int(t[-1]) + self.period_us
+        for buffer in self.buffers.values():
+            buffer.discard(int(np.searchsorted(buffer['frame']['tsf_timestamp'], self.next_t, side='right')) - 1)
+        return res
+
+    def _record_latency(self, latency_us: np.ndarray):
+        latency_us = latency_us[-len(self._latency):]
+        idx = (self._n_latency + np.arange(len(latency_us))) % len(self._latency)
+        self._latency[idx] = latency_us
+        self._n_latency += len(latency_us)
+
+    def stats(self) -> Dict[str, Any]:
+        latency = self._latency[:min(self._n_latency, len(self._latency))]
+        return {
+            'n_devices': len(self.buffers),
+            'n_emitted': self.n_emitted,
+            'n_stale': self.n_stale,
+            'n_late_frames': self.n_late_frames,
+            'clock_offset_us': self.clock_offset_us,
+            'latency_p50_us': float(np.percentile(latency, 50)) if len(latency) > 0 else None,
+            'latency_p99_us': float(np.percentile(latency, 99)) if len(latency) > 0 else None,
+        }
@@ -0,0 +1,153 @@
+import json
+import os
+from typing import Dict, List, Optional, Any, Tuple, Iterable
+
+import numpy as np
+
+ALIGNED_STORE_NAME: str = 'imu_aligned'
+
+
+class AlignedStoreWriter:
+    """Write aligned data as one .npy per device/field, chunk by chunk along the time axis
+
+    Layout::
+
+        imu_aligned/
+            manifest.json
+            timestamp.npy
+            tsf_timestamp.npy
+            {device_id}/{field}.npy
+
+    The shared master timeline is stored once at the root. Files are preallocated with np.lib.format.open_memmap,
+    so every chunk is written in place and nothing is pickled.
+    """
+    TIMELINE_FIELDS: Tuple[str] = ('timestamp', 'tsf_timestamp')
+
+    def __init__(self,
+                 path: str,
+                 n_samples: int,
+                 device_ids: List[str],
+                 fields: Dict[str, Tuple[Tuple[int, ...], Any]],
+                 meta: Dict[str, Any] = None):
+        """
+        Args:
+            path (str): store directory
+            n_samples (int): length of the master timeline
+            device_ids (List[str]): devices in the store
+            fields (Dict[str, Tuple[Tuple[int, ...], Any]]): field -> (trailing shape, dtype)
+            meta (Dict[str, Any]): extra json-serializable information kept in the manifest
+        """
+        self.path = path
+        self.n_samples = n_samples
+        self.device_ids = list(device_ids)
+        self.fields = fields
+        self.meta = meta if meta is not None else {}
+        self.chunks: List[List[int]] = []
+
+        os.makedirs(path, exist_ok=True)
+        self._timeline: Dict[str, np.memmap] = {
+            name: np.lib.format.open_memmap(os.path.join(path, f'{name}.npy'), mode='w+', dtype=np.int64, shape=(n_samples,))
+            for name in self.TIMELINE_FIELDS
+        }
+        self._arrays: Dict[str, Dict[str, np.memmap]] = {}
+        for device_id in self.device_ids:
+            os.makedirs(os.path.join(path, device_id), exist_ok=True)
+            self._arrays[device_id] = {
+                field: np.lib.format.open_memmap(os.path.join(path, device_id, f'{field}.npy'), mode='w+', dtype=dtype, shape=(n_samples, *shape))
+                for field, (shape, dtype) in fields.items()
+            }
+
+    def write_timeline(self, start: int, **timeline: np.ndarray):
+        for name, value in timeline.items():
+            self._timeline[name][start:start + len(value)] = value
+
+    def write(self, device_id: str, start: int, **fields: np.ndarray):
+        for field, value in fields.items():
+            self._arrays[device_id][field][start:start + len(value)] = value
+
+    def read(self, device_id: str, field: str) -> np.ndarray:
+        """Memory-mapped view of what has been written so far"""
+        return self._arrays[device_id][field]
+
+    def flush(self):
+        for array in self._timeline.values():
+            array.flush()
+        for arrays in self._arrays.values():
+            for array in arrays.values():
+                array.flush()
+
+    @staticmethod
+    def attach(path: str, device_id: str, fields: Iterable[str]) -> Dict[str, np.memmap]:
+        """Writable maps of some fields of a device in a store being written, e.g. from a worker process"""
+        return {field: np.load(os.path.join(path, device_id, f'{field}.npy'), mmap_mode='r+') for field in fields}
+
+    def commit_chunk(self, start: int, stop: int):
+        """Record that samples [start, stop) of every device are written"""
+        self.chunks.append([int(start), int(stop)])
+
+    def close(self):
+        self.flush()
+        manifest = {
+            'version': 1,
+            'n_samples': self.n_samples,
+            'devices': self.device_ids,
+            'timeline': list(self.TIMELINE_FIELDS),
+            'fields': {field: {'shape': list(shape), 'dtype': np.dtype(dtype).str} for field, (shape, dtype) in self.fields.items()},
+            'chunks': self.chunks,
+            'meta': self.meta,
+        }
+        with open(os.path.join(self.path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=4)
+        self._timeline = {}
+        self._arrays = {}
+
+
+class AlignedStore:
+    """Read-only view of an aligned store, every array is opened with mmap_mode='r'
+
+    Example:
+        >>> store = AlignedStore('./imu_data/imu_mem_2023-04-18_193003/imu_aligned')
+        >>> window = store.slice(t_start, t_end, device_ids=['84f7033b3e78'])
+        >>> window['84f7033b3e78']['quat'].shape
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json')) as f:
+            self.manifest: Dict[str, Any] = json.load(f)
+        self.device_ids: List[str] = self.manifest['devices']
+        self.fields: List[str] = list(self.manifest['fields'].keys())
+        self.timeline: Dict[str, np.ndarray] = {
+            name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in self.manifest['timeline']
+        }
+
+    def __len__(self):
+        return self.manifest['n_samples']
+
+    def device(self, device_id: str, fields: Optional[Iterable[str]] = None) -> Dict[str, np.ndarray]:
+        fields = self.fields if fields is None else fields
+        res = {field: np.load(os.path.join(self.path, device_id, f'{field}.npy'), mmap_mode='r') for field in fields}
+        res.update(self.timeline)
+        return res
+
+    def index_range(self, t_start: int, t_end: int, method: str = 'timestamp') -> Tuple[int, int]:
+        """Sample range covering t_start <= t < t_end on the given timeline"""
+        timeline = self.timeline[method]
+        return int(np.searchsorted(timeline, t_start, side='left')), int(np.searchsorted(timeline, t_end, side='left'))
+
+    def slice(self,
+              t_start: int,
+              t_end: int,
+              device_ids: Optional[Iterable[str]] = None,
+              fields: Optional[Iterable[str]] = None,
+              method: str = 'timestamp') -> Dict[str, Dict[str, np.ndarray]]:
+        """Aligned data of some devices within [t_start, t_end), only the selected range is read from disk"""
+        start, stop = self.index_range(t_start, t_end, method)
+        device_ids = self.device_ids if device_ids is None else device_ids
+        return {
+            device_id: {field: value[start:stop] for field, value in self.device(device_id, fields).items()} for device_id in device_ids
+        }
+
+    def load_all(self) -> Dict[str, Dict[str, np.ndarray]]:
+        """Everything in memory, laid out like the former imu.pkl"""
+        return {device_id: {field: np.array(value) for field, value in self.device(device_id).items()} for device_id in self.device_ids}
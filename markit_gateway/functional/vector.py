@@ -1,7 +1,9 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable
 
 import numpy as np
 
+from markit_gateway.common import IMUParser
+
 
 def vectorize_to_np(record_list: List[Dict[str, Any]], keys: List[str]) -> Dict[str, np.ndarray]:
     """Vectorizing record
@@ -26,3 +28,81 @@ def vectorize_to_np(record_list: List[Dict[str, Any]], keys: List[str]) -> Dict[
             raise ValueError("Not every attribute has the same length")
 
     return res
+
+
+def group_by_device(frames: np.ndarray) -> Dict[str, np.ndarray]:
+    """Split frames by the 12-byte device id
+
+    One stable sort on the device index keeps the arrival order inside every group.
+
+    Args:
+        frames (np.ndarray): structured array of IMUParser.FRAME_DTYPE
+
+    Returns:
+        Dict[str, np.ndarray]: device id -> structured array of that device's frames
+    """
+    if len(frames) == 0:
+        return {}
+    device_ids, inverse = np.unique(frames['id'], return_inverse=True)
+    if len(device_ids) == 1:
+        return {device_ids[0].decode('latin-1'): frames}
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.searchsorted(inverse[order], np.arange(len(device_ids) + 1))
+    grouped = frames[order]
+    return {
+        device_id.decode('latin-1'): grouped[bounds[idx]:bounds[idx + 1]] for idx, device_id in enumerate(device_ids)
+    }
+
+
+class FrameBatch:
+    """Growable columnar container of decoded frames
+
+    Frames are kept in one structured array of IMUParser.FRAME_DTYPE whose capacity doubles when full, so
+    appending parser batches is amortized O(1) per frame and every field is a zero-copy column view.
+    """
+
+    def __init__(self, capacity: int = 0x1000, dtype: np.dtype = IMUParser.FRAME_DTYPE):
+        self._data: np.ndarray = np.empty((max(capacity, 1),), dtype=dtype)
+        self._size: int = 0
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, key: str) -> np.ndarray:
+        return self.data[key]
+
+    @property
+    def data(self) -> np.ndarray:
+        return self._data[:self._size]
+
+    @classmethod
+    def concatenate(cls, batches: Iterable[np.ndarray]) -> 'FrameBatch':
+        res = cls()
+        for frames in batches:
+            res.append(frames)
+        return res
+
+    def append(self, frames: np.ndarray):
+        n = len(frames)
+        if self._size + n > len(self._data):
+            capacity = len(self._data)
+            while capacity < self._size + n:
+                capacity *= 2
+            data = np.empty((capacity,), dtype=self._data.dtype)
+            data[:self._size] = self._data[:self._size]
+            self._data = data
+        self._data[self._size:self._size + n] = frames
+        self._size += n
+
+    def clear(self):
+        self._size = 0
+
+    def discard(self, n: int):
+        """Drop the n oldest frames, the rest is moved to the front"""
+        n = min(max(n, 0), self._size)
+        if n > 0:
+            self._data[:self._size - n] = self._data[n:self._size]
+            self._size -= n
+
+    def group_by_device(self) -> Dict[str, np.ndarray]:
+        return group_by_device(self.data)
@@ -1,4 +1,5 @@
 import argparse
+import copy
 import logging
 import multiprocessing as mp
 import os.path
@@ -8,15 +9,15 @@ import signal
 import threading
 import time
 from datetime import datetime
-from typing import Optional
+from typing import Optional, Dict
 
 from rich.console import Console
 
 import cmd
 from markit_gateway.cmd import control_from_keyboard, portal, easy_setup
-from markit_gateway.common import IMUConnection
+from markit_gateway.common import IMUConnection, LiveSubscriber
 from markit_gateway.config import BrokerConfig
-from markit_gateway.functional import convert_measurement
+from markit_gateway.functional import convert_measurement, OnlineEllipseFitter
 from markit_gateway.tasks import measure
 
 
@@ -65,7 +66,11 @@ class IMUConsole(cmd.Cmd):
 
         # Convert
         try:
-            convert_measurement(osp.join(self.option.base_dir, tag))
+            convert_measurement(osp.join(self.option.base_dir, tag), cache_max_bytes=self.option.cache_max_bytes,
+                                index_stride=self.option.index_stride,
+                                align_n_workers=self.option.align_n_workers or None,
+                                align_pool=self.option.align_pool,
+                                align_rate_hz=self.option.align_rate_hz or None)
         except Exception as e:
             self.console.log(e, style="red")
 
@@ -75,8 +80,9 @@ class IMUConsole(cmd.Cmd):
 
         signal_stop = mp.Event()
         signal_stop.clear()
-        tmp_option = self.option
+        tmp_option = copy.copy(self.option)
         tmp_option.enable_gui = True
+        tmp_option.live_enable = True  # magnetometer samples for the running fit
         client_info_queue = mp.Queue()
         p = mp.Process(None,
                        measure,
@@ -115,6 +121,37 @@ class IMUConsole(cmd.Cmd):
         trigger = threading.Thread(target=trigger_imu, args=(client_info_queue,))
         trigger.start()
 
+        fitters: Dict[str, OnlineEllipseFitter] = {}
+
+        def fit_magnetometer(report_interval_s: float = 2.):
+            # Each batch only updates the running moments, the fits are solved at report time
+            sub: Optional[LiveSubscriber] = None
+            last_report_time = time.time()
+            while not signal_stop.is_set():
+                try:
+                    if sub is None:
+                        sub = LiveSubscriber(('127.0.0.1', tmp_option.live_port))
+                    msg = sub.recv(timeout=0.5)
+                except (ConnectionRefusedError, EOFError, OSError):
+                    sub = None
+                    time.sleep(0.5)
+                    continue
+                if msg is not None:
+                    for device_id, fields in msg['devices'].items():
+                        if device_id not in fitters.keys():
+                            fitters[device_id] = OnlineEllipseFitter()
+                        fitters[device_id].update(fields['mag'][~fields['stale']])
+                if time.time() - last_report_time > report_interval_s and len(fitters) > 0:
+                    for device_id, (ret, pos, length, score) in zip(fitters.keys(), OnlineEllipseFitter.solve_batch(fitters.values())):
+                        if ret:
+                            self.console.log(f"{device_id}: n={len(fitters[device_id])}, center={[round(v, 3) for v in pos]}, axes={[round(v, 3) for v in length]}, score={score:.3f}")
+                    last_report_time = time.time()
+            if sub is not None:
+                sub.close()
+
+        fitter_thread = threading.Thread(target=fit_magnetometer, daemon=True)
+        fitter_thread.start()
+
         try:
             self.console.input("Press \\[enter] to stop calibration \n")
         except KeyboardInterrupt:
@@ -123,6 +160,9 @@ class IMUConsole(cmd.Cmd):
         signal_stop.set()
         client_info_queue.put(None)
         trigger.join(timeout=5)
+        fitter_thread.join(timeout=5)
+        for device_id, res in zip(fitters.keys(), OnlineEllipseFitter.solve_batch(fitters.values())):
+            self.console.log(f"{device_id}: {res}")
         p.join(timeout=5)
         if p.is_alive():
             self.console.log("calibration process is still alive, killing it")
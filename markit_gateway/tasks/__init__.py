@@ -1,4 +1,6 @@
 from .imu_render_ui import imu_render_ui_task
+from .live_align import live_align_task
 from .measure import measure
+from .segment_convert import segment_convert_task
 from .tcp_listen import tcp_listen_task
 from .tcp_process import tcp_process_task
@@ -10,6 +10,8 @@ import numpy as np
 import tqdm
 import vtk
 
+from markit_gateway.common import StateTable
+
 
 def init_canvas(title: str = "IMU", resolution: Tuple[int] = (960, 540)):
     # 渲染（将执行单元和背景组合在一起按照某个视角绘制）
@@ -63,9 +65,9 @@ class IMUAxisActorBundle:
 
 
 class vtkTimerCallback:
-    def __init__(self, renderer, in_queue: mp.Queue = None, stop_ev: mp.Event = None):
+    def __init__(self, renderer, state_table: StateTable = None, stop_ev: mp.Event = None):
         self.renderer = renderer
-        self.in_queue = in_queue
+        self.state_table = state_table
         self.stop_ev: Optional[mp.Event] = stop_ev
 
         self.imu_actors: Dict[str, IMUAxisActorBundle] = {}
@@ -111,11 +113,9 @@ class vtkTimerCallback:
 
     def execute(self, obj, event):
 
-        count = 0
-        while self.in_queue.qsize() > 100 and count < 10:
-            imu_dict = self.in_queue.get()
+        # Only the latest state of each device matters for the pose
+        for imu_dict in self.state_table.snapshot().values():
             self._decode_imu_state_dict(imu_dict)
-            count += 1
 
         for actor_id, actor in self.imu_actors.items():
             actor.x_actor.SetOrientation(0, 0, 0)
@@ -148,7 +148,7 @@ class vtkTimerCallback:
         #     self.pbar.update(100)
 
 
-def keyboard_interact_task(imu_id: str, q: mp.Queue):
+def keyboard_interact_task(imu_id: str, state_table: StateTable):
     while True:
         time.sleep(0.05)
         imu_data_dict = {
@@ -158,19 +158,19 @@ def keyboard_interact_task(imu_id: str, q: mp.Queue):
             "quat_z": 0 + random.random() * 0.03,
             "id": imu_id
         }
-        q.put(imu_data_dict)
+        state_table.write(imu_data_dict)
 
 
 def imu_render_ui_task(stop_ev: mp.Event,
                        finish_ev: mp.Event,
-                       q: mp.Queue):
+                       state_table: StateTable):
     if stop_ev.is_set():
         return
 
     renderer, _, interactor = init_canvas()
 
     # Add callback
-    cb = vtkTimerCallback(renderer, q)
+    cb = vtkTimerCallback(renderer, state_table)
     interactor.AddObserver('TimerEvent', cb.execute)
 
     try:
@@ -189,25 +189,26 @@ def imu_render_ui_task(stop_ev: mp.Event,
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
 
-    shared_queue = mp.Queue(maxsize=100)
+    state_table = StateTable()
     stop_ev = mp.Event()
     finish_ev = mp.Event()
 
     keyboard_process_1 = mp.Process(None, keyboard_interact_task, "keyboard_interact_task_1",
-                                    ('test1', shared_queue,))
+                                    ('test1', state_table,))
     keyboard_process_1.start()
 
     render_process = mp.Process(None, imu_render_ui_task, "render_task",
-                                (stop_ev, finish_ev, shared_queue,))
+                                (stop_ev, finish_ev, state_table,))
     render_process.start()
 
     time.sleep(10)
 
     keyboard_process_2 = mp.Process(None, keyboard_interact_task, "keyboard_interact_task_2",
-                                    ('test2', shared_queue,))
+                                    ('test2', state_table,))
     keyboard_process_2.start()
 
     finish_ev.wait()
     keyboard_process_2.kill()
     keyboard_process_1.kill()
+    state_table.unlink()
     logging.info('finished')
@@ -0,0 +1,117 @@
+import logging
+import multiprocessing as mp
+import queue
+import socket
+import threading
+import time
+from multiprocessing.connection import Listener, Connection
+from typing import List, Tuple
+
+import numpy as np
+
+from markit_gateway.common import IMUParser
+from markit_gateway.config import BrokerConfig
+from markit_gateway.functional.live import LiveAligner
+
+
+class _Subscriber:
+    """One subscriber connection, served by its own thread so a slow reader only loses its own messages"""
+
+    def __init__(self, conn: Connection, max_pending: int = 0x100):
+        self.conn = conn
+        # Batches are small and frequent, Nagle's algorithm would hold them back for tens of milliseconds
+        with socket.fromfd(conn.fileno(), socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.pending: queue.Queue = queue.Queue(maxsize=max_pending)
+        self.alive = True
+        self.n_dropped = 0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def put(self, msg):
+        try:
+            self.pending.put_nowait(msg)
+        except queue.Full:
+            self.n_dropped += 1
+
+    def _run(self):
+        while self.alive:
+            msg = self.pending.get()
+            if msg is None:
+                break
+            try:
+                self.conn.send(msg)
+            except (OSError, EOFError, BrokenPipeError):
+                self.alive = False
+        self.conn.close()
+
+    def close(self):
+        self.alive = False
+        try:
+            self.pending.put_nowait(None)
+        except queue.Full:
+            pass
+
+
+def live_align_task(config: BrokerConfig,
+                    frame_queue: mp.Queue,
+                    stop_ev: mp.Event):
+    """Align the frames decoded by all tcp_process_task workers on the fly and publish them to local subscribers
+
+    Workers put (arrival_us, raw frames) tuples on frame_queue. Aligned batches are published through a
+    multiprocessing.connection.Listener on 127.0.0.1:live_port, see LiveSubscriber.
+    """
+    _logger = logging.getLogger('live_align_task')
+    _logger.setLevel(logging.DEBUG) if config.debug else _logger.setLevel(logging.INFO)
+
+    aligner = LiveAligner(rate_hz=config.live_rate_hz, max_delay_us=int(config.live_max_delay_ms * 1e3))
+    period_s = aligner.period_us / 1e6
+
+    listener = Listener(('127.0.0.1', config.live_port))
+    subscribers: List[_Subscriber] = []
+    subscribers_lock = threading.Lock()
+    _logger.info(f"publishing aligned frames at {config.live_rate_hz} Hz on 127.0.0.1:{config.live_port}")
+
+    def accept():
+        while not stop_ev.is_set():
+            try:
+                conn = listener.accept()
+            except OSError:
+                return
+            _logger.info(f"new subscriber {listener.last_accepted}")
+            with subscribers_lock:
+                subscribers.append(_Subscriber(conn))
+
+    threading.Thread(target=accept, daemon=True).start()
+
+    last_stats_time = time.time()
+    try:
+        while not stop_ev.is_set():
+            # Wake up for new frames, or at the next output tick to honour deadlines
+            batches: List[Tuple[int, bytes]] = []
+            try:
+                batches.append(frame_queue.get(timeout=period_s))
+                while True:
+                    batches.append(frame_queue.get_nowait())
+            except queue.Empty:
+                pass
+            for arrival_us, raw in batches:
+                aligner.push(np.frombuffer(raw, dtype=IMUParser.FRAME_DTYPE), arrival_us)
+
+            msg = aligner.poll(time.time_ns() // 1000)
+            if msg is not None:
+                with subscribers_lock:
+                    subscribers[:] = [sub for sub in subscribers if sub.alive]
+                    for sub in subscribers:
+                        sub.put(msg)
+
+            if time.time() - last_stats_time > 5:
+                _logger.debug(f"live stream: {aligner.stats()}, subscribers: {len(subscribers)}")
+                last_stats_time = time.time()
+    except KeyboardInterrupt:
+        pass
+
+    _logger.info(f"live stream stopped: {aligner.stats()}")
+    with subscribers_lock:
+        for sub in subscribers:
+            sub.close()
+    listener.close()
@@ -5,8 +5,11 @@ import signal
 import time
 from typing import Optional
 
+from markit_gateway.common import StateTable
 from markit_gateway.config import BrokerConfig
 from .imu_render_ui import imu_render_ui_task
+from .live_align import live_align_task
+from .segment_convert import segment_convert_task
 from .tcp_listen import tcp_listen_task
 
 _logger = logging.getLogger('measure')
@@ -16,20 +19,53 @@ def measure(config: BrokerConfig,
             tag: str,
             signal_stop: mp.Event = None,
             client_info_queue: mp.Queue = None,
-            imu_state_queue: mp.Queue = None):
+            imu_state_table: StateTable = None):
     _logger.setLevel(logging.DEBUG) if config.debug else _logger.setLevel(logging.INFO)
     _logger.debug("start")
     # Listen TCP
     stop_ev = {
         'tcp': mp.Event(),
-        'ui': mp.Event()
+        'ui': mp.Event(),
+        'live': mp.Event(),
+        'segments': mp.Event()
     }
     finish_ev = {
         'tcp': mp.Event(),
         'ui': mp.Event()
     }
-    if config.enable_gui and imu_state_queue is None:
-        imu_state_queue = mp.Queue()
+    # Latest device states for the UI, owned by this process unless the caller (the portal) provides one
+    own_state_table = config.enable_gui and imu_state_table is None
+    if own_state_table:
+        imu_state_table = StateTable(config.state_table_size)
+
+    live_frame_queue: Optional[mp.Queue] = None
+    live_align_task_process: Optional[mp.Process] = None
+    if config.live_enable:
+        live_frame_queue = mp.Queue(maxsize=0x400)
+        live_align_task_process = mp.Process(None,
+                                             live_align_task,
+                                             "live_align_task",
+                                             (
+                                                 config,
+                                                 live_frame_queue,
+                                                 stop_ev['live']
+                                             ))
+        _logger.debug("start live_align_task")
+        live_align_task_process.start()
+
+    # Closed segments are converted while the capture goes on, leaving only the last ones for convert_measurement
+    segment_convert_task_process: Optional[mp.Process] = None
+    if (config.segment_max_bytes > 0 or config.segment_max_duration_s > 0) and config.cache_max_bytes > 0:
+        segment_convert_task_process = mp.Process(None,
+                                                  segment_convert_task,
+                                                  "segment_convert_task",
+                                                  (
+                                                      config,
+                                                      tag,
+                                                      stop_ev['segments']
+                                                  ))
+        _logger.debug("start segment_convert_task")
+        segment_convert_task_process.start()
 
     tcp_listen_task_process = mp.Process(None,
                                          tcp_listen_task,
@@ -40,7 +76,8 @@ def measure(config: BrokerConfig,
                                              stop_ev['tcp'],
                                              finish_ev['tcp'],
                                              client_info_queue,
-                                             imu_state_queue
+                                             imu_state_table,
+                                             live_frame_queue
                                          ))
     _logger.debug("start tcp_listen_task")
     tcp_listen_task_process.start()
@@ -54,7 +91,7 @@ def measure(config: BrokerConfig,
                                              (
                                                  stop_ev['ui'],
                                                  finish_ev['ui'],
-                                                 imu_state_queue
+                                                 imu_state_table
                                              ))
         imu_render_task_process.start()
     else:
@@ -77,10 +114,23 @@ def measure(config: BrokerConfig,
     stop_ev['tcp'].set()
     _logger.debug("notify imu_render_ui_task to stop")
     stop_ev['ui'].set()
+    _logger.debug("notify live_align_task to stop")
+    stop_ev['live'].set()
 
     if imu_render_task_process is not None:
         # Kill render process directly
         os.kill(imu_render_task_process.pid, signal.SIGTERM)
     # finish_ev['tcp'].wait()
     time.sleep(5)
+    if live_align_task_process is not None:
+        live_align_task_process.join(timeout=1)
+        if live_align_task_process.is_alive():
+            os.kill(live_align_task_process.pid, signal.SIGTERM)
+    if segment_convert_task_process is not None:
+        # Its last pass must be over before convert_measurement reads the conversion cache
+        _logger.debug("notify segment_convert_task to stop")
+        stop_ev['segments'].set()
+        segment_convert_task_process.join()
+    if own_state_table:
+        imu_state_table.unlink()
     _logger.debug("measure stopped")
@@ -0,0 +1,33 @@
+import logging
+import multiprocessing as mp
+import os
+
+from markit_gateway.config import BrokerConfig
+from markit_gateway.functional import convert_closed_segments
+
+
+def segment_convert_task(config: BrokerConfig,
+                         tag: str,
+                         stop_ev: mp.Event,
+                         interval_s: float = 10.):
+    """Convert the segments closed by segment rotation while the capture is still running
+
+    Runs until stop_ev is set, then makes a last pass so that segments closed in the meantime are cached too.
+    """
+    _logger = logging.getLogger('segment_convert_task')
+    _logger.setLevel(logging.DEBUG) if config.debug else _logger.setLevel(logging.INFO)
+    measurement_basedir = os.path.join(config.base_dir, tag)
+
+    while True:
+        stopped = stop_ev.wait(timeout=interval_s)
+        if os.path.exists(measurement_basedir):
+            try:
+                n_parsed = convert_closed_segments(measurement_basedir,
+                                                   cache_max_bytes=config.cache_max_bytes,
+                                                   index_stride=config.index_stride)
+                if n_parsed > 0:
+                    _logger.debug(f"converted {n_parsed} closed segments")
+            except Exception as e:
+                _logger.error(e)
+        if stopped:
+            break
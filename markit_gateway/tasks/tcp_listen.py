@@ -1,15 +1,16 @@
+import dataclasses
 import logging
 import multiprocessing as mp
 import os
+import selectors
 import socket
-import time
-from typing import List
+from multiprocessing.connection import Connection
+from typing import List, Tuple, Optional
 
-import select
-
-from markit_gateway.common import IMUConnection
+from markit_gateway.common import tcp_listen_socket, tcp_accept_all
+from markit_gateway.common import LoadBalancer, WorkerLoad, MigratedConnection, StateTable
 from markit_gateway.config import BrokerConfig
-from .tcp_process import tcp_process_task
+from .tcp_process import tcp_process_task, accept_connection
 
 
 def tcp_listen_task(config: BrokerConfig,
@@ -17,7 +18,8 @@ def tcp_listen_task(config: BrokerConfig,
                     stop_ev: mp.Event,
                     finish_ev: mp.Event,
                     client_info_queue: mp.Queue = None,
-                    imu_state_queue: mp.Queue = None,
+                    imu_state_table: StateTable = None,
+                    live_frame_queue: mp.Queue = None,
                     ) -> None:
     logger = logging.getLogger('tcp_listen_task')
     logger.setLevel(logging.DEBUG) if config.debug else logger.setLevel(logging.INFO)
@@ -27,7 +29,15 @@ def tcp_listen_task(config: BrokerConfig,
     if not os.path.exists(measurement_basedir):
         os.makedirs(measurement_basedir)
 
-    client_queues: List[mp.Queue] = [mp.Queue() for _ in range(config.n_procs)]
+    reuse_port = config.tcp_reuseport
+    if reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+        logger.warning("SO_REUSEPORT is not supported on this platform, accepting in the listener")
+        reuse_port = False
+
+    # One pipe per worker: new clients and migration commands go down, load reports and migrating connections
+    # come back up. The worker end also wakes the worker up
+    client_pipes: List[Tuple[Connection, Connection]] = [mp.Pipe() for _ in range(config.n_procs)]
+    balancer = LoadBalancer(config.n_procs, config.rebalance_threshold, config.rebalance_cooldown_s)
 
     # Create client processors
     client_procs: List[mp.Process] = [
@@ -35,59 +45,80 @@ def tcp_listen_task(config: BrokerConfig,
                    tcp_process_task,
                    f"tcp_process_{i}",
                    (
-                       client_queues[i],
+                       client_pipes[i][0],
                        config,
                        measurement_basedir,
                        i,
                        stop_ev,
-                       imu_state_queue
+                       imu_state_table,
+                       live_frame_queue,
+                       client_info_queue,
+                       reuse_port
                    ),
                    daemon=False) for i in range(config.n_procs)
     ]
     [p.start() for p in client_procs]
 
-    n_client: int = 0
-    # Set up the server
-    server_socket: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_socket.bind((config.data_addr, config.data_port))
-    server_socket.listen(config.n_procs)
-    logger.info(f"binding address {config.data_addr}:{config.data_port}")
+    server_socket: Optional[socket.socket] = None
+    selector = selectors.DefaultSelector()
+    for i in range(config.n_procs):
+        selector.register(client_pipes[i][1], selectors.EVENT_READ, i)
+    if reuse_port:
+        logger.info(f"workers accept on {config.data_addr}:{config.data_port} with SO_REUSEPORT")
+    else:
+        # Set up the server
+        server_socket = tcp_listen_socket(config.data_addr,
+                                          config.data_port,
+                                          backlog=config.tcp_backlog,
+                                          rcvbuf=config.tcp_rcvbuf)
+        selector.register(server_socket, selectors.EVENT_READ)
+        logger.info(f"binding address {config.data_addr}:{config.data_port}")
 
     try:
         while True:
-            client_read_ready_fds, _, _ = select.select([server_socket.fileno()], [], [], 1)
-            if len(client_read_ready_fds) > 0:
-                client_socket, (client_address, client_port) = server_socket.accept()
-                logger.info(f"new client {client_address}:{client_port}")
-
-                new_client = IMUConnection(client_socket,
-                                           client_address,
-                                           client_port,
-                                           render_packet=config.render_packet,
-                                           imu_port=config.imu_port,
-                                           proc_id=n_client % config.n_procs,
-                                           update_interval_s=config.update_interval_s)
-                if client_info_queue is not None:
-                    client_info_queue.put(new_client)
-
-                client_socket.setblocking(False)  # Non-blocking
-
-                client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)  # Set keep-alive
-                if hasattr(socket, "TCP_KEEPIDLE") and hasattr(socket, "TCP_KEEPINTVL") and hasattr(socket,
-                                                                                                    "TCP_KEEPCNT"):
-                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60)
-                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 60)
-                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
-
-                # Evenly distribute client to subprocesses
-                client_queues[n_client % config.n_procs].put(new_client)
-                n_client += 1
+            # Returns as soon as a client connects or a worker reports, stop_ev and the workers are checked at
+            # least every second
+            for selector_key, _ in selector.select(timeout=1):
+                if selector_key.data is not None:
+                    worker_conn: Connection = selector_key.fileobj
+                    try:
+                        while worker_conn.poll():
+                            msg = worker_conn.recv()
+                            if isinstance(msg, WorkerLoad):
+                                balancer.report(msg)
+                            elif isinstance(msg, MigratedConnection):
+                                client_pipes[msg.dst][1].send(msg)
+                                # The destination got its own duplicate
+                                msg.connection.socket.close()
+                    except EOFError:
+                        selector.unregister(worker_conn)
+                    continue
+
+                # Take the whole accept queue at once, a reconnect storm must not wait one round per device
+                for client_socket, (client_address, client_port) in tcp_accept_all(server_socket):
+                    logger.info(f"new client {client_address}:{client_port}")
+                    # Place the client on the least loaded worker
+                    proc_id = balancer.place()
+                    new_client = accept_connection(config,
+                                                   client_socket,
+                                                   client_address,
+                                                   client_port,
+                                                   proc_id=proc_id,
+                                                   render_packet=config.render_packet or live_frame_queue is not None)
+                    if client_info_queue is not None:
+                        client_info_queue.put(dataclasses.replace(new_client, socket=None))
+                    client_pipes[proc_id][1].send(new_client)
+                    # The worker got its own duplicate
+                    client_socket.close()
+
+            migration = balancer.plan()
+            if migration is not None:
+                src, command = migration
+                logger.info(f"migrating client on port {command.port} from process {src} to process {command.dst}")
+                client_pipes[src][1].send(command)
 
             if not any([proc.is_alive() for proc in client_procs]) or stop_ev.is_set():
                 break
-            else:
-                time.sleep(0.01)
     except KeyboardInterrupt:
         logger.info("tcp_listen process capture keyboard interrupt")
 
@@ -96,6 +127,8 @@ def tcp_listen_task(config: BrokerConfig,
         logger.debug(f"joining {proc}")
         proc.join()
 
-    server_socket.close()
+    selector.close()
+    if server_socket is not None:
+        server_socket.close()
     finish_ev.set()
     logger.debug(f"all processes are joined")
@@ -1,11 +1,16 @@
+import dataclasses
 import logging
 import multiprocessing as mp
+import queue
+import socket
 import time
-from typing import BinaryIO
+from multiprocessing.connection import Connection
+from typing import BinaryIO, List
 
-import select
+import numpy as np
 
-from markit_gateway.common import ClientRepo, IMUConnection
+from markit_gateway.common import ClientRepo, IMUConnection, CoalescingWriter, IngestSelector, tcp_listen_socket
+from markit_gateway.common import WorkerLoad, MigrateCommand, MigratedConnection, StateTable
 from markit_gateway.config import BrokerConfig
 
 logging.basicConfig(level=logging.INFO)
@@ -23,59 +28,198 @@ def insert_data(f: BinaryIO, data: bytes):
     f.write(data)
 
 
-def tcp_process_task(client_socket_queue: mp.Queue,
+def accept_connection(config: BrokerConfig,
+                      client_socket: socket.socket,
+                      client_address: str,
+                      client_port: int,
+                      proc_id: int,
+                      render_packet: bool) -> IMUConnection:
+    """Set the socket options of a newly accepted data connection and wrap it
+
+    Returns:
+        IMUConnection: connection of the client, without backend yet
+    """
+    client_socket.setblocking(False)  # Non-blocking
+
+    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)  # Set keep-alive
+    if config.tcp_nodelay:
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if hasattr(socket, "TCP_KEEPIDLE") and hasattr(socket, "TCP_KEEPINTVL") and hasattr(socket, "TCP_KEEPCNT"):
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60)
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 60)
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+
+    return IMUConnection(client_socket,
+                         client_address,
+                         client_port,
+                         render_packet=render_packet,
+                         imu_port=config.imu_port,
+                         proc_id=proc_id,
+                         update_interval_s=config.update_interval_s,
+                         recv_size=config.tcp_buff_sz,
+                         recv_max_size=config.tcp_buff_max_sz)
+
+
+def tcp_process_task(client_conn: Connection,
                      config: BrokerConfig,
                      base_dir: str,
                      proc_id: int,
                      stop_ev: mp.Event,
-                     imu_state_queue: mp.Queue = None):
+                     imu_state_table: StateTable = None,
+                     live_frame_queue: mp.Queue = None,
+                     client_info_queue: mp.Queue = None,
+                     reuse_port: bool = False):
+    """Receive and store the data of the clients handed over by tcp_listen_task
+
+    With reuse_port, the worker also binds the data port with SO_REUSEPORT and accepts connections itself, the
+    kernel spreads new connections among the workers and no socket crosses a process boundary.
+
+    Every load_report_interval_s the worker sends a WorkerLoad to tcp_listen_task. On a MigrateCommand it
+    detaches the connection and sends it back as a MigratedConnection, which tcp_listen_task forwards to the
+    destination worker; the data stays in the socket buffer meanwhile.
+
+    Args:
+        client_conn (Connection): pipe to tcp_listen_task, new clients and commands arrive on it, it also wakes
+            the loop up
+        config (BrokerConfig): broker configuration
+        base_dir (str): measurement directory
+        proc_id (int): index of this worker
+        stop_ev (mp.Event): set to stop the worker
+        imu_state_table (StateTable): where device states are published, optional
+        live_frame_queue (mp.Queue): where decoded frames are forwarded for the live stream, optional
+        client_info_queue (mp.Queue): where accepted clients are reported, used with reuse_port
+        reuse_port (bool): accept connections in this worker
+    """
     _logger = logging.getLogger('tcp_process_task')
     _logger.setLevel(logging.DEBUG) if config.debug else _logger.setLevel(logging.INFO)
 
-    registration = ClientRepo(base_dir, proc_id, imu_state_queue=imu_state_queue)
-    recv_size = config.tcp_buff_sz
+    # Disk writes are batched off the recv loop
+    writer = CoalescingWriter(flush_interval_s=config.write_flush_interval_s,
+                              flush_size=config.write_flush_size,
+                              fsync=config.write_fsync)
+    registration = ClientRepo(base_dir,
+                              proc_id,
+                              imu_state_table=imu_state_table,
+                              decode_at_ingest=config.decode_at_ingest,
+                              writer=writer,
+                              index_stride=config.index_stride,
+                              segment_max_bytes=config.segment_max_bytes,
+                              segment_max_duration_s=config.segment_max_duration_s)
+    # Sleeps until a socket is readable or a client is handed over, stop_ev is checked at least every timeout
+    ingest = IngestSelector(client_conn)
+    if reuse_port:
+        ingest.add_listener(tcp_listen_socket(config.data_addr,
+                                              config.data_port,
+                                              backlog=config.tcp_backlog,
+                                              rcvbuf=config.tcp_rcvbuf,
+                                              reuse_port=True))
+        _logger.info(f"process {proc_id} accepting on {config.data_addr}:{config.data_port}")
+
+    # Bytes/s of every connection are reported to tcp_listen_task, which places clients and plans migrations
+    last_report_time = time.time()
 
     try:
-        while True:
-            if not client_socket_queue.empty():
-                new_client: IMUConnection = client_socket_queue.get()
-                registration.register(IMUConnection(new_client.socket,
-                                                    new_client.addr,
-                                                    new_client.port,
-                                                    render_packet=new_client.render_packet,
-                                                    proc_id=new_client.proc_id,
-                                                    update_interval_s=new_client.update_interval_s))
-
-            if len(registration) > 0:
-                client_read_ready_fds, _, _ = select.select(list(registration.index_by_fd.keys()), [], [], 1)
-                for fd in client_read_ready_fds:
-                    cli = registration.index_by_fd[fd]
-                    try:
-                        data = cli.socket.recv(recv_size)
-                    except Exception as e:
-                        _logger.warning(e)
-                        _logger.warning(f"client {cli.addr}:{cli.port} disconnected unexpectedly")
-                        registration.unregister(fd)
-                        continue
-                    if len(data) <= 0:
-                        _logger.warning(f"client {cli.addr}:{cli.port} disconnected unexpectedly")
-                        registration.unregister(fd)
-                        continue
-
-                    if not cli.active:
-                        registration.mark_as_online(fd)
-
-                    cli.update(data)
-                    if imu_state_queue is not None and cli.render is not None:
-                        imu_state_queue.put(cli.render.state)
-
-            if stop_ev.is_set():
-                _logger.debug("closing sockets")
-                registration.close()
-                return
-
-            else:
-                time.sleep(0.01)
+        while not stop_ev.is_set():
+            handoffs, received, closed = ingest.poll(timeout=0.5)
+            arrival_us = time.time_ns() // 1000
+
+            live_frames: List[np.ndarray] = []
+            migrations: List[MigrateCommand] = []
+            for new_client in handoffs:
+                replay = b''
+                if isinstance(new_client, MigrateCommand):
+                    # Carried out once the data received so far has been stored
+                    migrations.append(new_client)
+                    continue
+                if isinstance(new_client, MigratedConnection):
+                    new_client, replay = new_client.connection, new_client.pending
+                    _logger.info(f"client {new_client.addr}:{new_client.port} migrated to process {proc_id}")
+                if isinstance(new_client, IMUConnection):
+                    cli = IMUConnection(new_client.socket,
+                                        new_client.addr,
+                                        new_client.port,
+                                        render_packet=new_client.render_packet,
+                                        proc_id=proc_id,
+                                        update_interval_s=new_client.update_interval_s,
+                                        recv_size=new_client.recv_size,
+                                        recv_max_size=new_client.recv_max_size,
+                                        imu_port=new_client.imu_port,
+                                        device_id=new_client.device_id)
+                else:
+                    # Accepted by this worker
+                    client_socket, (client_address, client_port) = new_client
+                    _logger.info(f"new client {client_address}:{client_port}")
+                    cli = accept_connection(config, client_socket, client_address, client_port, proc_id,
+                                            render_packet=config.render_packet or live_frame_queue is not None)
+                    if client_info_queue is not None:
+                        client_info_queue.put(dataclasses.replace(cli, socket=None))
+                registration.register(cli)
+                if len(replay) > 0:
+                    frames = cli.update(replay)
+                    if live_frame_queue is not None and frames is not None and len(frames) > 0:
+                        live_frames.append(frames)
+                # Received straight into the buffer of the connection, see IMUConnection.writable
+                ingest.register(cli.socket, cli.tcp_fd, cli)
+
+            for fd, _ in received:
+                cli = registration.index_by_fd[fd]
+                if not cli.active:
+                    registration.mark_as_online(fd)
+
+                frames = cli.update()
+                if live_frame_queue is not None and frames is not None and len(frames) > 0:
+                    live_frames.append(frames)
+
+            # The live stream must never hold back the capture, batches are dropped if it lags behind
+            if len(live_frames) > 0:
+                try:
+                    live_frame_queue.put_nowait((arrival_us, np.concatenate(live_frames).tobytes()))
+                except queue.Full:
+                    _logger.debug("live frame queue is full, dropping frames")
+
+            for fd, error in closed:
+                cli = registration.index_by_fd[fd]
+                if error is not None:
+                    _logger.warning(error)
+                _logger.warning(f"client {cli.addr}:{cli.port} disconnected unexpectedly")
+                registration.unregister(fd)
+
+            # States held back by the throttle, e.g. the last one of a device that went quiet
+            for cli in registration.index_by_fd.values():
+                if cli.render is not None:
+                    cli.render.publish_state()
+
+            for command in migrations:
+                cli = registration.index_by_fd.get(command.fd)
+                if cli is None or cli.port != command.port:
+                    # Disconnected meanwhile
+                    continue
+                ingest.unregister(command.fd)
+                connection, replay = registration.detach(command.fd)
+                client_conn.send(MigratedConnection(command.dst, connection, replay))
+                # The socket was duplicated when it was sent, only this copy is closed
+                connection.socket.close()
+                _logger.info(f"client {cli.addr}:{cli.port} migrating to process {command.dst}")
+
+            now = time.time()
+            if now - last_report_time >= config.load_report_interval_s:
+                load = WorkerLoad(proc_id)
+                for fd, cli in registration.index_by_fd.items():
+                    # Counted per connection, a reused fd starts over
+                    rate = max(cli.n_bytes - cli.n_bytes_reported, 0) / (now - last_report_time)
+                    cli.n_bytes_reported = cli.n_bytes
+                    load.connections[fd] = (cli.port, rate)
+                    load.bytes_per_s += rate
+                client_conn.send(load)
+                last_report_time = now
+
+        _logger.debug("closing sockets")
+        ingest.close()
+        registration.close()
+        writer.stop()
+        _logger.debug(f"writer metrics: {writer.metrics()}")
     except KeyboardInterrupt:
         _logger.debug(f"process {proc_id} is exiting")
+        ingest.close()
         registration.close()
+        writer.stop()
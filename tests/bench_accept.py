@@ -0,0 +1,105 @@
+"""Measure how long a reconnect storm takes to be admitted by tcp_listen_task
+
+--n_clients devices connect at the same moment and each sends one frame. A device is admitted once a worker has
+decoded its frame and published its state, i.e. accept, handoff and first recv are all done. The storm is run
+against the listener with the old backlog (--old_backlog, listen(n_procs) before), the listener with
+--backlog and the SO_REUSEPORT workers.
+
+    python tests/bench_accept.py --n_clients 200 --n_procs 4
+"""
+import argparse
+import multiprocessing as mp
+import os.path as osp
+import socket
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from markit_gateway.common import StateTable
+from markit_gateway.config import BrokerConfig
+from markit_gateway.tasks import tcp_listen_task
+
+sys.path.insert(0, osp.dirname(__file__))
+from test_parser import make_recording  # noqa: E402
+
+
+def storm(port: int, n_clients: int, sockets: List[socket.socket]) -> float:
+    barrier = threading.Barrier(n_clients + 1)
+
+    def connect(i: int):
+        frame = make_recording(1, device_id=f'{0x84f7033b0000 + i:012x}')
+        barrier.wait()
+        sock = socket.create_connection(('127.0.0.1', port), timeout=30)
+        sock.sendall(frame)
+        sockets.append(sock)
+
+    threads = [threading.Thread(target=connect, args=(i,), daemon=True) for i in range(n_clients)]
+    [t.start() for t in threads]
+    barrier.wait()
+    return time.perf_counter()
+
+
+def run(args, port: int, backlog: int, reuse_port: bool) -> Dict[str, float]:
+    config = BrokerConfig()
+    config.base_dir = tempfile.mkdtemp()
+    config.data_addr = '127.0.0.1'
+    config.data_port = port
+    config.n_procs = args.n_procs
+    config.tcp_backlog = backlog
+    config.tcp_reuseport = reuse_port
+    config.render_packet = True
+    config.update_interval_s = 1e3
+
+    stop_ev, finish_ev = mp.Event(), mp.Event()
+    imu_state_table = StateTable(args.n_clients)
+    proc = mp.Process(target=tcp_listen_task, args=(config, 'storm', stop_ev, finish_ev, None, imu_state_table))
+    proc.start()
+    time.sleep(1)
+
+    sockets: List[socket.socket] = []
+    start = storm(port, args.n_clients, sockets)
+    admitted: Dict[str, float] = {}
+    deadline = start + args.timeout_s
+    while len(admitted) < args.n_clients and time.perf_counter() < deadline:
+        for device_id in imu_state_table.snapshot().keys():
+            if device_id not in admitted.keys():
+                admitted[device_id] = time.perf_counter() - start
+        time.sleep(1e-3)
+
+    stop_ev.set()
+    proc.join()
+    [sock.close() for sock in sockets]
+    imu_state_table.unlink()
+
+    admission_s = np.array(list(admitted.values()))
+    return {
+        'admitted': len(admitted),
+        'p50_ms': float(np.percentile(admission_s, 50)) * 1e3,
+        'p99_ms': float(np.percentile(admission_s, 99)) * 1e3,
+        'all_ms': float(admission_s.max()) * 1e3,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_clients', type=int, default=200)
+    parser.add_argument('--n_procs', type=int, default=4)
+    parser.add_argument('--old_backlog', type=int, default=4)
+    parser.add_argument('--backlog', type=int, default=1024)
+    parser.add_argument('--timeout_s', type=float, default=30.)
+    parser.add_argument('--port', type=int, default=28888)
+    args: argparse.Namespace = parser.parse_args()
+
+    cases = (
+        (f'listener, backlog {args.old_backlog}', args.old_backlog, False),
+        (f'listener, backlog {args.backlog}', args.backlog, False),
+        (f'reuseport, backlog {args.backlog}', args.backlog, True),
+    )
+    for i, (name, backlog, reuse_port) in enumerate(cases):
+        res = run(args, args.port + i, backlog, reuse_port)
+        print(f"{name:>24}: {res['admitted']}/{args.n_clients} admitted, "
+              f"p50 {res['p50_ms']:.1f} ms, p99 {res['p99_ms']:.1f} ms, all {res['all_ms']:.1f} ms")
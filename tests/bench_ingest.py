@@ -0,0 +1,129 @@
+"""Compare the ingest loop of tcp_process_task with the select() + sleep() loop it replaced
+
+A sender process opens --n_clients connections and writes 114-byte packets stamped with time.perf_counter_ns(),
+either paced at --rate_hz per client or as fast as possible (--flood). The receiver runs one loop for --duration_s
+and reports packets/s and the receive latency percentiles.
+
+    python tests/bench_ingest.py --n_clients 16 --rate_hz 200
+    python tests/bench_ingest.py --n_clients 16 --flood
+"""
+import argparse
+import multiprocessing as mp
+import select
+import socket
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from markit_gateway.common import IngestSelector, RecvBuffer, AdaptiveBufferSize
+
+PACKET_SIZE = 114
+
+
+def sender(port: int, n_clients: int, rate_hz: float, flood: bool, duration_s: float):
+    sockets = [socket.create_connection(('127.0.0.1', port)) for _ in range(n_clients)]
+    padding = bytes(PACKET_SIZE - 8)
+    deadline = time.perf_counter() + duration_s
+    next_t = time.perf_counter()
+    try:
+        while time.perf_counter() < deadline:
+            for sock in sockets:
+                sock.sendall(time.perf_counter_ns().to_bytes(8, 'little') + padding)
+            if not flood:
+                next_t += 1 / rate_hz
+                time.sleep(max(0., next_t - time.perf_counter()))
+    except OSError:
+        pass
+    [sock.close() for sock in sockets]
+
+
+class Sink:
+    """Splits the streams into packets and records their latency"""
+
+    def __init__(self):
+        self.buffers: Dict[int, bytearray] = {}
+        self.latency_ns: List[int] = []
+
+    def feed(self, key: int, data: bytes):
+        now = time.perf_counter_ns()
+        buf = self.buffers.setdefault(key, bytearray())
+        buf += data
+        n = len(buf) // PACKET_SIZE
+        for i in range(n):
+            self.latency_ns.append(now - int.from_bytes(buf[i * PACKET_SIZE:i * PACKET_SIZE + 8], 'little'))
+        del buf[:n * PACKET_SIZE]
+
+
+def legacy_loop(sockets: List[socket.socket], sink: Sink, duration_s: float, recv_size: int):
+    handoff_queue = mp.Queue()
+    by_fd = {sock.fileno(): sock for sock in sockets}
+    deadline = time.perf_counter() + duration_s
+    while time.perf_counter() < deadline and len(by_fd) > 0:
+        if not handoff_queue.empty():
+            handoff_queue.get()
+        ready, _, _ = select.select(list(by_fd.keys()), [], [], 1)
+        for fd in ready:
+            data = by_fd[fd].recv(recv_size)
+            if len(data) <= 0:
+                del by_fd[fd]
+                continue
+            sink.feed(fd, data)
+        time.sleep(0.01)
+
+
+def selector_loop(sockets: List[socket.socket], sink: Sink, duration_s: float, recv_size: int):
+    wakeup, _ = mp.Pipe(duplex=False)
+    ingest = IngestSelector(wakeup)
+    buffers = {sock.fileno(): RecvBuffer(recv_size) for sock in sockets}
+    sizers = {sock.fileno(): AdaptiveBufferSize(recv_size) for sock in sockets}
+    [ingest.register(sock, sock.fileno(), buffers[sock.fileno()]) for sock in sockets]
+    deadline = time.perf_counter() + duration_s
+    while time.perf_counter() < deadline and len(ingest) > 0:
+        _, received, _ = ingest.poll(timeout=0.5)
+        for fd, n_bytes in received:
+            sink.feed(fd, buffers[fd].take())
+            buffers[fd].resize(sizers[fd].observe(n_bytes))
+    ingest.close()
+
+
+def run(loop, args) -> Dict[str, float]:
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(args.n_clients)
+    proc = mp.Process(target=sender, args=(server.getsockname()[1], args.n_clients, args.rate_hz, args.flood, args.duration_s))
+    proc.start()
+    sockets = [server.accept()[0] for _ in range(args.n_clients)]
+    [sock.setblocking(False) for sock in sockets]
+
+    sink = Sink()
+    start = time.perf_counter()
+    loop(sockets, sink, args.duration_s, args.recv_size)
+    elapsed = time.perf_counter() - start
+    proc.terminate()
+    proc.join()
+    [sock.close() for sock in sockets]
+    server.close()
+
+    latency_ms = np.array(sink.latency_ns) / 1e6
+    return {
+        'packets_per_s': len(latency_ms) / elapsed,
+        'p50_ms': float(np.percentile(latency_ms, 50)),
+        'p99_ms': float(np.percentile(latency_ms, 99)),
+        'max_ms': float(latency_ms.max()),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_clients', type=int, default=16)
+    parser.add_argument('--rate_hz', type=float, default=200.)
+    parser.add_argument('--flood', action='store_true')
+    parser.add_argument('--duration_s', type=float, default=5.)
+    parser.add_argument('--recv_size', type=int, default=1024)
+    args: argparse.Namespace = parser.parse_args()
+
+    for name, loop in (('select + sleep', legacy_loop), ('selector', selector_loop)):
+        res = run(loop, args)
+        print(f"{name:>16}: {res['packets_per_s']:10.0f} packets/s, "
+              f"latency p50 {res['p50_ms']:.2f} ms, p99 {res['p99_ms']:.2f} ms, max {res['max_ms']:.2f} ms")
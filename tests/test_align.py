@@ -0,0 +1,61 @@
+import numpy as np
+from scipy.spatial.transform import Rotation as R
+
+from markit_gateway.functional.align import align_measurement, load_npz_mmap, ALIGNED_FIELDS
+
+
+def _make_device(n: int, tsf_start: int, seed: int) -> dict:
+    rng = np.random.default_rng(seed)
+    tsf = tsf_start + np.cumsum(rng.integers(2400, 2600, n)).astype(np.int64)
+    res = {'tsf_timestamp': tsf, 'timestamp': 1634823580000000 + tsf}
+    for name in ('accel_x', 'accel_y', 'accel_z', 'gyro_x', 'gyro_y', 'gyro_z', 'mag_x', 'mag_y', 'mag_z'):
+        res[name] = rng.standard_normal(n)
+    res.update(zip(('quat_x', 'quat_y', 'quat_z', 'quat_w'), R.random(n, random_state=seed).as_quat().T))
+    return {name: value.reshape(-1, 1) for name, value in res.items()}
+
+
+def _align(base_dir, devices: dict, **kwargs) -> dict:
+    base_dir.mkdir()
+    res = align_measurement(str(base_dir), imu_device_id_mapping=devices, **kwargs)
+    return {imu_id: {field: np.array(value) for field, value in fields.items()} for imu_id, fields in res.items()}
+
+
+def test_windowed_alignment_matches_single_pass(tmp_path):
+    devices = {'84f7033b3e78': _make_device(3000, 0, 0), '84f7033b3e79': _make_device(3000, 40000, 1)}
+    for kwargs in ({}, {'rate_hz': 150.}):
+        expected = _align(tmp_path / f'single{len(kwargs)}', devices, chunk_size=0x10000, n_workers=1, **kwargs)
+        res = _align(tmp_path / f'windowed{len(kwargs)}', devices, chunk_size=333, n_workers=1, **kwargs)
+        for imu_id in devices.keys():
+            assert len(res[imu_id]['accel']) > 1000
+            for field in ALIGNED_FIELDS.keys():
+                if field == 'quat':
+                    # q and -q are the same rotation, the sign depends on where the window starts
+                    assert np.allclose(np.abs(np.sum(res[imu_id][field] * expected[imu_id][field], axis=1)), 1, atol=1e-12)
+                else:
+                    assert np.allclose(res[imu_id][field], expected[imu_id][field], rtol=0, atol=1e-12)
+
+    # Devices that do not overlap
+    devices['84f7033b3e79'] = _make_device(100, 10 ** 9, 1)
+    res = _align(tmp_path / 'disjoint', devices, chunk_size=333, n_workers=1)
+    assert all(len(fields['accel']) == 0 for fields in res.values())
+
+
+def test_pooled_alignment_matches_serial(tmp_path):
+    devices = {f'84f7033b3e7{i}': _make_device(2000, 10000 * i, i) for i in range(3)}
+    expected = _align(tmp_path / 'serial', devices, chunk_size=333, n_workers=1)
+    for pool in ('process', 'thread'):
+        res = _align(tmp_path / pool, devices, chunk_size=333, n_workers=2, pool=pool)
+        for imu_id in devices.keys():
+            for field in ALIGNED_FIELDS.keys():
+                assert np.array_equal(res[imu_id][field], expected[imu_id][field])
+
+    # Memory-mapped sources are shared in place rather than spilled
+    (tmp_path / 'mmap').mkdir()
+    mapping = {}
+    for imu_id, columns in devices.items():
+        np.savez(str(tmp_path / 'mmap' / f'imu_{imu_id}.npz'), **columns)
+        mapping[imu_id] = load_npz_mmap(str(tmp_path / 'mmap' / f'imu_{imu_id}.npz'))
+    res = align_measurement(str(tmp_path / 'mmap'), imu_device_id_mapping=mapping, chunk_size=333, n_workers=2, pool='process')
+    for imu_id in devices.keys():
+        for field in ALIGNED_FIELDS.keys():
+            assert np.array_equal(res[imu_id][field], expected[imu_id][field])
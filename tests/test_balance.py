@@ -0,0 +1,62 @@
+import glob
+import io
+import os.path as osp
+import socket
+
+import numpy as np
+
+from markit_gateway.common import ClientRepo, IMUConnection, IMUParser, LoadBalancer, WorkerLoad
+from test_parser import make_recording
+
+
+def test_load_balancer_places_and_plans():
+    balancer = LoadBalancer(3, threshold=0.5, cooldown_s=5., min_bytes_per_s=100)
+    balancer.report(WorkerLoad(0, 3000., {10: (5000, 1000.), 11: (5001, 1000.), 12: (5002, 1000.)}))
+    balancer.report(WorkerLoad(1, 1000., {10: (5003, 1000.)}))
+    balancer.report(WorkerLoad(2, 0.))
+
+    # Clients placed before the next report count at the average rate
+    assert [balancer.place() for _ in range(3)] == [2, 1, 2]
+
+    balancer.report(WorkerLoad(2, 0.))
+    src, command = balancer.plan(now=100.)
+    assert src == 0 and command.dst == 2 and command.fd in (10, 11, 12)
+    # Nothing more until the cooldown has passed
+    assert balancer.plan(now=101.) is None
+    # Balanced enough
+    balancer.report(WorkerLoad(0, 2000., {10: (5000, 1000.), 11: (5001, 1000.)}))
+    balancer.report(WorkerLoad(2, 1000., {7: (5002, 1000.)}))
+    assert balancer.plan(now=200.) is None
+
+
+def test_detach_keeps_frame_cut_by_migration(tmp_path):
+    frame_sz = IMUParser.FRAME_SZ
+    recording = make_recording(6)
+    local, remote = socket.socketpair()
+    src, dst = ClientRepo(str(tmp_path), 0), ClientRepo(str(tmp_path), 1)
+
+    def receive(cli: IMUConnection, data: bytes):
+        remote.sendall(data)
+        n = local.recv_into(cli.writable())
+        assert n == len(data)
+        cli.commit(n)
+        cli.update()
+
+    cli = IMUConnection(local, '127.0.0.1', 5000, render_packet=True, recv_size=0x1000)
+    src.register(cli)
+    receive(cli, recording[:int(2.5 * frame_sz)])
+
+    connection, replay = src.detach(cli.tcp_fd)
+    assert replay == recording[2 * frame_sz:int(2.5 * frame_sz)]
+    cli = IMUConnection(connection.socket, connection.addr, connection.port, render_packet=True, recv_size=0x1000)
+    dst.register(cli)
+    cli.update(replay)
+    receive(cli, recording[int(2.5 * frame_sz):])
+    dst.unregister(cli.tcp_fd)
+    remote.close()
+
+    seq = []
+    for path in sorted(glob.glob(osp.join(str(tmp_path), 'process_*.dat'))):
+        with open(path, 'rb') as f:
+            seq.extend(IMUParser()(io.BytesIO(f.read()), columnar=True)['seq'])
+    assert np.array_equal(seq, np.arange(6))
@@ -0,0 +1,41 @@
+import os
+import shutil
+
+from markit_gateway.functional import ConversionCache
+
+
+def _spool(tmp_path, name: str, payload: bytes) -> dict:
+    path = str(tmp_path / f'{name}.imu_84f7033b3e78.frames')
+    with open(path, 'wb') as f:
+        f.write(payload)
+    return {'84f7033b3e78': (path, len(payload), 0)}
+
+
+def test_conversion_cache_hits_and_evicts(tmp_path):
+    recordings = []
+    for i in range(3):
+        recordings.append(str(tmp_path / f'process_0_{i}.dat'))
+        with open(recordings[-1], 'wb') as f:
+            f.write(bytes([i]) * 1000)
+    cache = ConversionCache(str(tmp_path / 'cache'), max_bytes=250)
+    assert cache.get(recordings[0]) is None
+    cache.put(recordings[0], _spool(tmp_path, 'a', b'a' * 100))
+    res = cache.get(recordings[0])
+    assert open(res['84f7033b3e78'][0], 'rb').read() == b'a' * 100 and res['84f7033b3e78'][1:] == (100, 0)
+
+    # Touched and copied files with the same content hit by hash, a changed one misses
+    os.utime(recordings[0], ns=(0, 0))
+    shutil.copyfile(recordings[0], str(tmp_path / 'copy.dat'))
+    assert cache.get(recordings[0]) is not None and cache.get(str(tmp_path / 'copy.dat')) is not None
+    with open(recordings[0], 'ab') as f:
+        f.write(b'\x00')
+    assert cache.get(recordings[0]) is None
+
+    # Least recently used entries go first, the index survives a reload
+    cache.put(recordings[1], _spool(tmp_path, 'b', b'b' * 100))
+    cache.put(recordings[2], _spool(tmp_path, 'c', b'c' * 100))
+    cache.index['entries'][cache.index['stat'][ConversionCache._stat_key(recordings[1])]]['last_access'] -= 10
+    cache.save()
+    cache = ConversionCache(str(tmp_path / 'cache'), max_bytes=250)
+    assert cache.get(str(tmp_path / 'copy.dat')) is not None and cache.get(recordings[2]) is not None
+    assert cache.get(recordings[1]) is None
@@ -0,0 +1,50 @@
+import numpy as np
+
+from markit_gateway.common import ClockModel
+
+
+def test_incremental_fit_matches_polyfit():
+    rng = np.random.default_rng(0)
+    tsf = np.cumsum(rng.integers(2400, 2600, 100000)).astype(np.int64) + 123456789
+    timestamp = 1634823580000000 + np.round((tsf - tsf[0]) * (1 + 35e-6) + rng.normal(0, 200, len(tsf))).astype(np.int64)
+
+    model = ClockModel('84f7033b3e78')
+    for start in range(0, len(tsf), 37):
+        model.update(tsf[start:start + 37], timestamp[start:start + 37])
+
+    slope, intercept = np.polyfit((tsf - tsf[0]).astype(np.float64), (timestamp - timestamp[0]).astype(np.float64), 1)
+    expected = timestamp[0] + np.round(intercept + slope * (tsf - tsf[0])).astype(np.int64)
+    assert abs(model.drift_ppm - 35) < 1
+    assert np.abs(model.to_global(tsf) - expected).max() <= 1
+    assert abs(model.residual_std_us - 200) < 5
+
+    # Fits of two connections merge into the fit of both
+    first, second = ClockModel('84f7033b3e78'), ClockModel.from_dict(ClockModel('84f7033b3e78').to_dict())
+    first.update(tsf[:40000], timestamp[:40000])
+    second.update(tsf[40000:], timestamp[40000:])
+    first.merge(ClockModel.from_dict(second.to_dict()))
+    assert first.n == model.n
+    assert np.abs(first.to_global(tsf) - model.to_global(tsf)).max() <= 1
+
+
+def test_save_all_merges_connections_of_a_file(tmp_path):
+    tsf = np.arange(40, dtype=np.int64) * 2500
+    timestamp = 1634823580000000 + tsf
+    filename = str(tmp_path / 'process_0_5.dat')
+    # A reconnection reusing the fd appends to the same recording
+    for part in (slice(0, 20), slice(20, 40)):
+        model = ClockModel('84f7033b3e78')
+        model.update(tsf[part], timestamp[part])
+        ClockModel.save_all([model], filename)
+
+    models = ClockModel.load_all(str(tmp_path))
+    assert models['84f7033b3e78'].n == 40
+    assert np.array_equal(models['84f7033b3e78'].to_global(tsf), timestamp)
+
+
+if __name__ == '__main__':
+    import pathlib
+    import tempfile
+
+    test_incremental_fit_matches_polyfit()
+    test_save_all_merges_connections_of_a_file(pathlib.Path(tempfile.mkdtemp()))
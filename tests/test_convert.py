@@ -0,0 +1,95 @@
+import os
+import socket
+
+import numpy as np
+
+from markit_gateway.common import ClientRepo, ClockModel, CoalescingWriter, FrameLog, IMUConnection, IMUParser, SeekIndex, \
+    SegmentedFile, SegmentManifest
+from markit_gateway.functional.convert import convert_measurement, convert_closed_segments
+from test_parser import make_recording
+
+
+def _make_measurement(base_dir) -> list:
+    base_dir.mkdir()
+    paths = []
+    for i, device_id in enumerate(('84f7033b3e78', '84f7033b3e79')):
+        paths.append(str(base_dir / f'process_{i}_5.dat'))
+        with open(paths[-1], 'wb') as f:
+            f.write(make_recording(600, device_id=device_id))
+    return paths
+
+
+def test_convert_sidecars(tmp_path):
+    # No index with index_stride=0
+    paths = _make_measurement(tmp_path / 'a')
+    convert_measurement(str(tmp_path / 'a'), n_workers=1, cache_max_bytes=0, index_stride=0)
+    assert not any(os.path.exists(SeekIndex.path_of(path)) for path in paths)
+
+    # An index built at ingest is kept, the others are written with index_stride
+    paths = _make_measurement(tmp_path / 'b')
+    live = SeekIndex(stride=100)
+    live.add(np.arange(600) * IMUParser.FRAME_SZ, IMUParser().decode(open(paths[0], 'rb').read()))
+    live.save(paths[0])
+    convert_measurement(str(tmp_path / 'b'), n_workers=1, cache_max_bytes=0, index_stride=16)
+    assert np.array_equal(SeekIndex.load(paths[0]).entries, live.entries)
+    assert len(SeekIndex.load(paths[1])) == 600 // 16 + 1
+
+    # Sidecars go with the recordings
+    model = ClockModel('84f7033b3e78')
+    model.update(np.arange(600) * 2500, 1634823580000000 + np.arange(600) * 2500)
+    ClockModel.save_all([model], paths[0])
+    res = convert_measurement(str(tmp_path / 'b'), delete_dat=True, n_workers=1, cache_max_bytes=0)
+    assert set(res.keys()) == {'84f7033b3e78', '84f7033b3e79'}
+    assert not any(name.endswith(('.dat', SeekIndex.SUFFIX, ClockModel.SUFFIX)) for name in os.listdir(tmp_path / 'b'))
+
+
+def test_convert_rotated_segments(tmp_path):
+    base_dir = tmp_path / 'm'
+    paths = _make_measurement(base_dir)
+    buf = open(paths[0], 'rb').read()
+    os.remove(paths[0])
+    # recv() sized chunks cut frames at the segment boundaries
+    segmented = SegmentedFile(str(base_dir), 'process_0_5', max_bytes=5000)
+    for start in range(0, len(buf), 1000):
+        segmented.write(buf[start:start + 1000])
+        if start == 30000:
+            # Segments closed so far are converted while the capture goes on
+            n_closed = len(SegmentManifest(str(base_dir), 'process_0_5').complete_paths())
+            assert convert_closed_segments(str(base_dir), cache_dir=str(tmp_path / 'cache')) == n_closed > 1
+            assert convert_closed_segments(str(base_dir), cache_dir=str(tmp_path / 'cache')) == 0
+    segmented.close()
+    assert len(SegmentManifest(str(base_dir), 'process_0_5').paths) > 10
+
+    convert_measurement(str(base_dir), n_workers=1, cache_dir=str(tmp_path / 'cache'))
+    expected = IMUParser().decode(buf)
+    npz = np.load(str(base_dir / 'imu_84f7033b3e78.npz'))
+    assert np.array_equal(npz['seq'][:, 0], expected['seq'])
+    assert np.array_equal(npz['accel_x'][:, 0], expected['accel_x'])
+    assert np.array_equal(npz['tsf_timestamp'][:, 0], expected['tsf_timestamp'])
+
+
+def test_convert_frame_logs_of_several_workers(tmp_path):
+    recording = make_recording(600)
+    writer = CoalescingWriter(flush_interval_s=60, flush_size=1 << 30)
+    repos = [ClientRepo(str(tmp_path), proc_id, decode_at_ingest=True, writer=writer) for proc_id in (0, 1)]
+    sockets = [socket.socketpair() for _ in repos]
+    clis = [IMUConnection(local, '127.0.0.1', 5000, recv_size=0x1000) for local, _ in sockets]
+    for repo, cli in zip(repos, clis):
+        repo.register(cli)
+    # The device reconnected to worker 1, which happens to store its frames before worker 0
+    clis[1].update(recording[300 * IMUParser.FRAME_SZ:])
+    clis[0].update(recording[:300 * IMUParser.FRAME_SZ])
+    for repo in repos:
+        repo.close()
+    writer.stop()
+    for _, remote in sockets:
+        remote.close()
+
+    logs = FrameLog.list(str(tmp_path))
+    assert list(logs.keys()) == ['84f7033b3e78']
+    assert FrameLog.load(logs['84f7033b3e78'])['seq'][0] == 300
+
+    convert_measurement(str(tmp_path), n_workers=1, cache_max_bytes=0)
+    npz = np.load(str(tmp_path / 'imu_84f7033b3e78.npz'))
+    assert np.array_equal(npz['seq'][:, 0], np.arange(600))
+    assert np.array_equal(npz['accel_x'][:, 0], IMUParser().decode(recording)['accel_x'])
@@ -1,5 +1,34 @@
 import numpy as np
-from markit_gateway.functional import EllipseFitter
+from markit_gateway.functional import EllipseFitter, OnlineEllipseFitter
+
+
+def test_online_fit_matches_batch():
+    rng = np.random.default_rng(0)
+    unit = rng.standard_normal((5000, 3))
+    unit /= np.linalg.norm(unit, axis=1, keepdims=True)
+    points = unit * [30, 25, 20] + [5, -3, 1]
+
+    ret, pos, length, _ = EllipseFitter.fit(points)
+    assert ret
+    assert np.allclose(pos, [5, -3, 1], atol=1e-6)
+    assert np.allclose(length, [30, 25, 20], atol=1e-6)
+
+    fitters = [OnlineEllipseFitter(), OnlineEllipseFitter()]
+    for start in range(0, len(points), 7):
+        fitters[0].update(points[start:start + 7])
+    fitters[1].update(points[:2])  # not enough samples yet
+    res = OnlineEllipseFitter.solve_batch(fitters)
+    assert np.allclose(res[0][1], pos) and np.allclose(res[0][2], length)
+    assert res[1][0] is False
+
+
+def test_degenerate_fit_is_rejected():
+    # a close to 0: the center and the axes overflow instead of raising
+    assert OnlineEllipseFitter._result(np.array([1e-300, 1., 0., 1., 0., -1.]))[0] is False
+    assert OnlineEllipseFitter._result(np.array([0., 1., 0., 0., 0., -1.]))[0] is False
+    assert OnlineEllipseFitter._result(np.array([1., 1., np.nan, 0., 0., -1.]))[0] is False
+    ret, pos, length, _ = OnlineEllipseFitter._result(np.array([1., 1., 0., 0., 0., -4.]))
+    assert ret and pos == [0., 0., 0.] and length == [2., 2., 2.]
 
 
 if __name__ == '__main__':
@@ -11,3 +40,5 @@ if __name__ == '__main__':
                      [0, 0, -2]])
     res = EllipseFitter()
     print(res.fit(data))
+    test_online_fit_matches_batch()
+    test_degenerate_fit_is_rejected()
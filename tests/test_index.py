@@ -0,0 +1,53 @@
+import numpy as np
+
+from markit_gateway.common import CoalescingWriter, IMUParser, IMURender, SeekIndex
+from test_parser import make_recording
+
+
+def test_reconnect_appends_to_index(tmp_path):
+    path = str(tmp_path / 'process_0_5.dat')
+    # The second connection reuses the fd, the first one has not been flushed yet
+    writer = CoalescingWriter(flush_interval_s=60., flush_size=1 << 30)
+    recordings = [make_recording(40, timestamp=1634823580000000), make_recording(40, timestamp=1634823590000000)]
+    renders = []
+    for recording in recordings:
+        renders.append(IMURender(path, writer=writer, index_stride=4))
+        for i in range(0, len(recording), 500):
+            renders[-1].update(recording[i:i + 500])
+    [render.close() for render in renders]
+    writer.stop()
+
+    data = open(path, 'rb').read()
+    index = SeekIndex.load(path)
+    # Both sessions are indexed, the second one after the first
+    assert index.entries['offset'].max() >= len(recordings[0]) and np.all(np.diff(index.entries['offset']) > 0)
+    for entry in index.entries:
+        frame = IMUParser.decode_at(data, np.array([entry['offset']]))[0]
+        assert frame['timestamp'] == entry['timestamp'] and frame['tsf_timestamp'] == entry['tsf_timestamp']
+
+
+def test_read_range_matches_full_decode(tmp_path):
+    path = str(tmp_path / 'process_0_5.dat')
+    # Three connections appended to one recording, tsf_timestamp restarts with each of them
+    sessions = [make_recording(300, timestamp=1634823580000000 + k * 10 ** 7) for k in range(3)]
+    with open(path, 'wb') as f:
+        f.write(b''.join(sessions))
+    for k in range(len(sessions)):
+        index = SeekIndex(stride=16)
+        index.add(np.arange(300) * IMUParser.FRAME_SZ + k * len(sessions[0]), IMUParser().decode(sessions[k]))
+        index.save(path)
+    assert len(SeekIndex.load(path)) == 3 * 19
+
+    parser = IMUParser()
+    frames = np.concatenate(list(parser.iter_batches(path)))
+    for method, t_start, t_end in (('tsf_timestamp', 100 * 2500, 140 * 2500),
+                                   ('tsf_timestamp', 0, 5 * 2500),
+                                   ('tsf_timestamp', 290 * 2500, 400 * 2500),
+                                   ('timestamp', 1634823590000000 + 17 * 2500, 1634823600000000 + 33 * 2500)):
+        expected = frames[(frames[method] >= t_start) & (frames[method] < t_end)]
+        assert len(expected) > 0
+        assert np.array_equal(parser.read_range(path, t_start, t_end, method), expected)
+        assert np.array_equal(parser.read_range(path, t_start, t_end, method, device_id='84f7033b3e78'), expected)
+    # Nothing outside the sessions that hold the window is read
+    ranges = SeekIndex.load(path).byte_ranges(1634823590000000 + 17 * 2500, 1634823590000000 + 33 * 2500, 'timestamp')
+    assert len(ranges) == 1 and len(sessions[0]) <= ranges[0][0] and ranges[0][1] < 2 * len(sessions[0])
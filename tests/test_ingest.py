@@ -0,0 +1,116 @@
+import multiprocessing as mp
+import queue
+import socket
+import threading
+import time
+
+from markit_gateway.common import IngestSelector, RecvBuffer, AdaptiveBufferSize, tcp_listen_socket
+
+
+def test_ingest_selector_drains_and_reports_close():
+    wakeup_r, wakeup_w = mp.Pipe(duplex=False)
+    ingest = IngestSelector(wakeup_r)
+    local, remote = socket.socketpair()
+    buf = RecvBuffer(64)
+    ingest.register(local, 'a', buf)
+
+    # A full buffer stops the drain, the rest is read once it has been consumed
+    remote.sendall(bytes(range(100)))
+    handoffs, received, closed = ingest.poll(timeout=1)
+    assert handoffs == [] and closed == []
+    assert received == [('a', 64)] and bytes(buf.take()) == bytes(range(64))
+    handoffs, received, closed = ingest.poll(timeout=1)
+    assert received == [('a', 36)] and bytes(buf.take()) == bytes(range(64, 100))
+
+    wakeup_w.send('new client')
+    handoffs, received, closed = ingest.poll(timeout=1)
+    assert handoffs == ['new client'] and received == []
+
+    # Data sent right before closing is still delivered
+    remote.sendall(b'last')
+    remote.close()
+    handoffs, received, closed = ingest.poll(timeout=1)
+    assert received == [('a', 4)] and bytes(buf.take()) == b'last'
+    assert closed == [('a', None)]
+    assert len(ingest) == 0
+
+    ingest.close()
+    local.close()
+
+
+def test_adaptive_buffer_size_follows_throughput():
+    sizer = AdaptiveBufferSize(min_size=1024, max_size=8192)
+    assert [sizer.observe(n) for n in (1024, 2048, 4096, 8192, 8192)] == [2048, 4096, 8192, 8192, 8192]
+    for _ in range(100):
+        size = sizer.observe(100)
+    assert size == 1024
+
+
+def test_ingest_selector_accepts_whole_queue():
+    server = tcp_listen_socket('127.0.0.1', 0, backlog=64)
+    ingest = IngestSelector()
+    ingest.add_listener(server)
+    clients = [socket.create_connection(server.getsockname()) for _ in range(20)]
+
+    handoffs, _, _ = ingest.poll(timeout=1)
+    assert len(handoffs) == 20
+    assert {addr[1] for _, addr in handoffs} == {client.getsockname()[1] for client in clients}
+
+    [sock.close() for sock, _ in handoffs]
+    [client.close() for client in clients]
+    ingest.close()
+
+
+def _accept_worker(worker_id: int, port: int, ready: mp.Barrier, stop_ev: mp.Event, accepted: mp.Queue):
+    ingest = IngestSelector()
+    ingest.add_listener(tcp_listen_socket('127.0.0.1', port, backlog=1024, reuse_port=True))
+    ready.wait()
+    while not stop_ev.is_set():
+        handoffs, _, _ = ingest.poll(timeout=0.1)
+        for sock, (_, client_port) in handoffs:
+            accepted.put((worker_id, client_port))
+            sock.close()
+    ingest.close()
+
+
+def test_reuseport_workers_admit_connection_burst():
+    n_workers, n_clients = 4, 200
+    # Reserves a port for the workers. Bound but not listening, so that the copies inherited by the workers get
+    # no connections
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    ready, stop_ev, accepted = mp.Barrier(n_workers + 1), mp.Event(), mp.Queue()
+    workers = [mp.Process(target=_accept_worker, args=(i, port, ready, stop_ev, accepted)) for i in range(n_workers)]
+    [worker.start() for worker in workers]
+    ready.wait()
+    probe.close()
+
+    clients = []
+    lock = threading.Lock()
+
+    def connect():
+        sock = socket.create_connection(('127.0.0.1', port), timeout=10)
+        with lock:
+            clients.append(sock)
+    threads = [threading.Thread(target=connect) for _ in range(n_clients)]
+    [thread.start() for thread in threads]
+    [thread.join() for thread in threads]
+
+    admitted = {}
+    deadline = time.time() + 10
+    while len(admitted) < n_clients and time.time() < deadline:
+        try:
+            worker_id, client_port = accepted.get(timeout=0.1)
+            admitted[client_port] = worker_id
+        except queue.Empty:
+            pass
+    stop_ev.set()
+    [worker.join() for worker in workers]
+    client_ports = {client.getsockname()[1] for client in clients}
+    [client.close() for client in clients]
+
+    assert set(admitted.keys()) == client_ports
+    # The kernel spreads the burst among the workers
+    assert len(set(admitted.values())) > 1
@@ -0,0 +1,59 @@
+import numpy as np
+from scipy.spatial.transform import Rotation as R
+from scipy.spatial.transform import Slerp
+
+from markit_gateway.functional import SharedIndexInterpolator
+
+
+def test_linear_matches_np_interp():
+    rng = np.random.default_rng(0)
+    src_t = np.cumsum(rng.integers(2400, 2600, 1000)).astype(np.int64)
+    dst_t = np.linspace(src_t[0] - 100, src_t[-1] + 100, 777).astype(np.int64)
+    values = rng.standard_normal((1000, 9)).astype(np.float32)
+
+    res = SharedIndexInterpolator(src_t, dst_t).linear(values)
+    expected = np.stack([np.interp(dst_t, src_t, values[:, i]) for i in range(9)], axis=1)
+    assert res.shape == (777, 9)
+    assert np.allclose(res, expected, atol=1e-12)
+
+
+def test_slerp_matches_scipy():
+    rng = np.random.default_rng(1)
+    src_t = np.cumsum(rng.integers(2400, 2600, 500)).astype(np.int64)
+    dst_t = np.sort(rng.integers(src_t[0], src_t[-1], 300))
+    quat = R.random(500, random_state=2).as_quat()
+
+    res = SharedIndexInterpolator(src_t, dst_t).slerp(quat)
+    expected = Slerp(src_t, R.from_quat(quat))(dst_t)
+    assert np.allclose((R.from_quat(res) * expected.inv()).magnitude(), 0, atol=1e-6)
+
+
+def test_filtered_linear_matches_convolution():
+    rng = np.random.default_rng(3)
+    src_t = np.arange(4000, dtype=np.int64) * 2500
+    dst_t = np.arange(src_t[0], src_t[-1], 33333, dtype=np.int64)
+    values = rng.standard_normal((4000, 3))
+    taps = rng.random(55)
+
+    res = SharedIndexInterpolator(src_t, dst_t).linear(values, taps)
+    padded = np.concatenate([np.repeat(values[:1], 27, axis=0), values, np.repeat(values[-1:], 27, axis=0)])
+    filtered = np.stack([np.convolve(padded[:, i], taps[::-1], mode='valid') for i in range(3)], axis=1)
+    expected = np.stack([np.interp(dst_t, src_t, filtered[:, i]) for i in range(3)], axis=1)
+    assert np.allclose(res, expected, atol=1e-9)
+
+
+def test_linear_with_repeated_timestamps_matches_np_interp():
+    src_t = np.array([0, 10, 10, 20, 30, 30], dtype=np.int64)
+    dst_t = np.array([-5, 5, 10, 15, 25, 30, 35], dtype=np.int64)
+    values = np.array([1., 2., 3., 4., 5., 6.])
+
+    res = SharedIndexInterpolator(src_t, dst_t).linear(values)
+    assert np.all(np.isfinite(res))
+    assert np.array_equal(res, np.interp(dst_t, src_t, values))
+
+
+if __name__ == '__main__':
+    test_linear_matches_np_interp()
+    test_slerp_matches_scipy()
+    test_filtered_linear_matches_convolution()
+    test_linear_with_repeated_timestamps_matches_np_interp()
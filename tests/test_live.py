@@ -0,0 +1,42 @@
+import numpy as np
+
+from markit_gateway.common import IMUParser
+from markit_gateway.functional import LiveAligner
+
+from test_parser import make_recording
+
+
+def decode(buf: bytes) -> np.ndarray:
+    return IMUParser.decode_at(buf, IMUParser.scan(buf).offsets).copy()
+
+
+def test_live_alignment_waits_for_devices_until_deadline():
+    aligner = LiveAligner(rate_hz=100., max_delay_us=50_000)
+    # tsf_timestamp of frame i is i * 2500, accel_x is 0.5 * i, both devices at 400 Hz
+    dev_a = decode(make_recording(40, device_id='84f7033b3e78'))
+    dev_b = decode(make_recording(40, device_id='84f7033b3e79'))
+    offset = 92_500  # host clock - tsf clock
+
+    aligner.push(dev_a[:4], arrival_us=7_500 + offset)
+    aligner.push(dev_b[:4], arrival_us=7_500 + offset)
+    assert np.array_equal(aligner.poll(now_us=7_500 + offset)['tsf_timestamp'], [0])
+
+    aligner.push(dev_a[4:20], arrival_us=47_500 + offset)
+    aligner.push(dev_b[4:20], arrival_us=47_500 + offset)
+    res = aligner.poll(now_us=47_500 + offset)
+    assert np.array_equal(res['tsf_timestamp'], [10_000, 20_000, 30_000, 40_000])
+    assert not res['devices']['84f7033b3e79']['stale'].any()
+    assert np.allclose(res['devices']['84f7033b3e78']['accel'][:, 0], 0.5 * res['tsf_timestamp'] / 2500)
+
+    # Device b stalls: nothing is emitted until the deadline of 50_000 has passed
+    aligner.push(dev_a[20:], arrival_us=97_500 + offset)
+    assert aligner.poll(now_us=97_500 + offset) is None
+    batches = [aligner.poll(now_us=now_us + offset) for now_us in range(100_000, 140_001, 10_000)]
+    assert np.array_equal(np.concatenate([res['tsf_timestamp'] for res in batches]), [50_000, 60_000, 70_000, 80_000, 90_000])
+    assert all(res['devices']['84f7033b3e79']['stale'].all() for res in batches)
+    assert not any(res['devices']['84f7033b3e78']['stale'].any() for res in batches)
+    assert aligner.stats()['latency_p99_us'] <= 50_000 + 10_000
+
+
+if __name__ == '__main__':
+    test_live_alignment_waits_for_devices_until_deadline()
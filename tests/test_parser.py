@@ -0,0 +1,134 @@
+import io
+import struct
+
+import numpy as np
+
+from markit_gateway.common import IMUParser, FrameStreamDecoder, SequenceTracker
+
+
+def make_frame(seq: int, device_id: str = '84f7033b3e78', timestamp: int = 1634823580000000) -> bytes:
+    imu = struct.pack(IMUParser.ch_imu_data_t_fmt,
+                      0, *[0.5 * seq + i for i in range(16)], 0.0, seq * 10)
+    meta = struct.pack(IMUParser.hi229_dgram_meta_t_fmt,
+                       timestamp + seq * 2500, seq * 2500, seq, 0, device_id.encode())
+    payload = bytes([IMUParser.ADDR]) + imu + meta
+    chksum = 0
+    for b in payload:
+        chksum ^= b
+    return payload + bytes([chksum])
+
+
+def make_recording(n: int, **kwargs) -> bytes:
+    return b''.join(make_frame(i, **kwargs) for i in range(n))
+
+
+def test_columnar_matches_records():
+    buf = b'\x00\x01' + make_recording(50)
+    parser = IMUParser()
+    records = parser(io.BytesIO(buf))
+    columns = parser(io.BytesIO(buf), columnar=True)
+
+    assert len(records) == 50
+    assert np.array_equal(columns['seq'], np.arange(50))
+    assert records[7]['accel_x'] == columns['accel_x'][7]
+    assert records[7]['id'] == '84f7033b3e78'
+    assert records[7]['tsf_timestamp'] == 7 * 2500
+
+
+def test_bad_checksum_is_dropped():
+    buf = bytearray(make_recording(10))
+    buf[3 * IMUParser.FRAME_SZ + 20] ^= 0xff
+    columns = IMUParser()(io.BytesIO(bytes(buf)), columnar=True)
+
+    assert 3 not in columns['seq'].tolist()
+    assert len(columns['seq']) == 9
+
+
+def test_scan_resyncs_after_corruption():
+    frames = [make_frame(i) for i in range(30)]
+    frames[10] = frames[10][:-7]  # dropped bytes
+    frames[20] = b'\xe5\x00' + frames[20]  # garbage in between
+    buf = b''.join(frames)
+
+    scan = IMUParser.scan(buf)
+    seq = IMUParser.decode_at(buf, scan.offsets)['seq'].tolist()
+
+    assert seq == [i for i in range(30) if i != 10]
+    assert scan.skipped_bytes == len(buf) - 29 * IMUParser.FRAME_SZ
+    assert scan.n_resync == 2
+
+
+def test_scan_ignores_false_sync_inside_payload():
+    rng = np.random.default_rng(0)
+    buf = bytearray(make_recording(200))
+    # plant 0xe5 bytes inside payloads, some of which will pass the checksum by chance
+    for pos in rng.integers(0, len(buf), size=400):
+        if pos % IMUParser.FRAME_SZ not in (0, IMUParser.FRAME_SZ - 1):
+            frame_start = pos - pos % IMUParser.FRAME_SZ
+            buf[pos] = IMUParser.ADDR
+            chksum = 0
+            for b in buf[frame_start:frame_start + IMUParser.FRAME_SZ - 1]:
+                chksum ^= b
+            buf[frame_start + IMUParser.FRAME_SZ - 1] = chksum
+
+    scan = IMUParser.scan(bytes(buf))
+    assert scan.skipped_bytes == 0
+    assert len(scan.offsets) == 200
+
+
+def test_stream_decoder_across_chunks():
+    frames = [make_frame(i) for i in range(300)]
+    frames[100] = frames[100][:50]
+    buf = b'\x00\xe5' + b''.join(frames)
+
+    decoder = FrameStreamDecoder(capacity=1024)
+    rng = np.random.default_rng(1)
+    res, cursor = [], 0
+    while cursor < len(buf):
+        step = int(rng.integers(1, 3000))
+        res.append(decoder.feed(buf[cursor:cursor + step]))
+        cursor += step
+
+    assert np.concatenate(res)['seq'].tolist() == [i for i in range(300) if i != 100]
+    assert decoder.n_resync == 1
+    assert decoder.n_checksum_failures == 1
+    assert len(decoder) < IMUParser.FRAME_SZ
+
+
+def test_sequence_tracker_counts_loss():
+    tracker = SequenceTracker(reset_window=5)
+    tracker.update(np.array([10, 11, 12, 15, 16]))
+    tracker.update(np.array([16, 14, 17, 20]))
+    assert (tracker.n_received, tracker.n_lost, tracker.n_duplicates) == (9, 4, 2)
+
+    # The device restarted
+    tracker.update(np.array([0, 1, 3]))
+    assert (tracker.n_resets, tracker.n_lost, tracker.n_received) == (1, 5, 12)
+    assert abs(tracker.loss_rate - 5 / 15) < 1e-12
+
+
+def test_iter_batches_across_windows(tmp_path):
+    frames = [make_frame(i) for i in range(1000)]
+    frames[500] = frames[500][:30]
+    path = tmp_path / 'process_0_5.dat'
+    path.write_bytes(b'\x00\x00' + b''.join(frames))
+
+    parser = IMUParser()
+    batches = list(parser.iter_batches(str(path), batch_size=64))
+
+    assert max(len(batch) for batch in batches) <= 64
+    assert np.concatenate(batches)['seq'].tolist() == [i for i in range(1000) if i != 500]
+    assert parser.last_scan.skipped_bytes == 32
+
+
+if __name__ == '__main__':
+    import pathlib
+    import tempfile
+
+    test_columnar_matches_records()
+    test_bad_checksum_is_dropped()
+    test_scan_resyncs_after_corruption()
+    test_scan_ignores_false_sync_inside_payload()
+    test_stream_decoder_across_chunks()
+    test_sequence_tracker_counts_loss()
+    test_iter_batches_across_windows(pathlib.Path(tempfile.mkdtemp()))
@@ -0,0 +1,50 @@
+import multiprocessing as mp
+
+from markit_gateway.common import IMUParser, IMURender, StateTable
+from test_parser import make_recording
+
+
+def _hammer(table: StateTable, device_id: str, n: int):
+    for i in range(n):
+        table.write({'id': device_id, **{key: i for key in (*StateTable.FLOAT_FIELDS, *StateTable.INT_FIELDS)}})
+
+
+def test_state_table_slots():
+    table = StateTable(2)
+    try:
+        render = IMURender(state_table=table, update_interval_s=1e3)
+        render.update(make_recording(3))
+        published = render.state
+        # The first state is published at once, the next ones every update_interval_s
+        render.update(make_recording(5)[3 * IMUParser.FRAME_SZ:])
+        assert render.state['seq'] == 4
+        assert table.read('84f7033b3e78') == published
+        # The state held back by the throttle is published on close at the latest
+        render.close()
+        assert table.read('84f7033b3e78')['seq'] == 4
+
+        assert table.write({'id': 'a', 'seq': 1}) and table.write({'id': 'a', 'seq': 2})
+        assert not table.write({'id': 'b'})
+        assert len(table) == 2 and table.snapshot()['a']['seq'] == 2 and table.snapshot()['a']['accel_x'] == 0.
+        table.clear()
+        assert table.snapshot() == {} and table.read('a') is None
+    finally:
+        table.unlink()
+
+
+def test_state_table_snapshots_are_consistent():
+    table = StateTable(4)
+    try:
+        writer = mp.Process(target=_hammer, args=(table, 'a', 20000))
+        writer.start()
+        n_reads = 0
+        while writer.is_alive() or n_reads == 0:
+            state = table.read('a')
+            if state is not None:
+                # Every field was written with the same value, a torn copy would mix two writes
+                assert len({value for key, value in state.items() if key != 'id'}) == 1
+                n_reads += 1
+        writer.join()
+        assert table.read('a')['seq'] == 19999
+    finally:
+        table.unlink()
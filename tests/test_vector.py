@@ -0,0 +1,40 @@
+import numpy as np
+
+from markit_gateway.common import IMUParser
+from markit_gateway.functional import FrameBatch, group_by_device
+from test_parser import make_recording
+
+
+def test_frame_batch_grows_and_discards():
+    frames = IMUParser().decode(make_recording(100))
+    batch = FrameBatch(capacity=4)
+    for start in range(0, 100, 7):
+        batch.append(frames[start:start + 7])
+    assert len(batch) == 100 and len(batch._data) == 128
+    assert np.array_equal(batch['seq'], np.arange(100))
+
+    batch.discard(30)
+    assert np.array_equal(batch['seq'], np.arange(30, 100))
+    batch.append(frames[:5])
+    assert np.array_equal(batch['seq'], np.concatenate([np.arange(30, 100), np.arange(5)]))
+    batch.discard(1000)
+    assert len(batch) == 0 and len(batch.data) == 0
+
+
+def test_group_by_device_keeps_arrival_order():
+    devices = ['84f7033b3e79', '84f7033b3e78', '84f7033b3e7a']
+    recordings = {device_id: IMUParser().decode(make_recording(50, device_id=device_id)) for device_id in devices}
+    rng = np.random.default_rng(0)
+    # Interleaved at random, the frames of every device stay in arrival order
+    owner = np.repeat(np.arange(len(devices)), 50)
+    rng.shuffle(owner)
+    frames = np.empty((150,), dtype=IMUParser.FRAME_DTYPE)
+    for i, device_id in enumerate(devices):
+        frames[owner == i] = recordings[device_id]
+
+    res = FrameBatch.concatenate([frames[:60], frames[60:]]).group_by_device()
+    assert sorted(res.keys()) == sorted(devices)
+    for device_id in devices:
+        assert np.array_equal(res[device_id], recordings[device_id])
+    assert group_by_device(recordings[devices[0]])[devices[0]] is recordings[devices[0]]
+    assert group_by_device(frames[:0]) == {}
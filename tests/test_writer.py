@@ -0,0 +1,42 @@
+import os
+import time
+
+from markit_gateway.common import CoalescingWriter
+
+
+def _wait_flushed(writer: CoalescingWriter, timeout_s: float = 5.):
+    deadline = time.time() + timeout_s
+    while writer.metrics()['pending_bytes'] > 0 and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def test_coalescing_writer_flush_and_close(tmp_path, monkeypatch):
+    path = str(tmp_path / 'process_0_5.dat')
+    writer = CoalescingWriter(flush_interval_s=60, flush_size=1 << 30, fsync='close')
+    handle = writer.open(path)
+    for i in range(100):
+        handle.write(bytes([i]) * 10)
+    # Nothing reaches the disk before a flush is due
+    assert not os.path.exists(path) or os.path.getsize(path) == 0
+    assert writer.size(path) == 1000
+    metrics = writer.metrics()
+    assert metrics['pending_bytes'] == metrics['max_pending_bytes'] == 1000 and metrics['n_files'] == 1
+
+    handle.flush()
+    _wait_flushed(writer)
+    metrics = writer.metrics()
+    assert metrics['bytes_written'] == 1000 and metrics['n_flushes'] == 1
+    assert open(path, 'rb').read() == b''.join(bytes([i]) * 10 for i in range(100))
+
+    # A failing fsync on close is logged, the writer keeps going
+    def _fail(fd):
+        raise OSError(5, 'Input/output error')
+    monkeypatch.setattr(os, 'fsync', _fail)
+    handle.close()
+    other = writer.open(str(tmp_path / 'process_0_6.dat'))
+    other.write(b'abc')
+    other.flush()
+    _wait_flushed(writer)
+    assert writer.metrics()['bytes_written'] == 1003
+    writer.stop()
+    assert open(str(tmp_path / 'process_0_6.dat'), 'rb').read() == b'abc'